@@ -0,0 +1,488 @@
+#####################################################################
+# Benchmarks (timings on synthetic data)
+#####################################################################
+
+# import packages
+import time
+import numpy as np
+import kernels
+
+#####################################################################
+# Time a function (best of several repeats)
+#####################################################################
+def time_function(func, *args, repeat=3, **kwargs):
+
+    # best wall time over repeats
+    best = np.inf
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+
+    return best, result
+
+#####################################################################
+# Synthetic profiles (smooth, stably stratified, with some gaps)
+#####################################################################
+def synthetic_profiles(n_profiles=100000, n_levels=50, nan_frac=0.01, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    # depth, temperature, salinity, and a monotonic density-like field
+    z = np.linspace(10.0, 1000.0, n_levels)
+    T = 2.0 + 10.0*np.exp(-z/200.0)[None, :]*rng.uniform(0.2, 1.5, (n_profiles, 1))
+    S = 34.0 + 0.5*(z/1000.0)[None, :]*rng.uniform(0.5, 1.5, (n_profiles, 1))
+    sig0 = 26.0 + np.cumsum(rng.uniform(0.0, 0.05, (n_profiles, n_levels)), axis=1)
+
+    # random gaps
+    T[rng.random(T.shape) < nan_frac] = np.nan
+    S[rng.random(S.shape) < nan_frac] = np.nan
+
+    return z, T, S, sig0
+
+#####################################################################
+# Benchmark the per-profile kernels (numba versus numpy)
+#####################################################################
+def benchmark_kernels(n_profiles=100000, n_levels=50, n_targets=100, repeat=3):
+
+    print('benchmarks.benchmark_kernels')
+
+    # synthetic data
+    z, T, S, sig0 = synthetic_profiles(n_profiles, n_levels)
+    target_z = np.linspace(z.min(), z.max(), 2*n_levels)
+    target_sig0 = np.linspace(np.nanmin(sig0), np.nanmax(sig0), n_targets)
+    N2 = np.abs(np.diff(sig0, axis=1))
+    zmid = 0.5*(z[1:] + z[:-1])
+
+    # the kernels to compare
+    tests = {'interp onto depth' : (kernels.interp_linear, (T, z, target_z)),
+             'interp onto sig0'  : (kernels.interp_linear, (T, sig0, target_sig0)),
+             'mld integral'      : (kernels.mld_integral, (N2, zmid)),
+             'extrema'           : (kernels.column_extrema, (T, z))}
+
+    # backends available here
+    backends = ['numpy']
+    if kernels.HAS_NUMBA:
+        backends.append('numba')
+
+    # time each kernel with each backend
+    original_backend = kernels.BACKEND
+    timings = {}
+    for backend in backends:
+        kernels.set_backend(backend)
+        for name, (func, args) in tests.items():
+            # first call compiles the numba kernels
+            func(*args)
+            timings[(name, backend)], _ = time_function(func, *args, repeat=repeat)
+    kernels.set_backend(original_backend)
+
+    # report
+    print('profiles = ' + str(n_profiles) + ', levels = ' + str(n_levels))
+    for name in tests:
+        line = name.ljust(20)
+        for backend in backends:
+            line = line + backend + ': ' + "%.4f" % timings[(name, backend)] + ' s   '
+        print(line)
+
+    return timings
+
+#####################################################################
+# Check interp_linear (both backends) against np.interp
+#####################################################################
+def check_interp_linear(n_profiles=2000, n_levels=50, n_targets=80, seed=0):
+# - includes gaps, rows with fewer than two valid values (all-NaN, empty),
+#   decreasing profiles, and density inversions; the reference is
+#   np.interp on the running maximum of theta (see kernels.interp_linear)
+# returns the largest difference from the reference for each backend
+
+    print('benchmarks.check_interp_linear')
+
+    rng = np.random.default_rng(seed)
+
+    # increasing theta with inversions, some profiles upside down
+    steps = rng.uniform(-0.02, 0.05, (n_profiles, n_levels))
+    theta = 26.0 + np.cumsum(steps, axis=1)
+    phi = rng.normal(size=(n_profiles, n_levels)).cumsum(axis=1)
+    flip = rng.random(n_profiles) < 0.2
+    theta[flip] = theta[flip, ::-1]
+    phi[flip] = phi[flip, ::-1]
+    target = np.linspace(np.min(theta), np.max(theta), n_targets)
+
+    # gaps and rows that cannot be interpolated
+    phi[rng.random(phi.shape) < 0.02] = np.nan
+    bad = rng.choice(n_profiles, n_profiles//20, replace=False)
+    theta[bad[0::2]] = np.nan
+    theta[bad[1::2], 1:] = np.nan
+
+    # reference, one profile at a time
+    reference = np.full((n_profiles, n_targets), np.nan)
+    for i in range(n_profiles):
+        th, ph = theta[i], phi[i]
+        if np.sum(np.isfinite(th)) < 2:
+            continue
+        if th[-1] < th[0]:
+            th, ph = th[::-1], ph[::-1]
+        th = np.maximum.accumulate(th)
+        inside = (target >= th[0]) & (target <= th[-1])
+        reference[i, inside] = np.interp(target[inside], th, ph)
+
+    # both backends
+    backends = ['numpy']
+    if kernels.HAS_NUMBA:
+        backends.append('numba')
+    original_backend = kernels.BACKEND
+    errors = {}
+    for backend in backends:
+        kernels.set_backend(backend)
+        out = kernels.interp_linear(phi, theta, target)
+        same_nans = np.array_equal(np.isnan(out), np.isnan(reference))
+        errors[backend] = np.nanmax(np.abs(out - reference)) if same_nans else np.inf
+        print(backend + ': largest difference from np.interp = ' + str(errors[backend]))
+    kernels.set_backend(original_backend)
+
+    return errors
+
+#####################################################################
+# Benchmark the PCA solvers (exact float64 versus randomized float32)
+#####################################################################
+def benchmark_pca_solvers(profile_counts=(10000, 100000, 500000),
+                          feature_widths=(100, 400), number_of_pca_components=6,
+                          tol=1e-3, repeat=1, seed=0):
+
+    print('benchmarks.benchmark_pca_solvers')
+
+    from sklearn.decomposition import PCA
+    import load_and_preprocess as lp
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for n_features in feature_widths:
+        for n_profiles in profile_counts:
+
+            # smooth, correlated features (like CT/SA on many levels)
+            z, T, S, sig0 = synthetic_profiles(n_profiles, n_features//2, nan_frac=0.0)
+            X = np.concatenate((T, S), axis=1)
+            X = X + 0.01*rng.standard_normal(X.shape)
+            X = (X - X.mean(axis=0))/X.std(axis=0)
+            X32 = X.astype(np.float32)
+
+            # exact solver, float64
+            t_exact, pca_exact = time_function(
+                lambda: PCA(number_of_pca_components, svd_solver='full').fit(X),
+                repeat=repeat)
+
+            # randomized solver, float32
+            t_rand, pca_rand = time_function(lp.fit_randomized_pca, X32,
+                                             number_of_pca_components, tol=tol,
+                                             repeat=repeat)
+
+            # explained variance and subspace agreement
+            cosines = lp.pca_subspace_agreement(pca_rand, pca_exact)
+            result = {'n_profiles': n_profiles, 'n_features': X.shape[1],
+                      'time_exact': t_exact, 'time_randomized': t_rand,
+                      'variance_exact': np.sum(pca_exact.explained_variance_ratio_),
+                      'variance_randomized': np.sum(pca_rand.explained_variance_ratio_),
+                      'min_cosine': np.min(cosines),
+                      'power_iterations': pca_rand.power_iterations_}
+            results.append(result)
+            print(str(n_profiles).rjust(8) + ' x ' + str(X.shape[1]).ljust(5) +
+                  'exact: ' + "%.3f" % t_exact + ' s   randomized: ' + "%.3f" % t_rand +
+                  ' s   variance: ' + "%.5f" % result['variance_exact'] + ' / ' +
+                  "%.5f" % result['variance_randomized'] +
+                  '   min cos(angle): ' + "%.6f" % result['min_cosine'])
+
+    return results
+
+#####################################################################
+# Benchmark the t-SNE backends (openTSNE versus sklearn)
+#####################################################################
+def benchmark_tsne(sample_sizes=(10000, 100000, 1000000), n_features=6,
+                   backends=('opentsne', 'sklearn'), max_sklearn_size=100000,
+                   perplexity=50, seed=0):
+# - sklearn is skipped above max_sklearn_size (it takes hours at 10^6)
+
+    print('benchmarks.benchmark_tsne')
+
+    import load_and_preprocess as lp
+
+    # synthetic PCA features: a few Gaussian clusters
+    rng = np.random.default_rng(seed)
+    centres = 3.0*rng.standard_normal((8, n_features))
+
+    timings = {}
+    for n in sample_sizes:
+        X = centres[rng.integers(0, 8, n)] + rng.standard_normal((n, n_features))
+        for backend in backends:
+            if backend=='sklearn' and n > max_sklearn_size:
+                continue
+            if backend=='opentsne' and not lp.HAS_OPENTSNE:
+                continue
+            timings[(n, backend)], _ = time_function(lp.tsne_embedding, X,
+                                                     perplexity=perplexity,
+                                                     backend=backend, repeat=1)
+            print(str(n).rjust(8) + ' points   ' + backend.ljust(9) + ': ' +
+                  "%.1f" % timings[(n, backend)] + ' s')
+
+    return timings
+
+#####################################################################
+# Benchmark the i-metric (vectorized versus the per-profile loop)
+#####################################################################
+def benchmark_i_metric(n_profiles=1000000, n_classes=8, loop_profiles=100000,
+                       chunk_size=100000, seed=0):
+# - the loop is only timed on loop_profiles profiles and scaled up
+
+    print('benchmarks.benchmark_i_metric')
+
+    import dask.array as dask_array
+    import gmm
+
+    # random posterior probabilities, with ties: saturated profiles (one
+    # class has all of the probability) and profiles rounded to 0.1
+    rng = np.random.default_rng(seed)
+    posteriors = rng.dirichlet(0.3*np.ones(n_classes), size=n_profiles)
+    saturated = rng.random(n_profiles) < 0.1
+    posteriors[saturated] = np.eye(n_classes)[rng.integers(0, n_classes, np.sum(saturated))]
+    rounded = rng.random(n_profiles) < 0.1
+    posteriors[rounded] = np.round(posteriors[rounded], 1)
+
+    # per-profile loop (get_i_metric)
+    def loop(p):
+        i_metric = np.zeros(p.shape[0])
+        a_b = np.zeros((p.shape[0], 2))
+        for i in range(p.shape[0]):
+            i_metric[i], a_b[i,:] = gmm.get_i_metric(p[i, :].tolist())
+        return i_metric, a_b
+    n_loop = int(np.min((loop_profiles, n_profiles)))
+    t_loop, (i_loop, ab_loop) = time_function(loop, posteriors[:n_loop], repeat=1)
+    t_loop = t_loop*n_profiles/n_loop
+
+    # vectorized, numpy and dask
+    t_numpy, (i_metric, label, runner_up) = time_function(gmm.i_metric_from_posteriors,
+                                                          posteriors)
+    dposteriors = dask_array.from_array(posteriors, chunks=(chunk_size, n_classes))
+    t_dask, _ = time_function(lambda p: [x.compute() for x in gmm.i_metric_from_posteriors(p)],
+                              dposteriors)
+
+    # same answers
+    agree = (np.allclose(i_loop, i_metric[:n_loop]) and
+             np.array_equal(ab_loop[:, 0], label[:n_loop]) and
+             np.array_equal(ab_loop[:, 1], runner_up[:n_loop]))
+
+    print('profiles = ' + str(n_profiles) + ', classes = ' + str(n_classes))
+    print('loop (scaled from ' + str(n_loop) + ' profiles): ' + "%.2f" % t_loop + ' s')
+    print('vectorized (numpy): ' + "%.3f" % t_numpy + ' s   speedup ' + "%.0f" % (t_loop/t_numpy))
+    print('vectorized (dask):  ' + "%.3f" % t_dask + ' s')
+    print('same results as the loop: ' + str(agree))
+
+    return {'loop': t_loop, 'numpy': t_numpy, 'dask': t_dask, 'agree': agree}
+
+#####################################################################
+# Benchmark the clustering backends against the full-covariance GMM
+#####################################################################
+def benchmark_gmm_backends(n_profiles=500000, n_features=6, n_components=8,
+                           backends=(('gmm', 'diag'), ('gmm', 'tied'),
+                                     ('gmm', 'spherical'), ('kmeans', 'spherical'),
+                                     ('bayesian', 'full')),
+                           seed=0):
+# - agreement with the full-covariance GMM is the adjusted Rand index of
+#   the labels (1 = the same partition, whatever the class numbering)
+
+    print('benchmarks.benchmark_gmm_backends')
+
+    from sklearn.metrics import adjusted_rand_score
+    import gmm
+
+    # synthetic PCA features: anisotropic Gaussian clusters
+    rng = np.random.default_rng(seed)
+    centres = 4.0*rng.standard_normal((n_components, n_features))
+    mixing = rng.normal(0.0, 0.5, (n_components, n_features, n_features)) + \
+             np.eye(n_features)[None, :, :]
+    labels_true = rng.integers(0, n_components, n_profiles)
+    noise = rng.standard_normal((n_profiles, n_features))
+    X = centres[labels_true] + np.einsum('nj,nij->ni', noise, mixing[labels_true])
+
+    # reference: full covariance
+    t_fit, reference = time_function(gmm.train_gmm, X, n_components, repeat=1)
+    t_apply, (labels_ref, posteriors_ref, i_ref) = time_function(gmm.classify_features,
+                                                                 reference, X, repeat=1)
+    results = [{'backend': 'gmm', 'covariance_type': 'full', 'n_classes': n_components,
+                'fit': t_fit, 'apply': t_apply, 'ari': 1.0,
+                'log_likelihood': gmm.mean_log_likelihood(reference, X)}]
+
+    # alternatives
+    for backend, covariance_type in backends:
+        t_fit, model = time_function(gmm.train_gmm, X, n_components, backend=backend,
+                                     covariance_type=covariance_type, repeat=1)
+        t_apply, (labels, posteriors, i_metric) = time_function(gmm.classify_features,
+                                                                model, X, repeat=1)
+        results.append({'backend': backend, 'covariance_type': covariance_type,
+                        'n_classes': model.n_components, 'fit': t_fit, 'apply': t_apply,
+                        'ari': adjusted_rand_score(labels_ref, labels),
+                        'log_likelihood': gmm.mean_log_likelihood(model, X)})
+
+    # report
+    print('profiles = ' + str(n_profiles) + ', features = ' + str(n_features) +
+          ', classes = ' + str(n_components))
+    for r in results:
+        print((r['backend'] + ' ' + r['covariance_type']).ljust(20) +
+              'classes: ' + str(r['n_classes']).rjust(2) +
+              '   fit: ' + "%.2f" % r['fit'] + ' s   apply: ' + "%.2f" % r['apply'] +
+              ' s   ARI vs full: ' + "%.3f" % r['ari'] +
+              '   mean log-likelihood: ' + "%.3f" % r['log_likelihood'])
+
+    return results
+
+#####################################################################
+# Classification server (local stand-in client)
+#####################################################################
+def synthetic_pipeline(n_profiles=20000, n_levels=50, n_pca=6, n_components=8, seed=0):
+# a pipeline (see pipeline.build_pipeline) trained on synthetic profiles
+
+    import xarray as xr
+    import gsw
+    import load_and_preprocess as lp
+    import gmm
+    import pipeline
+
+    z, T, S, sig0 = synthetic_profiles(n_profiles, n_levels, nan_frac=0.0, seed=seed)
+    SA = gsw.SA_from_SP(S, z[None, :], 0.0, -60.0)
+    CT = gsw.CT_from_pt(SA, T)
+    profiles = xr.Dataset({'prof_CT': (('profile', 'depth'), CT),
+                           'prof_SA': (('profile', 'depth'), SA)},
+                          coords={'profile': np.arange(n_profiles), 'depth': z})
+    pca, Xpca = lp.fit_and_apply_pca(profiles, number_of_pca_components=n_pca)
+    best_gmm = gmm.train_gmm(Xpca, n_components)
+
+    return pipeline.build_pipeline(profiles, pca, best_gmm)
+
+def check_server(pipe=None, seed=0):
+# - starts the server in a background thread and sends a valid profile, a
+#   profile that does not reach the bottom of the model grid, and a
+#   malformed body; checks the status codes and the responses
+# returns a dictionary: case -> True if the response was as expected
+
+    print('benchmarks.check_server')
+
+    import json
+    import urllib.request
+    import urllib.error
+    import server
+
+    if pipe is None:
+        pipe = synthetic_pipeline(seed=seed)
+
+    # one profile on the model grid, and the top half of another
+    grid = pipe['vertical_grid']
+    z, T, S, sig0 = synthetic_profiles(2, grid.size, nan_frac=0.0, seed=seed + 1)
+    half = grid.size//2
+    valid = {'lon': 0.0, 'lat': -60.0, 'depth': grid.tolist(),
+             'T': T[0].tolist(), 'S': S[0].tolist()}
+    short = {'lon': 0.0, 'lat': -60.0, 'depth': grid[:half].tolist(),
+             'T': T[1, :half].tolist(), 'S': S[1, :half].tolist()}
+    bodies = {'valid': json.dumps({'profiles': [valid]}).encode(),
+              'short': json.dumps({'profiles': [short]}).encode(),
+              'malformed': b'{"profiles": [{"lon": 0.0,'}
+
+    srv, url = server.start_in_background(pipe)
+
+    def send(body):
+        request = urllib.request.Request(url + '/classify', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, json.loads(error.read())
+
+    try:
+        responses = {case: send(body) for case, body in bodies.items()}
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+    code, result = responses['valid']
+    profile = result['profiles'][0] if code==200 else {}
+    passed = {'valid': bool(code==200 and profile.get('label') in range(pipe['n_components']) and
+                            np.isclose(np.sum(profile['posteriors']), 1.0))}
+    code, result = responses['short']
+    profile = result['profiles'][0] if code==200 else {}
+    passed['short'] = (code==200 and profile.get('label') is None and 'error' in profile)
+    code, result = responses['malformed']
+    passed['malformed'] = (code==400 and 'error' in result)
+
+    for case in passed:
+        print(case + ': ' + ('ok' if passed[case] else 'FAILED, response ' +
+                                                        str(responses[case])))
+
+    return passed
+
+#####################################################################
+# Load test of the classification server
+#####################################################################
+def benchmark_server(pipe=None, n_requests=2000, profiles_per_request=10,
+                     concurrency=8, seed=0):
+# - starts the server in a background thread and sends n_requests POST
+#   requests of profiles_per_request profiles from concurrency client
+#   threads; reports the latency percentiles and the throughput
+
+    print('benchmarks.benchmark_server')
+
+    import json
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    import server
+
+    if pipe is None:
+        pipe = synthetic_pipeline(seed=seed)
+
+    # the server must answer correctly before its speed means anything
+    passed = check_server(pipe, seed=seed)
+    if not all(passed.values()):
+        raise RuntimeError('server check failed: ' + str(passed))
+
+    # request bodies (profiles on the model grid, positions in the Southern Ocean)
+    rng = np.random.default_rng(seed)
+    z, T, S, sig0 = synthetic_profiles(n_requests*profiles_per_request,
+                                       pipe['vertical_grid'].size, nan_frac=0.0, seed=seed + 1)
+    bodies = []
+    for r in range(n_requests):
+        rows = range(r*profiles_per_request, (r + 1)*profiles_per_request)
+        records = [{'lon': float(rng.uniform(-60, 80)), 'lat': float(rng.uniform(-70, -45)),
+                    'depth': pipe['vertical_grid'].tolist(),
+                    'T': T[i].tolist(), 'S': S[i].tolist()} for i in rows]
+        bodies.append(json.dumps({'profiles': records}).encode())
+
+    srv, url = server.start_in_background(pipe)
+
+    def send(body):
+        t0 = time.perf_counter()
+        request = urllib.request.Request(url + '/classify', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read())
+        return time.perf_counter() - t0, len(result['profiles'])
+
+    # warm up, then the load test
+    send(bodies[0])
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, bodies))
+    wall = time.perf_counter() - t0
+    srv.shutdown()
+    srv.server_close()
+
+    latency = 1000*np.array([r[0] for r in results])
+    n_classified = np.sum([r[1] for r in results])
+    summary = {'p50_ms': np.percentile(latency, 50), 'p95_ms': np.percentile(latency, 95),
+               'p99_ms': np.percentile(latency, 99), 'requests_per_s': n_requests/wall,
+               'profiles_per_s': n_classified/wall}
+
+    print('requests = ' + str(n_requests) + ' x ' + str(profiles_per_request) +
+          ' profiles, client threads = ' + str(concurrency))
+    print('latency p50 / p95 / p99: ' + "%.1f" % summary['p50_ms'] + ' / ' +
+          "%.1f" % summary['p95_ms'] + ' / ' + "%.1f" % summary['p99_ms'] + ' ms')
+    print('throughput: ' + "%.0f" % summary['requests_per_s'] + ' requests/s, ' +
+          "%.0f" % summary['profiles_per_s'] + ' profiles/s')
+
+    return summary
@@ -5,19 +5,41 @@
 # import modules
 from sklearn import mixture
 import numpy as np
-import random
+import sampling
+import gmm as gm
 
 #####################################################################
 # Calculate BIC and AIC
 #####################################################################
-def calc_bic_and_aic(Xpca, max_N, max_iter=20):
-# calc_bic_and_aic(Xpca, max_N, max_iter=20)
+def calc_bic_and_aic(Xpca, max_N, max_iter=20, sample_size=1000, strata=None,
+                     random_state=sampling.DEFAULT_SEED, warm_start=False,
+                     split_by='variance', compare_to_cold=False):
+# calc_bic_and_aic(Xpca, max_N, max_iter=20, sample_size=1000, strata=None,
+#                  random_state=0, warm_start=False)
+#   strata : None, or a stratum code for each row of Xpca (e.g. from
+#            sampling.profile_strata) to draw stratified subsets
+#   warm_start : sweep mode; each of the max_iter subsets is used for all
+#            numbers of components, and the K+1 model is initialized from
+#            the K model (see gmm.sweep_gmm)
+#   compare_to_cold : (sweep mode) also fit every K from scratch on the same
+#            subsets, report the iterations and wall time of both, and score
+#            each K and subset with the better (higher log-likelihood) fit
+# - warm starts skip the k-means initialization of each fit but need more
+#   EM iterations, and can end in a different local optimum than a fit
+#   from scratch (see gmm.sweep_gmm): run compare_to_cold on the features
+#   before relying on them
 # returns bic_mean, bic_std, aic_mean, aic_std
 
     # start message
     print('bic_and_aic.calc_bic_and_aic')
     print('--- this may take some time ---')
 
+    if warm_start==True:
+        return calc_bic_and_aic_sweep(Xpca, max_N, max_iter=max_iter,
+                                      sample_size=sample_size, strata=strata,
+                                      random_state=random_state, split_by=split_by,
+                                      compare_to_cold=compare_to_cold)
+
     # initialize, declare variables
     bic_scores = np.zeros((2,max_iter))
     aic_scores = np.zeros((2,max_iter))
@@ -26,6 +48,9 @@ def calc_bic_and_aic(Xpca, max_N, max_iter=20):
     n_components_range = range(2, max_N)
     iter_range = range(0,max_iter)
 
+    # one generator for all the subsets (reproducible, but each one different)
+    rng = sampling.get_rng(random_state)
+
     # iterate through all the covariance types (just 'full' for now)
     cv_types = ['full']
 
@@ -38,8 +63,7 @@ def calc_bic_and_aic(Xpca, max_N, max_iter=20):
             # repeat the BIC step for better statistics
             for bic_iter in iter_range:
                 # select a new random subset
-                rows_id = random.sample(range(0,Xpca.shape[0]-1), 1000)
-                Xpca_for_BIC = Xpca[rows_id,:]
+                Xpca_for_BIC = Xpca[random_subset(Xpca, sample_size, strata, rng),:]
                 # fit a Gaussian mixture model
                 gmm = mixture.GaussianMixture(n_components=n_components,
                                               covariance_type=cv_type,
@@ -71,3 +95,70 @@ def calc_bic_and_aic(Xpca, max_N, max_iter=20):
     aic_std = np.std(aic_scores, axis=1)
 
     return bic_mean, bic_std, aic_mean, aic_std
+
+#####################################################################
+# Calculate BIC and AIC (sweep mode, warm-started across K)
+#####################################################################
+def calc_bic_and_aic_sweep(Xpca, max_N, max_iter=20, sample_size=1000, strata=None,
+                           random_state=sampling.DEFAULT_SEED, split_by='variance',
+                           compare_to_cold=False):
+
+    print('bic_and_aic.calc_bic_and_aic_sweep')
+
+    n_components_range = range(2, max_N)
+    rng = sampling.get_rng(random_state)
+
+    # scores, iterations, and times: (number of components, subset)
+    shape = (len(n_components_range), max_iter)
+    bic_scores = np.zeros(shape)
+    aic_scores = np.zeros(shape)
+    log_likelihood = np.full(shape, -np.inf)
+    kept = np.empty(shape, dtype=object)
+    n_iter = {'warm': np.zeros(shape, dtype=int), 'cold': np.zeros(shape, dtype=int)}
+    times = {'warm': np.zeros(shape), 'cold': np.zeros(shape)}
+
+    modes = [('warm', True)]
+    if compare_to_cold==True:
+        modes.append(('cold', False))
+
+    # one subset per iteration, shared by all numbers of components
+    for bic_iter in range(0, max_iter):
+        Xpca_for_BIC = np.asarray(Xpca[random_subset(Xpca, sample_size, strata, rng),:])
+        for mode, warm in modes:
+            gmms, info = gm.sweep_gmm(Xpca_for_BIC, n_components_range, random_state=42,
+                                      warm_start=warm, split_by=split_by)
+            n_iter[mode][:, bic_iter] = [i['n_iter'] for i in info]
+            times[mode][:, bic_iter] = [i['time'] for i in info]
+            # keep the better fit of each K
+            for i, g in enumerate(gmms):
+                if g.log_likelihood_ > log_likelihood[i, bic_iter]:
+                    log_likelihood[i, bic_iter] = g.log_likelihood_
+                    bic_scores[i, bic_iter] = g.bic(Xpca_for_BIC)
+                    aic_scores[i, bic_iter] = g.aic(Xpca_for_BIC)
+                    kept[i, bic_iter] = g.start_
+
+    # report iterations and wall time
+    for mode, warm in modes:
+        print('bic_and_aic.calc_bic_and_aic_sweep: ' + mode + ' starts, mean EM iterations per K = ' +
+              str(np.round(np.mean(n_iter[mode], axis=1), 1)) + ', total time = ' +
+              "%.1f" % np.sum(times[mode]) + ' s')
+    print('bic_and_aic.calc_bic_and_aic_sweep: scored with ' + str(np.sum(kept=='warm')) +
+          ' warm-started and ' + str(np.sum(kept=='cold')) + ' cold fits')
+
+    # mean values and standard deviations for BIC and AIC
+    bic_mean = np.mean(bic_scores, axis=1)
+    aic_mean = np.mean(aic_scores, axis=1)
+    bic_std = np.std(bic_scores, axis=1)
+    aic_std = np.std(aic_scores, axis=1)
+
+    return bic_mean, bic_std, aic_mean, aic_std
+
+#####################################################################
+# Random (or stratified) subset of rows
+#####################################################################
+def random_subset(Xpca, sample_size, strata, rng):
+
+    if strata is None:
+        return sampling.random_rows(Xpca.shape[0], sample_size, rng)
+
+    return sampling.stratified_rows(strata, sample_size, rng)
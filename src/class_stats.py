@@ -0,0 +1,194 @@
+#####################################################################
+# Class statistics (streaming mean, std, count, quantiles)
+#####################################################################
+#
+# - The statistics of each class are accumulated chunk by chunk along the
+#   profile dimension: counts and means/variances are merged between
+#   chunks (Chan/Welford update), and the quantiles are read off a
+#   histogram of each class on each level.
+# - Each variable takes two passes over the profiles: one for the range
+#   of each level (the histogram bins) and one to accumulate; with fixed
+#   ranges (e.g. the T/S ranges of the plots) the first pass is skipped.
+# - Only the selected variables are summarised, so the (class x level)
+#   summary is small and can be reused by all of the class-structure plots.
+#
+
+# import packages
+import numpy as np
+import xarray as xr
+
+# variables summarised by default (those present in the Dataset)
+DEFAULT_VARIABLES = ('prof_CT', 'prof_SA', 'sig0', 'ct_on_sig0', 'sa_on_sig0')
+DEFAULT_QUANTILES = (0.25, 0.50, 0.75)
+
+#####################################################################
+# Class summary (class x level) of selected variables
+#####################################################################
+def class_summary(profiles, variables=None, quantiles=DEFAULT_QUANTILES,
+                  n_bins=500, chunk_size=20000, ranges=None):
+# class_summary(profiles, variables=None, quantiles=(0.25,0.5,0.75),
+#               n_bins=500, chunk_size=20000, ranges=None)
+#   profiles : Dataset with 'label' (one per profile)
+#   variables : variables to summarise (default: DEFAULT_VARIABLES present)
+#   n_bins : histogram bins per class and level (for the quantiles)
+#   chunk_size : profiles per chunk
+#   ranges : dictionary of fixed histogram ranges, e.g.
+#            {'prof_CT': Trange, 'prof_SA': Srange}; variables in it take a
+#            single pass (values outside the range count in the end bins),
+#            the others a first pass for the range of each level
+# returns summary (Dataset) with, for each variable v on dims (label, level):
+#   v + '_mean', v + '_std', v + '_count', and v + '_quantiles' (quantile, label, level)
+#
+# - the quantiles are approximate: linearly interpolated within histogram
+#   bins that span the range of each level
+
+    print('class_stats.class_summary')
+
+    if variables is None:
+        variables = [v for v in DEFAULT_VARIABLES if v in profiles]
+
+    # labels (small, held in memory)
+    labels = np.asarray(profiles.label.values).astype(np.int64)
+    n_classes = int(labels.max()) + 1
+    nprof = labels.size
+    classes = np.arange(n_classes)
+
+    summary = xr.Dataset(coords={'label': classes,
+                                 'quantile': np.asarray(quantiles)})
+    summary['n_profiles'] = xr.DataArray(np.bincount(labels, minlength=n_classes),
+                                         dims='label')
+
+    for v in variables:
+
+        # profile dimension first; the remaining (level) dims are flattened
+        da = profiles[v].transpose('profile', ...)
+        level_dims = da.dims[1:]
+        level_shape = da.shape[1:]
+        nlev = int(np.prod(level_shape))
+
+        # histogram range on each level (fixed, or a pass over the profiles)
+        if ranges is not None and v in ranges:
+            lo = np.full(nlev, ranges[v][0], dtype=np.float64)
+            hi = np.full(nlev, ranges[v][1], dtype=np.float64)
+        else:
+            lo = np.asarray(da.min(dim='profile', skipna=True).values, dtype=np.float64).ravel()
+            hi = np.asarray(da.max(dim='profile', skipna=True).values, dtype=np.float64).ravel()
+        lo[~np.isfinite(lo)] = 0.0
+        hi[~np.isfinite(hi)] = 0.0
+        width = (hi - lo)/n_bins
+        width[width <= 0] = 1.0
+
+        # accumulators
+        count = np.zeros((n_classes, nlev))
+        mean = np.zeros((n_classes, nlev))
+        M2 = np.zeros((n_classes, nlev))
+        hist = np.zeros((n_classes*nlev*n_bins,), dtype=np.int64)
+
+        # one pass over the profiles, chunk by chunk
+        for start in range(0, nprof, chunk_size):
+            stop = np.min((start + chunk_size, nprof))
+            X = np.asarray(da[start:stop].values, dtype=np.float64).reshape(stop - start, nlev)
+            chunk_labels = labels[start:stop]
+            accumulate(X, chunk_labels, n_classes, lo, width, n_bins,
+                       count, mean, M2, hist)
+
+        # statistics
+        # (population standard deviation, as in groupby("label").std())
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(M2/count)
+        mean[count==0] = np.nan
+        qvalues = histogram_quantiles(hist.reshape(n_classes, nlev, n_bins),
+                                      lo, width, quantiles)
+
+        # store (with the level coordinates of the variable)
+        shape = (n_classes,) + level_shape
+        coords = {d: da[d] for d in level_dims if d in da.coords}
+        summary[v + '_mean'] = xr.DataArray(mean.reshape(shape),
+                                            dims=('label',) + level_dims, coords=coords)
+        summary[v + '_std'] = xr.DataArray(std.reshape(shape),
+                                           dims=('label',) + level_dims, coords=coords)
+        summary[v + '_count'] = xr.DataArray(count.reshape(shape).astype(np.int64),
+                                             dims=('label',) + level_dims, coords=coords)
+        summary[v + '_quantiles'] = xr.DataArray(qvalues.reshape((len(quantiles),) + shape),
+                                                 dims=('quantile', 'label') + level_dims,
+                                                 coords=coords)
+
+    summary.attrs['variables'] = list(variables)
+
+    return summary
+
+#####################################################################
+# Add one chunk to the accumulators (in place)
+#####################################################################
+def accumulate(X, labels, n_classes, lo, width, n_bins, count, mean, M2, hist):
+# X : (profiles, levels), may contain NaNs
+# count, mean, M2 : (classes, levels); hist : flattened (classes, levels, bins)
+
+    nlev = X.shape[1]
+    valid = np.isfinite(X)
+    cell = (labels[:, None]*nlev + np.arange(nlev)[None, :])[valid]
+    x = X[valid]
+    size = n_classes*nlev
+
+    # count, mean, and sum of squared deviations of this chunk
+    n_b = np.bincount(cell, minlength=size).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_b = np.bincount(cell, weights=x, minlength=size)/n_b
+    mean_b[n_b==0] = 0.0
+    M2_b = np.bincount(cell, weights=(x - mean_b[cell])**2, minlength=size)
+
+    # merge with the running statistics (Chan et al.)
+    n_a = count.ravel()
+    mean_a = mean.ravel()
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac_b = np.where(n > 0, n_b/n, 0.0)
+    mean.ravel()[:] = mean_a + delta*frac_b
+    M2.ravel()[:] = M2.ravel() + M2_b + delta**2*n_a*frac_b
+    count.ravel()[:] = n
+
+    # histogram (bins span the range of each level)
+    level = cell % nlev
+    ibin = np.clip(((x - lo[level])/width[level]).astype(np.int64), 0, n_bins - 1)
+    hist += np.bincount(cell*n_bins + ibin, minlength=size*n_bins)
+
+#####################################################################
+# Quantiles from histograms (linear within bins)
+#####################################################################
+def histogram_quantiles(hist, lo, width, quantiles):
+# hist : (classes, levels, bins); lo, width : (levels,)
+# returns array (quantiles, classes, levels), NaN where a class has no data
+
+    n_bins = hist.shape[-1]
+    cumulative = np.cumsum(hist, axis=-1)
+    total = cumulative[..., -1]
+
+    qvalues = np.full((len(quantiles),) + total.shape, np.nan)
+    for iq, q in enumerate(quantiles):
+        target = q*total
+        # first bin where the cumulative count reaches the target
+        ibin = np.minimum(np.sum(cumulative < target[..., None], axis=-1), n_bins - 1)
+        below = np.take_along_axis(cumulative, ibin[..., None], axis=-1)[..., 0] - \
+                np.take_along_axis(hist, ibin[..., None], axis=-1)[..., 0]
+        inbin = np.take_along_axis(hist, ibin[..., None], axis=-1)[..., 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.clip(np.where(inbin > 0, (target - below)/inbin, 0.5), 0.0, 1.0)
+        values = lo[None, :] + (ibin + frac)*width[None, :]
+        qvalues[iq] = np.where(total > 0, values, np.nan)
+
+    return qvalues
+
+#####################################################################
+# Means and standard deviations in the layout of groupby("label")
+#####################################################################
+def means_and_stds(summary, variables=None):
+# returns class_means, class_stds (Datasets with the original variable names)
+
+    if variables is None:
+        variables = summary.attrs['variables']
+
+    class_means = xr.Dataset({v: summary[v + '_mean'] for v in variables})
+    class_stds = xr.Dataset({v: summary[v + '_std'] for v in variables})
+
+    return class_means, class_stds
@@ -5,6 +5,7 @@
 import gsw
 import xarray as xr
 import numpy as np
+import kernels
 
 #####################################################################
 # Calculate density of each profile in an xarray dataset
@@ -67,23 +68,16 @@ def calc_Nsquared(df):
     print('density.calc_Nsquared')
 
     # extract a few variables
-    sa = df.prof_SA.values
-    ct = df.prof_CT.values
+    sa = df.prof_SA.transpose('profile','depth').values
+    ct = df.prof_CT.transpose('profile','depth').values
     p = df.depth.values
     lon = df.lon.values
     lat = df.lat.values
 
-    # initialize array of zeros
-    Nsquared = np.zeros((sa.shape[0],sa.shape[1]-1))
-    Nsquared[:,:] = np.NaN
-    p_mid = np.zeros((sa.shape[1]-1))
-    p_mid[:] = np.NaN
-
-    # loop over profiles, calculate N2 separately
-    for n in np.arange(sa.shape[0]):
-        Nsq1, p_mid1 = gsw.stability.Nsquared(sa[n,:], ct[n,:], p)
-        Nsquared[n,:] = Nsq1
-        p_mid[:] = p_mid1
+    # calculate N2 for all profiles at once (gsw works along the depth axis)
+    Nsquared, p_mid = gsw.stability.Nsquared(sa, ct,
+                                             np.broadcast_to(p, sa.shape), axis=1)
+    p_mid = p_mid[0,:]
 
     # convert to DataArray
     da = xr.DataArray(data=Nsquared,
@@ -112,19 +106,11 @@ def calc_mixed_layer_depth(df):
     print('NOTE: must call density.calc_Nsquared first')
 
     # extract a few variables
-    N2 = df.Nsquared.values
+    N2 = df.Nsquared.transpose('profile','depth_mid').values
     p = df.depth_mid.values
 
-    # initialize array of zeros
-    mld = np.zeros((N2.shape[0],))
-    mld[:] = np.NaN
-
-    # loop over profiles, integrate downward (z_b= 1000 m reference)
-    for n in np.arange(N2.shape[0]):
-
-        N2a = N2[n,:]
-        A = np.cumsum(p*N2a)/np.cumsum(N2a)
-        mld[n] = A[-1]
+    # integrate downward (z_b= 1000 m reference), all profiles at once
+    mld = kernels.mld_integral(N2, p)
 
     # convert to DataArray
     da = xr.DataArray(data=mld,
@@ -137,6 +123,41 @@ def calc_mixed_layer_depth(df):
 
     return df
 
+#####################################################################
+# Temperature, salinity, and density extrema of each profile
+#####################################################################
+def calc_extrema(df):
+
+    # display
+    print('density.calc_extrema')
+
+    # vertical coordinate
+    z = df.depth.values
+
+    # maximum/minimum values and their depths (all profiles at once)
+    Tmax, Tmax_depth, Tmin, Tmin_depth = kernels.column_extrema(
+        df.prof_CT.transpose('profile','depth').values, z)
+    Smax, Smax_depth, Smin, Smin_depth = kernels.column_extrema(
+        df.prof_SA.transpose('profile','depth').values, z)
+    sig0max, sig0max_depth, sig0min, sig0min_depth = kernels.column_extrema(
+        df.sig0.transpose('profile','depth').values, z)
+
+    # add to df dataset
+    df['Tmax'] = xr.DataArray(Tmax, dims=["profile"])
+    df['Tmax_depth'] = xr.DataArray(Tmax_depth, dims=["profile"])
+    df['Tmin'] = xr.DataArray(Tmin, dims=["profile"])
+    df['Tmin_depth'] = xr.DataArray(Tmin_depth, dims=["profile"])
+    df['Smax'] = xr.DataArray(Smax, dims=["profile"])
+    df['Smax_depth'] = xr.DataArray(Smax_depth, dims=["profile"])
+    df['Smin'] = xr.DataArray(Smin, dims=["profile"])
+    df['Smin_depth'] = xr.DataArray(Smin_depth, dims=["profile"])
+    df['sig0max'] = xr.DataArray(sig0max, dims=["profile"])
+    df['sig0max_depth'] = xr.DataArray(sig0max_depth, dims=["profile"])
+    df['sig0min'] = xr.DataArray(sig0min, dims=["profile"])
+    df['sig0min_depth'] = xr.DataArray(sig0min_depth, dims=["profile"])
+
+    return df
+
 #####################################################################
 # MLD stats
 #####################################################################
@@ -0,0 +1,164 @@
+#####################################################################
+# Feature store (memory-mapped feature matrices on disk)
+#####################################################################
+#
+# - A feature store holds one feature matrix (e.g. Xscaled or Xpca) with
+#   one row per profile, in profile order:
+#     file_name + '.npy'           the features (memory-mappable)
+#     file_name + '_profiles.npy'  the profile ID of each row
+#     file_name + '.json'          metadata (shape, dtype, description,
+#                                  and whatever produced the features)
+# - Stores are opened read-only and memory-mapped, so downstream stages
+#   (BIC, GMM, t-SNE, plotting) and later runs read the features without
+#   copying them or recomputing the PCA.
+# - Before reusing a store, check with is_current that it holds the same
+#   profiles and was produced the same way (e.g. by the same PCA).
+#
+
+# import packages
+import os
+import json
+import hashlib
+import numpy as np
+
+# increment when the layout of the store changes
+STORE_VERSION = 1
+
+#####################################################################
+# File names
+#####################################################################
+def store_files(file_name):
+
+    # allow the name of the .npy file to be given
+    if file_name.endswith('.npy'):
+        file_name = file_name[:-4]
+
+    return file_name + '.npy', file_name + '_profiles.npy', file_name + '.json'
+
+def exists(file_name):
+
+    return all(os.path.isfile(f) for f in store_files(file_name))
+
+#####################################################################
+# Create an empty store (to be filled chunk by chunk)
+#####################################################################
+def create_features(file_name, profile_ids, n_features, dtype=np.float64,
+                    metadata=None):
+# create_features(file_name, profile_ids, n_features, dtype=np.float64, metadata=None)
+# returns a writable memory-mapped array, shape (number of profiles, n_features)
+
+    print('feature_store.create_features')
+
+    features_file, profiles_file, metadata_file = store_files(file_name)
+    directory = os.path.dirname(features_file)
+    if (directory != '') and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # profile IDs and metadata
+    profile_ids = np.asarray(profile_ids)
+    np.save(profiles_file, profile_ids, allow_pickle=False)
+    meta = {'version': STORE_VERSION,
+            'shape': [int(profile_ids.size), int(n_features)],
+            'dtype': np.dtype(dtype).str}
+    if metadata is not None:
+        meta.update(metadata)
+    with open(metadata_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # features
+    X = np.lib.format.open_memmap(features_file, mode='w+', dtype=dtype,
+                                  shape=(profile_ids.size, n_features))
+
+    return X
+
+#####################################################################
+# Write a feature matrix (in chunks, so X can itself be memory-mapped)
+#####################################################################
+def write_features(file_name, X, profile_ids, metadata=None, chunk_size=100000):
+
+    print('feature_store.write_features')
+
+    Xstore = create_features(file_name, profile_ids, X.shape[1],
+                             dtype=X.dtype, metadata=metadata)
+    for start in range(0, X.shape[0], chunk_size):
+        Xstore[start:start + chunk_size, :] = X[start:start + chunk_size, :]
+    Xstore.flush()
+
+    return Xstore
+
+#####################################################################
+# Open a store (read-only, memory-mapped)
+#####################################################################
+def open_features(file_name, profiles=None):
+# open_features(file_name, profiles=None)
+#   profiles : if given, the store must hold exactly these profiles
+#              (same IDs, same order)
+# returns X (read-only memmap), profile_ids, metadata
+
+    print('feature_store.open_features')
+
+    features_file, profiles_file, metadata_file = store_files(file_name)
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    if metadata.get('version') != STORE_VERSION:
+        raise ValueError('feature store version ' + str(metadata.get('version')) +
+                         ' does not match ' + str(STORE_VERSION))
+
+    X = np.load(features_file, mmap_mode='r')
+    profile_ids = np.load(profiles_file, mmap_mode='r')
+    if list(X.shape) != metadata['shape']:
+        raise ValueError('feature store ' + features_file + ' has the wrong shape')
+
+    if profiles is not None and not matches(profile_ids, profiles):
+        raise ValueError('feature store ' + features_file +
+                         ' does not hold the same profiles')
+
+    return X, profile_ids, metadata
+
+#####################################################################
+# Does a store hold exactly these profiles (in this order)?
+#####################################################################
+def matches(profile_ids, profiles):
+
+    ids = profiles.profile.values
+    return (ids.shape == profile_ids.shape) and np.array_equal(ids, profile_ids)
+
+#####################################################################
+# Fingerprint of a set of profiles (IDs and positions)
+#####################################################################
+def profile_fingerprint(profiles):
+# - sha1 of the profile IDs and the lon, lat, and time coordinates (those
+#   that exist), so that two selections of the same size are told apart
+#   even when the profile coordinate is only an index
+
+    h = hashlib.sha1()
+    for name in ('profile', 'lon', 'lat', 'time'):
+        if name in profiles.coords:
+            h.update(name.encode())
+            h.update(np.ascontiguousarray(profiles[name].values).tobytes())
+
+    return h.hexdigest()
+
+#####################################################################
+# Can a store be reused for these profiles?
+#####################################################################
+def is_current(file_name, profiles, metadata):
+# is_current(file_name, profiles, metadata)
+#   metadata : dictionary of values the store's metadata must have (e.g.
+#              load_and_preprocess.xpca_metadata)
+# returns True if the store exists, holds exactly these profiles (same
+# IDs, same order), and has the given metadata
+
+    if not exists(file_name):
+        return False
+
+    X, profile_ids, stored = open_features(file_name)
+    if not matches(profile_ids, profiles):
+        print('feature_store.is_current: ' + file_name + ' holds different profiles')
+        return False
+    for key, value in metadata.items():
+        if stored.get(key) != value:
+            print('feature_store.is_current: ' + file_name + ' has a different ' + key)
+            return False
+
+    return True
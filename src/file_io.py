@@ -62,41 +62,263 @@ def save_pca(file_name, pca):
 #####################################################################
 # Load PCA using joblib
 #####################################################################
-def load_pca(file_name, pca):
+def load_pca(file_name):
 
     print('file_io.load_pca')
 
-    # save pca object
-    joblib.load(pca, file_name + '.pkl')
+    # load pca object (including pca.scaler_, if it was saved with one)
+    pca = joblib.load(file_name + '.pkl')
+
+    return pca
+
+#####################################################################
+# Save UMAP embedding using joblib
+#####################################################################
+def save_umap(file_name, embedding):
+
+    print('file_io.save_umap')
+
+    # save umap object (including embedding.scaler_)
+    joblib.dump(embedding, file_name + '.pkl')
+
+#####################################################################
+# Load UMAP embedding using joblib
+#####################################################################
+def load_umap(file_name):
+
+    print('file_io.load_umap')
+
+    # load umap object
+    embedding = joblib.load(file_name + '.pkl')
+
+    return embedding
+
+#####################################################################
+# Model file name (region, depth range, and number of components)
+#####################################################################
+def model_file_name(dloc, prefix, lon_min, lon_max, lat_min, lat_max,
+                    zmin, zmax, n_label, descrip, extension=''):
+# e.g. model_file_name('models/', 'gmm', -65, 80, -85, -30, 20, 1000, '5K_', 'allDomain')
+#   -> 'models/gmm_-65to80lon_-85to-30lat_20to1000depth_5K_allDomain'
+
+    file_name = (dloc + prefix + '_' +
+                 str(int(lon_min)) + 'to' + str(int(lon_max)) + 'lon_' +
+                 str(int(lat_min)) + 'to' + str(int(lat_max)) + 'lat_' +
+                 str(int(zmin)) + 'to' + str(int(zmax)) + 'depth_' +
+                 n_label + descrip + extension)
+
+    return file_name
+
+#####################################################################
+# Save classification pipeline (scaler + PCA + GMM) using joblib
+#####################################################################
+def save_pipeline(file_name, pipeline):
+
+    print('file_io.save_pipeline')
+
+    # save pipeline dictionary
+    joblib.dump(pipeline, file_name + '.pkl')
+
+#####################################################################
+# Load classification pipeline
+#####################################################################
+def load_pipeline(file_name):
+
+    import pipeline as pl
+
+    print('file_io.load_pipeline')
+
+    # load pipeline dictionary
+    pipeline = joblib.load(file_name + '.pkl')
+
+    # check version
+    if pipeline.get('version') != pl.PIPELINE_VERSION:
+        raise ValueError('pipeline version ' + str(pipeline.get('version')) +
+                         ' does not match ' + str(pl.PIPELINE_VERSION))
+
+    return pipeline
 
 #####################################################################
-# Save GMM as numpy files
+# Save GMM (single memory-mappable file)
 #####################################################################
-def save_gmm(file_name, gmm):
+# file_name + '.gmm' layout:
+#   GMM_FILE_MAGIC (8 bytes), header length (uint32, little-endian),
+#   header (JSON: version, covariance type, shapes, array offsets, and
+#   metadata), then the arrays (float64, C order, each aligned to 64
+#   bytes): weights, means, covariances, precisions_cholesky, log_det
+# - precisions_cholesky and log_det (log-determinant of each Cholesky
+#   factor) are stored so that loading needs no factorization or inversion
+#   (precisions_ is the product of the stored factors)
+
+GMM_FILE_MAGIC = b'SOGMM\x00\x00\n'
+GMM_FILE_VERSION = 1
+GMM_ARRAYS = ('weights', 'means', 'covariances', 'precisions_cholesky', 'log_det')
+
+def save_gmm(file_name, gmm, pca=None, metadata=None):
+# save_gmm(file_name, gmm, pca=None, metadata=None)
+#   pca : the PCA (or other transform) the GMM was trained on; its output
+#         width and a fingerprint are stored to check it when loading
+#   metadata : extra information to store (JSON-serializable dictionary)
 
     print('file_io.save_gmm')
 
-    # save weights, means, and covariances of GMM
-    np.save(file_name + '_weights.npy', gmm.weights_, allow_pickle=False)
-    np.save(file_name + '_means.npy', gmm.means_, allow_pickle=False)
-    np.save(file_name + '_covariances.npy', gmm.covariances_, allow_pickle=False)
+    import json
+    import gmm as gm
+
+    arrays = {'weights': gmm.weights_,
+              'means': gmm.means_,
+              'covariances': gmm.covariances_,
+              'precisions_cholesky': gmm.precisions_cholesky_,
+              'log_det': gm.log_det_cholesky(gmm.precisions_cholesky_, gmm.covariance_type,
+                                             gmm.means_.shape[1])}
+    arrays = {name: np.ascontiguousarray(a, dtype='<f8') for name, a in arrays.items()}
+
+    # header
+    meta = {'converged': bool(getattr(gmm, 'converged_', True)),
+            'n_iter': int(getattr(gmm, 'n_iter_', 0)),
+            'lower_bound': float(getattr(gmm, 'lower_bound_', np.nan))}
+    if pca is not None:
+        meta.update(gm.pca_signature(pca))
+    if metadata is not None:
+        meta.update(json_metadata(metadata))
+    header = {'version': GMM_FILE_VERSION,
+              'covariance_type': gmm.covariance_type,
+              'n_components': int(gmm.means_.shape[0]),
+              'n_features': int(gmm.means_.shape[1]),
+              'dtype': '<f8',
+              'arrays': {},
+              'metadata': meta}
+
+    # offsets: the header is written with fixed-width offsets, so its length
+    # does not depend on them
+    def header_bytes(header):
+        return json.dumps(header, sort_keys=True).encode()
+    for name in GMM_ARRAYS:
+        header['arrays'][name] = {'offset': 0, 'shape': list(arrays[name].shape)}
+    start = len(GMM_FILE_MAGIC) + 4 + len(header_bytes(header)) + 20*len(GMM_ARRAYS)
+    offset = int(np.ceil(start/64)*64)
+    for name in GMM_ARRAYS:
+        header['arrays'][name]['offset'] = offset
+        offset = int(np.ceil((offset + arrays[name].nbytes)/64)*64)
+    data = header_bytes(header)
+
+    with open(file_name + '.gmm', 'wb') as f:
+        f.write(GMM_FILE_MAGIC)
+        f.write(np.uint32(len(data)).astype('<u4').tobytes())
+        f.write(data)
+        for name in GMM_ARRAYS:
+            f.write(b'\x00'*(header['arrays'][name]['offset'] - f.tell()))
+            f.write(arrays[name].tobytes())
+
+#####################################################################
+# Metadata that can be written to a JSON header
+#####################################################################
+def json_metadata(metadata):
+# numpy scalars and arrays become Python numbers and lists; anything
+# else that JSON cannot store is a ValueError
+
+    import json
+
+    def convert(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        raise TypeError(type(value).__name__)
+
+    try:
+        return json.loads(json.dumps(metadata, default=convert))
+    except (TypeError, ValueError) as error:
+        raise ValueError('GMM metadata must be JSON-serializable (' + str(error) + ')')
 
 #####################################################################
 # Load an existing GMM
 #####################################################################
-def load_gmm(file_name):
+def load_gmm(file_name, pca=None, n_features=None):
+# load_gmm(file_name, pca=None, n_features=None)
+#   pca, n_features : if given, the GMM must match the PCA (output width,
+#         and the fingerprint stored by save_gmm) or the number of features
+# returns gmm (arrays memory-mapped, read-only)
+#
+# - GMMs saved as separate .npy files (before the single-file format) are
+#   still loaded
 
     print('file_io.load_gmm')
 
+    import os
+    import json
+    import gmm as gm
+
+    if not os.path.isfile(file_name + '.gmm'):
+        loaded_gmm = load_gmm_npy(file_name)
+        gm.check_compatibility(loaded_gmm, pca=pca, n_features=n_features)
+        return loaded_gmm
+
+    # header
+    with open(file_name + '.gmm', 'rb') as f:
+        if f.read(len(GMM_FILE_MAGIC))!=GMM_FILE_MAGIC:
+            raise ValueError(file_name + '.gmm is not a GMM file')
+        length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(length))
+    if header.get('version')!=GMM_FILE_VERSION:
+        raise ValueError('GMM file version ' + str(header.get('version')) +
+                         ' does not match ' + str(GMM_FILE_VERSION))
+
+    # arrays, memory-mapped
+    arrays = {name: np.memmap(file_name + '.gmm', dtype=header['dtype'], mode='r',
+                              offset=a['offset'], shape=tuple(a['shape']))
+              for name, a in header['arrays'].items()}
+
+    # GaussianMixture, ready for inference
+    meta = header['metadata']
+    loaded_gmm = mixture.GaussianMixture(n_components=header['n_components'],
+                                         covariance_type=header['covariance_type'])
+    loaded_gmm.weights_ = arrays['weights']
+    loaded_gmm.means_ = arrays['means']
+    loaded_gmm.covariances_ = arrays['covariances']
+    loaded_gmm.precisions_cholesky_ = arrays['precisions_cholesky']
+    loaded_gmm.precisions_ = gm.precisions_from_cholesky(arrays['precisions_cholesky'],
+                                                         header['covariance_type'])
+    loaded_gmm.log_det_cholesky_ = arrays['log_det']
+    loaded_gmm.n_features_in_ = header['n_features']
+    loaded_gmm.converged_ = meta.get('converged', True)
+    loaded_gmm.n_iter_ = meta.get('n_iter', 0)
+    loaded_gmm.lower_bound_ = meta.get('lower_bound', np.nan)
+    loaded_gmm.metadata_ = meta
+
+    gm.check_compatibility(loaded_gmm, pca=pca, n_features=n_features)
+
+    return loaded_gmm
+
+#####################################################################
+# Load a GMM saved as separate numpy files (older format)
+#####################################################################
+def load_gmm_npy(file_name):
+
+    import os
+    import gmm as gm
+
     # load means and covariances
     means = np.load(file_name + '_means.npy')
     covar = np.load(file_name + '_covariances.npy')
 
+    # covariance type (GMMs saved before it was stored are 'full')
+    covariance_type = 'full'
+    if os.path.isfile(file_name + '_covariance_type.npy'):
+        covariance_type = str(np.load(file_name + '_covariance_type.npy'))
+
     # reconstruct GMM using means and covariances
-    loaded_gmm = mixture.GaussianMixture(n_components = len(means), covariance_type='full')
-    loaded_gmm.precisions_cholesky_ = np.linalg.cholesky(np.linalg.inv(covar))
-    loaded_gmm.weights_ = np.load(file_name + '_weights.npy')
-    loaded_gmm.means_ = means
-    loaded_gmm.covariances_ = covar
+    loaded_gmm = gm.gmm_from_parameters(np.load(file_name + '_weights.npy'), means, covar,
+                                        covariance_type=covariance_type)
 
     return loaded_gmm
+
+#####################################################################
+# Does a saved GMM exist (either format)?
+#####################################################################
+def gmm_exists(file_name):
+
+    import os
+
+    return (os.path.isfile(file_name + '.gmm') or
+            os.path.isfile(file_name + '_means.npy'))
@@ -4,72 +4,862 @@
 
 #import numpy as np
 from sklearn import mixture
+from scipy import linalg
+from scipy.special import logsumexp
 import numpy as np
 import xarray as xr
+import sampling
+import feature_store as fs
+import class_stats as cs
 
 #####################################################################
 # Train GMM
 #####################################################################
-def train_gmm(Xtrain, n_components_selected, random_state=42):
-# train_gmm(Xtrain, n_components_selected, random_state=42)
-# returns gmm
+def train_gmm(Xtrain, n_components_selected, random_state=42, mode='batch',
+              batch_size=100000, max_iter=None, tol=1e-3, init_size=100000,
+              compare_to_batch=False, n_init=1,
+              init_methods=('kmeans', 'kmeans++', 'random'), warm_start=None,
+              n_jobs=-1, covariance_type='full', backend='gmm',
+              weight_concentration_prior=None, weight_threshold=0.01):
+# train_gmm(Xtrain, n_components_selected, random_state=42, mode='batch')
+#   Xtrain : features (array, memmap, dask array, or feature store name)
+#   mode : 'batch' (sklearn EM on all of Xtrain in memory) or
+#          'streaming' (same EM, with the sufficient statistics accumulated
+#          over chunks of batch_size rows, so Xtrain never has to be in
+#          memory; initialized from a GMM fitted to init_size rows)
+#   compare_to_batch : (streaming only) also run the batch EM from the same
+#          initialization and print the agreement
+#   n_init : (batch only) number of independent initializations, cycling
+#          through init_methods ('kmeans', 'kmeans++', 'random'), with
+#          seeds random_state, random_state+1, ...
+#   warm_start : (batch only) a fitted GMM (e.g. from file_io.load_gmm) used
+#          as one more start
+#   n_jobs : starts run concurrently in a process pool
+#   covariance_type : 'full', 'diag', 'tied', or 'spherical' (batch, single
+#          start only for anything but 'full')
+#   backend : 'gmm' (EM), or one of the cheaper alternatives for
+#          exploratory runs; all return a GaussianMixture, so labels,
+#          posteriors, saving, and loading work the same way:
+#          'kmeans'   : mini-batch k-means, turned into a spherical GMM
+#                       (soft assignments from the cluster variances)
+#          'bayesian' : variational Bayesian GMM with a Dirichlet process
+#                       prior; n_components_selected is the upper bound
+#                       and the number of classes is chosen by the fit,
+#                       through weight_concentration_prior (None = sklearn's
+#                       1/n_components; smaller values leave more components
+#                       empty) and weight_threshold (smallest weight kept)
+#   max_iter : None = 100 (EM, k-means), or 1000 ('bayesian'; with fewer
+#          iterations the fit usually stops before the unused components
+#          are emptied, and keeps all of them)
+# returns gmm (the start with the highest log-likelihood; the summary of
+# all starts is in gmm.starts_)
 
     print('gmm.train_gmm')
 
-    # establish gmm
-    gmm = mixture.GaussianMixture(n_components=n_components_selected,
-                                  covariance_type='full',
+    # the variational fit needs many more iterations to empty the unused
+    # components
+    if max_iter is None:
+        max_iter = 1000 if backend=='bayesian' else 100
+
+    # cheaper backends
+    if backend=='kmeans':
+        return train_kmeans_gmm(Xtrain, n_components_selected, random_state=random_state,
+                                batch_size=batch_size, max_iter=max_iter)
+    elif backend=='bayesian':
+        return train_bayesian_gmm(Xtrain, n_components_selected,
+                                  random_state=random_state, max_iter=max_iter, tol=tol,
+                                  covariance_type=covariance_type,
+                                  weight_concentration_prior=weight_concentration_prior,
+                                  weight_threshold=weight_threshold)
+    elif backend!='gmm':
+        raise ValueError('backend must be gmm, kmeans, or bayesian')
+
+    if covariance_type!='full' and (mode!='batch' or n_init > 1 or warm_start is not None):
+        raise ValueError('only full covariances are available with streaming, '
+                         'n_init, or warm_start')
+
+    if mode=='streaming':
+        if n_init > 1 or warm_start is not None:
+            raise ValueError('n_init and warm_start are only available in batch mode')
+        return train_gmm_streaming(Xtrain, n_components_selected,
+                                   random_state=random_state,
+                                   batch_size=batch_size, max_iter=max_iter,
+                                   tol=tol, init_size=init_size,
+                                   compare_to_batch=compare_to_batch)
+    elif mode!='batch':
+        raise ValueError('mode must be batch or streaming')
+
+    X = feature_array(Xtrain)
+
+    # a single start: the original behaviour
+    if n_init==1 and warm_start is None and init_methods[0]=='kmeans':
+
+        # establish gmm
+        gmm = mixture.GaussianMixture(n_components=n_components_selected,
+                                      covariance_type=covariance_type,
+                                      random_state=random_state,
+                                      max_iter=max_iter, tol=tol)
+
+        # fit this GMM using the training data in PC space
+        gmm.fit(X)
+
+        # return the gmm object, which has now been trained
+        return gmm
+
+    return train_gmm_multistart(X, n_components_selected, random_state=random_state,
+                                max_iter=max_iter, tol=tol, n_init=n_init,
+                                init_methods=init_methods, warm_start=warm_start,
+                                n_jobs=n_jobs)
+
+#####################################################################
+# Multi-start training (independent starts in a process pool)
+#####################################################################
+def train_gmm_multistart(X, n_components_selected, random_state=42, max_iter=100,
+                         tol=1e-3, n_init=4, init_methods=('kmeans', 'kmeans++', 'random'),
+                         warm_start=None, n_jobs=-1):
+# returns the gmm with the highest mean log-likelihood on X
+
+    print('gmm.train_gmm_multistart')
+
+    import joblib
+
+    # check the warm start before starting the workers
+    if warm_start is not None:
+        check_warm_start(warm_start, n_components_selected)
+
+    # list of starts: (method, seed)
+    starts = [(init_methods[i % len(init_methods)], random_state + i)
+              for i in range(n_init)]
+    if warm_start is not None:
+        starts.append(('warm', random_state))
+
+    # fit all starts concurrently (large arrays are memory-mapped to the
+    # workers by joblib)
+    results = joblib.Parallel(n_jobs=n_jobs, backend='loky')(
+        joblib.delayed(fit_start)(X, n_components_selected, method, seed,
+                                  max_iter=max_iter, tol=tol, warm_start=warm_start)
+        for method, seed in starts)
+
+    # report
+    for i, (gmm, info) in enumerate(results):
+        print('gmm.train_gmm_multistart: start ' + str(i) + ' (' + info['method'] +
+              ', seed ' + str(info['seed']) + '): ' +
+              ('converged' if info['converged'] else 'did not converge') +
+              ' in ' + str(info['n_iter']) + ' iterations, log-likelihood ' +
+              "%.5f" % info['log_likelihood'] + ', ' + "%.1f" % info['time'] + ' s')
+
+    # keep the best
+    ibest = int(np.argmax([info['log_likelihood'] for gmm, info in results]))
+    best = results[ibest][0]
+    best.starts_ = [info for gmm, info in results]
+    best.best_start_ = ibest
+    print('gmm.train_gmm_multistart: best start = ' + str(ibest))
+
+    return best
+
+#####################################################################
+# Fit one start (run in a worker process)
+#####################################################################
+def fit_start(X, n_components_selected, method, seed, max_iter=100, tol=1e-3,
+              warm_start=None):
+# method : 'kmeans' (sklearn default), 'random', 'kmeans++' (k-means++
+#          seeding, one hard assignment), or 'warm' (from warm_start)
+# returns gmm, info (method, seed, converged, n_iter, log_likelihood, time)
+
+    import time
+
+    t0 = time.perf_counter()
+    X = np.asarray(X)
+
+    if method=='warm':
+        check_warm_start(warm_start, n_components_selected)
+
+    if method in ('kmeans', 'random'):
+        gmm = mixture.GaussianMixture(n_components=n_components_selected,
+                                      covariance_type='full', init_params=method,
+                                      max_iter=max_iter, tol=tol, random_state=seed)
+    elif method in ('kmeans++', 'warm'):
+        if method=='kmeans++':
+            weights, means, precisions = kmeans_plusplus_parameters(X, n_components_selected,
+                                                                    random_state=seed)
+        else:
+            weights, means, precisions = warm_start.weights_, warm_start.means_, \
+                                         np.linalg.inv(warm_start.covariances_)
+        gmm = mixture.GaussianMixture(n_components=n_components_selected,
+                                      covariance_type='full', weights_init=weights,
+                                      means_init=means, precisions_init=precisions,
+                                      max_iter=max_iter, tol=tol, random_state=seed)
+    else:
+        raise ValueError('method must be kmeans, kmeans++, random, or warm')
+
+    gmm.fit(X)
+    info = {'method': method, 'seed': seed, 'converged': bool(gmm.converged_),
+            'n_iter': int(gmm.n_iter_), 'log_likelihood': float(gmm.score(X)),
+            'time': time.perf_counter() - t0}
+
+    return gmm, info
+
+#####################################################################
+# Check that a GMM can be used as a warm start
+#####################################################################
+def check_warm_start(warm_start, n_components_selected):
+# raises ValueError unless warm_start is a GMM with full covariances and
+# n_components_selected components
+
+    covariance_type = getattr(warm_start, 'covariance_type', None)
+    if covariance_type!='full':
+        raise ValueError('warm_start must have full covariances, not ' +
+                         str(covariance_type))
+    n_components = np.shape(warm_start.means_)[0]
+    if n_components!=n_components_selected:
+        raise ValueError('warm_start has ' + str(n_components) + ' components, ' +
+                         'expected ' + str(n_components_selected))
+
+#####################################################################
+# Initial parameters from k-means++ seeds (one hard assignment)
+#####################################################################
+def kmeans_plusplus_parameters(X, n_components_selected, random_state=42,
+                               reg_covar=1e-6):
+
+    from sklearn.cluster import kmeans_plusplus
+
+    centres, indices = kmeans_plusplus(X, n_components_selected, random_state=random_state)
+
+    # assign each sample to its nearest seed
+    distances = (np.sum(X**2, axis=1)[:, None] - 2*X @ centres.T +
+                 np.sum(centres**2, axis=1)[None, :])
+    labels = np.argmin(distances, axis=1)
+
+    # weights, means, and precisions of the hard clusters
+    # (clusters with fewer than two members keep their seed and take the
+    # covariance of all samples)
+    d = X.shape[1]
+    counts = np.bincount(labels, minlength=n_components_selected)
+    means = centres.copy()
+    precisions = np.empty((n_components_selected, d, d))
+    for k in range(n_components_selected):
+        Xk = X[labels==k] if counts[k] >= 2 else X
+        if counts[k] >= 2:
+            means[k] = Xk.mean(axis=0)
+        covariance = np.cov(Xk, rowvar=False).reshape(d, d) + reg_covar*np.eye(d)
+        precisions[k] = np.linalg.inv(covariance)
+    weights = np.maximum(counts, 1)/np.sum(np.maximum(counts, 1))
+
+    return weights, means, precisions
+
+#####################################################################
+# Mini-batch k-means as a spherical GMM
+#####################################################################
+def train_kmeans_gmm(Xtrain, n_components_selected, random_state=42,
+                     batch_size=100000, max_iter=100, tol=1e-4):
+# - the centres are initialized with one pass of mini-batch k-means and
+#   refined with Lloyd iterations, accumulated over chunks of the features,
+#   until the centres move by less than tol (relative to the mean variance
+#   of the features, as in KMeans) or max_iter passes; the weights and the
+#   (spherical) variances of the clusters are then accumulated over chunks,
+#   so the posteriors are soft assignments
+# returns gmm (GaussianMixture, covariance_type='spherical')
+
+    print('gmm.train_kmeans_gmm')
+
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.metrics import pairwise_distances_argmin
+
+    X = feature_array(Xtrain)
+    n, d = X.shape
+
+    # initial centres (one pass of mini-batches), and the variance of the
+    # features for the tolerance
+    kmeans = MiniBatchKMeans(n_clusters=n_components_selected,
+                             batch_size=int(np.min((batch_size, n))),
+                             compute_labels=False, random_state=random_state)
+    total = np.zeros(d)
+    total_sq = np.zeros(d)
+    for Xchunk in feature_chunks(X, batch_size):
+        kmeans.partial_fit(Xchunk)
+        total += np.sum(Xchunk, axis=0)
+        total_sq += np.sum(Xchunk**2, axis=0)
+    centres = kmeans.cluster_centers_.copy()
+    tol_abs = tol*np.mean(total_sq/n - (total/n)**2)
+
+    # Lloyd iterations, one pass over the chunks each
+    for n_iter in range(1, max_iter + 1):
+        counts = np.zeros(n_components_selected)
+        sums = np.zeros((n_components_selected, d))
+        for Xchunk in feature_chunks(X, batch_size):
+            labels = pairwise_distances_argmin(Xchunk, centres)
+            counts += np.bincount(labels, minlength=n_components_selected)
+            for k in range(d):
+                sums[:, k] += np.bincount(labels, weights=Xchunk[:, k],
+                                          minlength=n_components_selected)
+        # (empty clusters keep their centre)
+        new_centres = np.where(counts[:, None] > 0,
+                               sums/np.maximum(counts, 1)[:, None], centres)
+        shift = np.sum((new_centres - centres)**2)
+        centres = new_centres
+        if shift <= tol_abs:
+            break
+
+    # sizes and mean squared distances of the clusters
+    counts = np.zeros(n_components_selected)
+    sum_sq = np.zeros(n_components_selected)
+    for Xchunk in feature_chunks(X, batch_size):
+        labels = pairwise_distances_argmin(Xchunk, centres)
+        counts += np.bincount(labels, minlength=n_components_selected)
+        sum_sq += np.bincount(labels, weights=np.sum((Xchunk - centres[labels])**2, axis=1),
+                              minlength=n_components_selected)
+    counts = np.maximum(counts, 1)
+    variances = sum_sq/(counts*d) + 1e-6
+
+    gmm = gmm_from_parameters(counts/np.sum(counts), centres, variances,
+                              random_state=random_state, covariance_type='spherical')
+    gmm.converged_ = True
+    gmm.n_iter_ = n_iter
+
+    return gmm
+
+#####################################################################
+# Variational Bayesian GMM (chooses the number of classes)
+#####################################################################
+def train_bayesian_gmm(Xtrain, max_components, random_state=42, max_iter=1000,
+                       tol=1e-3, covariance_type='full', weight_concentration_prior=None,
+                       weight_threshold=0.01):
+# - weight_concentration_prior : concentration of the Dirichlet process
+#   (None = 1/max_components); the smaller it is, the fewer components the
+#   fit uses
+# - components with a weight below weight_threshold are dropped (keeping
+#   at least two) and the rest are returned as a GaussianMixture
+#   (renormalized weights); the variational weights are kept in
+#   gmm.bayesian_weights_
+# returns gmm
+
+    print('gmm.train_bayesian_gmm')
+
+    X = np.asarray(feature_array(Xtrain))
+    bgmm = mixture.BayesianGaussianMixture(n_components=max_components,
+                                           covariance_type=covariance_type,
+                                           weight_concentration_prior_type='dirichlet_process',
+                                           weight_concentration_prior=weight_concentration_prior,
+                                           max_iter=max_iter, tol=tol,
+                                           random_state=random_state)
+    bgmm.fit(X)
+
+    # keep the components that are used (at least the two heaviest, so that
+    # there is a runner-up class for the i-metric)
+    keep = np.flatnonzero(bgmm.weights_ >= weight_threshold)
+    if keep.size < 2:
+        if max_components < 2:
+            raise ValueError('train_bayesian_gmm needs at least two components')
+        keep = np.sort(np.argsort(bgmm.weights_)[-2:])
+    covariances = bgmm.covariances_ if covariance_type=='tied' else bgmm.covariances_[keep]
+    weights = bgmm.weights_[keep]
+    gmm = gmm_from_parameters(weights/np.sum(weights), bgmm.means_[keep], covariances,
+                              random_state=random_state, covariance_type=covariance_type)
+    gmm.converged_ = bgmm.converged_
+    gmm.n_iter_ = bgmm.n_iter_
+    gmm.bayesian_weights_ = bgmm.weights_
+    dropped = np.setdiff1d(np.arange(max_components), keep)
+    print('gmm.train_bayesian_gmm: ' + str(keep.size) + ' classes (of at most ' +
+          str(max_components) + ')')
+    print('gmm.train_bayesian_gmm: kept weights ' + str(np.round(bgmm.weights_[keep], 4)) +
+          ', dropped weights ' + str(np.round(bgmm.weights_[dropped], 4)))
+    if not bgmm.converged_:
+        print('gmm.train_bayesian_gmm: did not converge in ' + str(max_iter) + ' iterations')
+
+    return gmm
+
+#####################################################################
+# Sweep over the number of components (optionally warm-started from the last)
+#####################################################################
+def sweep_gmm(X, n_components_range, random_state=42, max_iter=100, tol=1e-3,
+              warm_start=False, split_by='variance'):
+# sweep_gmm(X, n_components_range, random_state=42, warm_start=False,
+#           split_by='variance')
+#   n_components_range : consecutive numbers of components, e.g. range(2, max_N)
+#   warm_start : initialize the K+1 model from the K model, by splitting one
+#                component (False = every K from scratch). This skips the
+#                k-means initialization of each fit, but EM usually needs
+#                more iterations from a split; on synthetic blobs (20000 to
+#                50000 samples, 4 to 20 clusters) the sweep took 10-20% less
+#                wall time, and the fits reached a similar log-likelihood,
+#                sometimes higher and sometimes lower than from scratch.
+#                Check on the features with
+#                bic_and_aic.calc_bic_and_aic(..., compare_to_cold=True)
+#   split_by : component to split: 'variance' (largest weight times total
+#              variance) or 'deficit' (see component_deficit)
+# returns gmms (one per K, with the mean log-likelihood on X in
+# log_likelihood_), info (one dictionary per K: n_components, n_iter,
+# converged, time, start ('warm' or 'cold'))
+
+    import time
+
+    X = np.asarray(X)
+    gmms = []
+    info = []
+    for n_components in n_components_range:
+        t0 = time.perf_counter()
+
+        # warm start from the K-1 model, or from scratch
+        if warm_start==True and len(gmms) > 0 and gmms[-1].n_components==n_components - 1:
+            weights, means, precisions = split_component(gmms[-1], X, split_by=split_by)
+            gmm = mixture.GaussianMixture(n_components=n_components,
+                                          covariance_type='full', weights_init=weights,
+                                          means_init=means, precisions_init=precisions,
+                                          max_iter=max_iter, tol=tol,
+                                          random_state=random_state)
+            gmm.start_ = 'warm'
+        else:
+            gmm = mixture.GaussianMixture(n_components=n_components,
+                                          covariance_type='full', max_iter=max_iter,
+                                          tol=tol, random_state=random_state)
+            gmm.start_ = 'cold'
+        gmm.fit(X)
+        gmm.log_likelihood_ = gmm.score(X)
+
+        gmms.append(gmm)
+        info.append({'n_components': n_components, 'n_iter': int(gmm.n_iter_),
+                     'converged': bool(gmm.converged_), 'start': gmm.start_,
+                     'time': time.perf_counter() - t0})
+
+    return gmms, info
+
+#####################################################################
+# Split one component (initial parameters for one more component)
+#####################################################################
+def split_component(gmm, X=None, split_by='variance'):
+# - the selected component is cut in two halves across its leading
+#   eigenvector (variance lam), each with half its weight: the children
+#   are centred on the means of the two halves of a Gaussian,
+#   +/- sqrt(2/pi)*sqrt(lam) along that direction, and their variance
+#   along it shrinks to that of a half Gaussian, (1 - 2/pi)*lam, so that
+#   the pair still has the mean and covariance of the parent
+# returns weights, means, precisions (n_components + 1)
+
+    # largest weighted total variance, or largest deficit
+    if split_by=='variance':
+        k = int(np.argmax(gmm.weights_*np.trace(gmm.covariances_, axis1=1, axis2=2)))
+    elif split_by=='deficit':
+        k = int(np.argmax(component_deficit(gmm, X)))
+    else:
+        raise ValueError('split_by must be variance or deficit')
+
+    # leading eigenvector of the selected component
+    eigenvalues, eigenvectors = np.linalg.eigh(gmm.covariances_[k])
+    lam = eigenvalues[-1]
+    v = eigenvectors[:, -1]
+    offset = np.sqrt(2/np.pi)*np.sqrt(lam)*v
+    child_cov = gmm.covariances_[k] - (2/np.pi)*lam*np.outer(v, v)
+
+    weights = np.concatenate((gmm.weights_, [0.5*gmm.weights_[k]]))
+    weights[k] = 0.5*gmm.weights_[k]
+    means = np.concatenate((gmm.means_, [gmm.means_[k] + offset]))
+    means[k] = gmm.means_[k] - offset
+    covariances = np.concatenate((gmm.covariances_, [child_cov]))
+    covariances[k] = child_cov
+
+    return weights, means, np.linalg.inv(covariances)
+
+#####################################################################
+# Deficit of each component (how badly one Gaussian fits its samples)
+#####################################################################
+def component_deficit(gmm, X):
+# deficit of component k = Nk * |E_k[m^4] - d*(d+2)|
+#   m : Mahalanobis distance of a sample from component k
+#   E_k : responsibility-weighted mean over the samples, Nk : their total
+#   d*(d+2) : value of E[m^4] for Gaussian data (Mardia's kurtosis)
+# - large for big components whose samples are not Gaussian, e.g. two
+#   clusters covered by one component (the mean log-likelihood of a
+#   fitted Gaussian does not show this, as it only depends on the
+#   first two moments)
+
+    X = np.asarray(X, dtype=np.float64)
+    d = X.shape[1]
+    log_resp, log_likelihood = estimate_log_resp(X, gmm.weights_, gmm.means_,
+                                                 gmm.precisions_cholesky_)
+    resp = np.exp(log_resp)
+
+    deficit = np.empty(gmm.n_components)
+    for k in range(gmm.n_components):
+        y = (X - gmm.means_[k]) @ gmm.precisions_cholesky_[k]
+        m2 = np.sum(y**2, axis=1)
+        Nk = np.sum(resp[:, k]) + 1e-12
+        deficit[k] = Nk*np.abs(np.sum(resp[:, k]*m2**2)/Nk - d*(d + 2))
+
+    return deficit
+
+#####################################################################
+# Features as an array (open feature stores, memory-mapped)
+#####################################################################
+def feature_array(X):
+
+    if isinstance(X, str):
+        X, profile_ids, metadata = fs.open_features(X)
+
+    return X
+
+#####################################################################
+# Iterate over chunks of rows (numpy, memmap, or dask arrays)
+#####################################################################
+def feature_chunks(X, batch_size=100000):
+
+    for start in range(0, X.shape[0], batch_size):
+        Xchunk = X[start:start + batch_size]
+        if hasattr(Xchunk, 'compute'):
+            Xchunk = Xchunk.compute()
+        yield np.asarray(Xchunk, dtype=np.float64)
+
+#####################################################################
+# Log responsibilities
+#####################################################################
+def estimate_log_resp(X, weights, means, precisions_cholesky, covariance_type='full',
+                      log_det=None):
+# precisions_cholesky : as in GaussianMixture.precisions_cholesky_, shape
+#   (components, d, d) full, (d, d) tied, (components, d) diag, or
+#   (components,) spherical
+# log_det : log-determinants of the Cholesky factors (see log_det_cholesky),
+#   if already known (e.g. stored with the GMM)
+# returns log_resp, shape (samples, components), and the log-likelihood
+# of each sample
+
+    n, d = X.shape
+    ncomp = means.shape[0]
+    if log_det is None:
+        log_det = log_det_cholesky(precisions_cholesky, covariance_type, d)
+    # (one value for all components if tied)
+    log_det = np.broadcast_to(log_det, (ncomp,))
+
+    # log N(x | mean_k, cov_k) using the Cholesky factors of the precisions
+    log_prob = np.empty((n, ncomp))
+    for k in range(ncomp):
+        if covariance_type=='full':
+            y = (X - means[k]) @ precisions_cholesky[k]
+        elif covariance_type=='tied':
+            y = (X - means[k]) @ precisions_cholesky
+        elif covariance_type in ('diag', 'spherical'):
+            y = (X - means[k])*precisions_cholesky[k]
+        log_prob[:, k] = -0.5*(d*np.log(2*np.pi) + np.sum(y**2, axis=1)) + log_det[k]
+
+    # weighted, normalized
+    weighted = log_prob + np.log(weights)
+    log_likelihood = logsumexp(weighted, axis=1)
+    log_resp = weighted - log_likelihood[:, None]
+
+    return log_resp, log_likelihood
+
+#####################################################################
+# Log-determinant of the Cholesky factor of each precision matrix
+#####################################################################
+def log_det_cholesky(precisions_cholesky, covariance_type, n_features):
+# returns array, shape (components,)
+
+    if covariance_type=='full':
+        return np.sum(np.log(np.diagonal(precisions_cholesky, axis1=1, axis2=2)), axis=1)
+    elif covariance_type=='tied':
+        return np.array([np.sum(np.log(np.diag(precisions_cholesky)))])
+    elif covariance_type=='diag':
+        return np.sum(np.log(precisions_cholesky), axis=1)
+    elif covariance_type=='spherical':
+        return n_features*np.log(precisions_cholesky)
+    else:
+        raise ValueError('covariance_type must be full, tied, diag, or spherical')
+
+#####################################################################
+# Cholesky factors of the precision matrices
+#####################################################################
+def precisions_cholesky_from_covariances(covariances, covariance_type='full'):
+
+    if covariance_type=='tied':
+        return precisions_cholesky_from_covariances(covariances[None, :, :])[0]
+    elif covariance_type in ('diag', 'spherical'):
+        return 1.0/np.sqrt(covariances)
+
+    d = covariances.shape[1]
+    precisions_cholesky = np.empty(covariances.shape)
+    for k in range(covariances.shape[0]):
+        cov_chol = linalg.cholesky(covariances[k], lower=True)
+        precisions_cholesky[k] = linalg.solve_triangular(cov_chol, np.eye(d), lower=True).T
+
+    return precisions_cholesky
+
+#####################################################################
+# GaussianMixture object from its parameters
+#####################################################################
+def gmm_from_parameters(weights, means, covariances, random_state=42,
+                        covariance_type='full'):
+
+    ncomp = means.shape[0]
+    gmm = mixture.GaussianMixture(n_components=ncomp, covariance_type=covariance_type,
                                   random_state=random_state)
+    gmm.weights_ = weights
+    gmm.means_ = means
+    gmm.covariances_ = covariances
+    gmm.precisions_cholesky_ = precisions_cholesky_from_covariances(covariances,
+                                                                    covariance_type)
+    gmm.precisions_ = precisions_from_cholesky(gmm.precisions_cholesky_, covariance_type)
+
+    return gmm
+
+#####################################################################
+# Precisions from their Cholesky factors
+#####################################################################
+def precisions_from_cholesky(precisions_cholesky, covariance_type):
+
+    if covariance_type=='full':
+        return np.einsum('kij,klj->kil', precisions_cholesky, precisions_cholesky)
+    elif covariance_type=='tied':
+        return precisions_cholesky @ precisions_cholesky.T
+    else:
+        return precisions_cholesky**2
+
+#####################################################################
+# Output width and fingerprint of the PCA a GMM is applied to
+#####################################################################
+def pca_signature(pca):
+# pca : PCA (or KernelPCA, or an sklearn Pipeline ending in one)
+# returns dictionary: pca_class, pca_n_components, pca_fingerprint (sha1
+#   of the components, or None if the transform has none)
+
+    import hashlib
+
+    if hasattr(pca, 'steps'):
+        pca = pca.steps[-1][1]
+    if hasattr(pca, 'components_'):
+        components = np.ascontiguousarray(pca.components_, dtype=np.float64)
+        n_components = components.shape[0]
+        fingerprint = hashlib.sha1(components.tobytes()).hexdigest()
+    else:
+        n_components = getattr(pca, 'n_components_', pca.n_components)
+        fingerprint = None
+
+    return {'pca_class': type(pca).__name__,
+            'pca_n_components': int(n_components),
+            'pca_fingerprint': fingerprint}
+
+#####################################################################
+# Check that a GMM can be applied to a PCA (or number of features)
+#####################################################################
+def check_compatibility(gmm, pca=None, n_features=None):
+# raises ValueError if the GMM was trained on a different number of
+# features, or (when save_gmm stored one) a different PCA
+
+    n_gmm = gmm.means_.shape[1]
+    if n_features is not None and n_features!=n_gmm:
+        raise ValueError('GMM has ' + str(n_gmm) + ' features, data has ' +
+                         str(n_features))
+    if pca is None:
+        return
+
+    signature = pca_signature(pca)
+    if signature['pca_n_components']!=n_gmm:
+        raise ValueError('GMM has ' + str(n_gmm) + ' features, PCA has ' +
+                         str(signature['pca_n_components']) + ' components')
+    stored = getattr(gmm, 'metadata_', {}).get('pca_fingerprint')
+    if (stored is not None and signature['pca_fingerprint'] is not None and
+        stored!=signature['pca_fingerprint']):
+        raise ValueError('GMM was trained on a different PCA')
 
-    # fit this GMM using the training data in PC space
-    gmm.fit(Xtrain)
+#####################################################################
+# Streaming EM (sufficient statistics accumulated chunk by chunk)
+#####################################################################
+def train_gmm_streaming(Xtrain, n_components_selected, random_state=42,
+                        batch_size=100000, max_iter=100, tol=1e-3,
+                        init_size=100000, reg_covar=1e-6, compare_to_batch=False):
+# - each iteration is one exact EM step over all rows: the E-step is done
+#   chunk by chunk, accumulating the weighted counts, sums, and scatter
+#   matrices (about the current means, for accuracy); the M-step uses
+#   the totals. This gives the same iterates as the batch EM.
+# - stops when the mean log-likelihood changes by less than tol
+# returns gmm (with converged_, n_iter_, and lower_bound_ set)
+
+    print('gmm.train_gmm_streaming')
+
+    X = feature_array(Xtrain)
+    n, d = X.shape
+
+    # initialize with a GMM fitted to a random subset
+    rows_id = sampling.random_rows(n, init_size, random_state=random_state, sort=True)
+    init = mixture.GaussianMixture(n_components=n_components_selected,
+                                   covariance_type='full',
+                                   random_state=random_state).fit(np.asarray(X[rows_id]))
+    weights, means, covariances = init.weights_, init.means_, init.covariances_
+    precisions_cholesky = init.precisions_cholesky_
+
+    # EM iterations
+    converged = False
+    lower_bound = -np.inf
+    for n_iter in range(1, max_iter + 1):
+
+        # E-step, accumulated over chunks
+        Nk = np.zeros(n_components_selected)
+        S1 = np.zeros((n_components_selected, d))
+        S2 = np.zeros((n_components_selected, d, d))
+        total_log_likelihood = 0.0
+        for Xchunk in feature_chunks(X, batch_size):
+            log_resp, log_likelihood = estimate_log_resp(Xchunk, weights, means,
+                                                         precisions_cholesky)
+            resp = np.exp(log_resp)
+            total_log_likelihood += np.sum(log_likelihood)
+            Nk += np.sum(resp, axis=0)
+            for k in range(n_components_selected):
+                Xc = Xchunk - means[k]
+                S1[k] += resp[:, k] @ Xc
+                S2[k] += (resp[:, k, None]*Xc).T @ Xc
+
+        # M-step
+        Nk = Nk + 10*np.finfo(Nk.dtype).eps
+        shift = S1/Nk[:, None]
+        means = means + shift
+        covariances = (S2/Nk[:, None, None] - np.einsum('ki,kj->kij', shift, shift)
+                       + reg_covar*np.eye(d)[None, :, :])
+        weights = Nk/n
+        precisions_cholesky = precisions_cholesky_from_covariances(covariances)
+
+        # convergence (log-likelihood of the parameters before this M-step)
+        previous = lower_bound
+        lower_bound = total_log_likelihood/n
+        if np.abs(lower_bound - previous) < tol:
+            converged = True
+            break
+
+    if not converged:
+        print('gmm.train_gmm_streaming: did not converge in ' + str(max_iter) + ' iterations')
+
+    gmm = gmm_from_parameters(weights, means, covariances, random_state=random_state)
+    gmm.converged_ = converged
+    gmm.n_iter_ = n_iter
+    gmm.lower_bound_ = lower_bound
+
+    # agreement with the batch EM from the same initialization
+    if compare_to_batch==True:
+        batch = mixture.GaussianMixture(n_components=n_components_selected,
+                                        covariance_type='full',
+                                        weights_init=init.weights_,
+                                        means_init=init.means_,
+                                        precisions_init=init.precisions_,
+                                        max_iter=max_iter, tol=tol,
+                                        random_state=random_state)
+        batch.fit(np.asarray(X))
+        ll_stream = mean_log_likelihood(gmm, X, batch_size)
+        ll_batch = mean_log_likelihood(batch, X, batch_size)
+        print('gmm.train_gmm_streaming: mean log-likelihood ' + str(ll_stream) +
+              ' (streaming), ' + str(ll_batch) + ' (batch)')
+        print('gmm.train_gmm_streaming: largest difference in the means = ' +
+              str(np.max(np.abs(np.sort(gmm.means_, axis=0) - np.sort(batch.means_, axis=0)))))
 
-    # return the gmm object, which has now been trained
     return gmm
 
+#####################################################################
+# Mean log-likelihood of the features (streamed over chunks)
+#####################################################################
+def mean_log_likelihood(gmm, X, batch_size=100000):
+
+    X = feature_array(X)
+    total = 0.0
+    for Xchunk in feature_chunks(X, batch_size):
+        log_resp, log_likelihood = estimate_log_resp(Xchunk, gmm.weights_, gmm.means_,
+                                                     gmm.precisions_cholesky_,
+                                                     gmm.covariance_type)
+        total += np.sum(log_likelihood)
+
+    return total/X.shape[0]
+
 #####################################################################
 # Apply GMM
 #####################################################################
-def apply_gmm(profiles, Xpca, gmm, n_components_selected, random_state=42):
-# train_gmm(profiles, Xpca, n_components_selected, random_state=42)
-# returns gmm
+def apply_gmm(profiles, Xpca, gmm, n_components_selected, random_state=42,
+              batch_size=100000, n_jobs=-1):
+# apply_gmm(profiles, Xpca, gmm, n_components_selected, random_state=42,
+#           batch_size=100000, n_jobs=-1)
+# returns profiles with label, posteriors, and i_metric added
 
     print('gmm.apply_gmm')
 
-    # assign class labels ("predict" the class using the selected GMM)
-    labels = gmm.predict(Xpca)
+    # labels, posterior probabilities, and i-metric from a single pass
+    labels, posterior_probs, i_metric = classify_features(gmm, Xpca,
+                                                          batch_size=batch_size,
+                                                          n_jobs=n_jobs)
+
+    # convert into xarray format, add to Dataset
+    # (the number of classes is that of the gmm, which may differ from
+    # n_components_selected for the Bayesian backend)
+    gmm_classes = [b for b in range(0,posterior_probs.shape[1],1)]
+    profiles = profiles.assign({'label': xr.DataArray(labels, coords=[profiles.profile],
+                                                      dims='profile'),
+                                'posteriors': xr.DataArray(posterior_probs,
+                                                           coords=[profiles.profile, gmm_classes],
+                                                           dims=['profile', 'CLASS']),
+                                'i_metric': xr.DataArray(i_metric, coords=[profiles.profile],
+                                                         dims='profile')})
 
-    # find posterior probabilities (the probabilities of belonging to each class)
-    posterior_probs = gmm.predict_proba(Xpca)
+    return profiles
 
-    # convert labels into xarray format
-    xlabels = xr.DataArray(labels, coords=[profiles.profile], dims='profile')
+#####################################################################
+# Classify one batch of features (a single E-step)
+#####################################################################
+def classify_batch(gmm, X):
+# returns labels, posteriors, i_metric for the rows of X
 
-    # convert posterior probabilities into xarray format
-    gmm_classes = [b for b in range(0,n_components_selected,1)]
-    xprobs = xr.DataArray(posterior_probs,
-                          coords=[profiles.profile, gmm_classes],
-                          dims=['profile', 'CLASS'])
+    log_resp, log_likelihood = estimate_log_resp(np.asarray(X, dtype=np.float64),
+                                                 gmm.weights_, gmm.means_,
+                                                 gmm.precisions_cholesky_,
+                                                 gmm.covariance_type,
+                                                 getattr(gmm, 'log_det_cholesky_', None))
+    posteriors = np.exp(log_resp)
+    i_metric, labels, runner_up_label = i_metric_from_posteriors(posteriors)
 
-    # add label DataArray to Dataset
-    profiles = profiles.assign({'label':xlabels})
-    profiles = profiles.assign({'posteriors':xprobs})
+    return labels, posteriors, i_metric
 
-    return profiles
+#####################################################################
+# Classify all features in parallel batches
+#####################################################################
+def classify_features(gmm, X, batch_size=100000, n_jobs=-1):
+# classify_features(gmm, X, batch_size=100000, n_jobs=-1)
+#   X : features (array, memmap, dask array, or feature store name)
+# returns labels, posteriors, i_metric
+#
+# - batches are spread over a thread pool (numpy releases the GIL in the
+#   heavy parts) and each one writes straight into the preallocated outputs
+
+    import joblib
+
+    X = feature_array(X)
+    n = X.shape[0]
+    ncomp = gmm.means_.shape[0]
+
+    # preallocate outputs
+    labels = np.empty(n, dtype=np.int64)
+    posteriors = np.empty((n, ncomp))
+    i_metric = np.empty(n)
+
+    def run_batch(start):
+        stop = np.min((start + batch_size, n))
+        Xbatch = X[start:stop]
+        if hasattr(Xbatch, 'compute'):
+            Xbatch = Xbatch.compute()
+        labels[start:stop], posteriors[start:stop], i_metric[start:stop] = \
+            classify_batch(gmm, Xbatch)
+
+    joblib.Parallel(n_jobs=n_jobs, backend='threading')(
+        joblib.delayed(run_batch)(start) for start in range(0, n, batch_size))
+
+    return labels, posteriors, i_metric
 
 #####################################################################
 # Get mean and standard deviation (class statistics)
 #####################################################################
-def calc_class_stats(profiles):
+def calc_class_stats(profiles, variables=None, summary=None):
+# calc_class_stats(profiles, variables=None, summary=None)
+#   variables : variables to summarise (default: class_stats.DEFAULT_VARIABLES)
+#   summary : class summary from class_stats.class_summary (computed if None)
+# returns class_means, class_stds (class x level, one variable per field)
 
     print('gmm.calc_class_stats')
 
-    # create grouped object using the labels
-    grouped = profiles.groupby("label")
+    # streaming class statistics of the selected variables only
+    if summary is None:
+        summary = cs.class_summary(profiles, variables=variables)
 
-    # class means and standard deviations
-    class_means = grouped.mean()
-    class_stds = grouped.std()
+    class_means, class_stds = cs.means_and_stds(summary, variables=variables)
 
     return class_means, class_stds
 
@@ -83,23 +873,53 @@ def calc_i_metric(profiles):
     # first, get 1D dataframe
     df1D = profiles.isel(depth=0)
 
-    # declare variables
-    i_metric = np.zeros(df1D.profile.size)
-    a_b = np.zeros((df1D.profile.size,2))
-
-    # loop through the profiles, calculate the i_metric for each one
-    for i in range(df1D.profile.size):
-          i_metric[i], a_b[i,:] = get_i_metric(df1D.posteriors[i, :].values.tolist())
+    # i-metric, most likely and runner-up class for all profiles at once
+    # (the posteriors can be numpy- or dask-backed)
+    posteriors = df1D.posteriors.transpose('profile', 'CLASS').data
+    i_metric, label, runner_up_label = i_metric_from_posteriors(posteriors)
 
-    # convert i_metric numpy array to xarray DataArray
+    # convert to xarray DataArrays
     i_metric = xr.DataArray(i_metric, coords=[profiles.profile], dims='profile')
+    runner_up_label = xr.DataArray(runner_up_label, coords=[profiles.profile], dims='profile')
 
     # add i_metric DataArray to Dataset
-    df1D = df1D.assign({'i_metric':i_metric})
+    df1D = df1D.assign({'i_metric':i_metric, 'runner_up_label':runner_up_label})
 
     # return 1D dataframe with i-i_metric
     return df1D
 
+#####################################################################
+# I-metric for an array of posterior probabilities
+#####################################################################
+def i_metric_from_posteriors(posteriors):
+# i_metric_from_posteriors(posteriors)
+#   posteriors : array, shape (profile, class); numpy or dask
+# returns i_metric, label, runner-up label (same definition as get_i_metric)
+
+    # dask: apply block by block along the profiles (one pass per block,
+    # the three outputs are stacked as columns)
+    if hasattr(posteriors, 'map_blocks'):
+        posteriors = posteriors.rechunk({1: -1})
+        stacked = posteriors.map_blocks(
+            lambda p: np.stack(i_metric_from_posteriors(p), axis=1).astype(np.float64),
+            chunks=(posteriors.chunks[0], (3,)), dtype=np.float64)
+        return stacked[:, 0], stacked[:, 1].astype(np.int64), stacked[:, 2].astype(np.int64)
+
+    posteriors = np.asarray(posteriors)
+
+    # the two largest probabilities (partial sort along the class axis)
+    p_top2 = np.partition(posteriors, -2, axis=1)[:, -2:]
+
+    # classes: the lowest index holding each value, as list.index in
+    # get_i_metric (so with a tie for the maximum the runner-up is the label)
+    label = np.argmax(posteriors, axis=1).astype(np.int64)
+    runner_up_label = np.argmax(posteriors==p_top2[:, :1], axis=1).astype(np.int64)
+
+    # I_metric = 1 - (max_probability - runner_up)
+    i_metric = 1 - (p_top2[:, 1] - p_top2[:, 0])
+
+    return i_metric, label, runner_up_label
+
 #####################################################################
 # Contains the definition of the i-metric
 #####################################################################
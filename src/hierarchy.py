@@ -0,0 +1,216 @@
+#####################################################################
+# Hierarchical classification (class tree with a shared feature cache)
+#####################################################################
+#
+# - The scaled features of all profiles are computed once, with the
+#   scaler of the top-level (parent) PCA, and kept in memory or in a
+#   feature store. Each node of the tree holds the rows (into the full
+#   set of profiles) of its profiles, its own scaler, PCA, and GMM, and
+#   the labels, posteriors, and i-metric of its classification.
+# - Sub-classifying a class is then an indexed slice of the cached
+#   features plus a child fit; no profiles are reloaded from NetCDF and
+#   no vertical fields are regridded or rescaled from scratch. Standard
+#   scaling is invariant under the parent scaling (a positive affine map
+#   of each feature), so the child scaler fitted to the cached features
+#   gives the same child features as scaling the raw fields.
+# - Any node can be turned into a pipeline for new profiles with
+#   pipeline.build_pipeline(profiles, node['pca'], node['gmm'], method).
+#
+
+# import packages
+import numpy as np
+import xarray as xr
+from sklearn import preprocessing
+from sklearn.decomposition import PCA
+import load_and_preprocess as lp
+import gmm as gm
+import sampling
+import feature_store as fs
+
+#####################################################################
+# Build the tree: cache the scaled features and classify the root
+#####################################################################
+def class_tree(profiles, pca, gmm, Xpca=None, method='onZ', xscaled_file=None,
+               batch_size=100000):
+# class_tree(profiles, pca, gmm, Xpca=None, method='onZ', xscaled_file=None)
+#   pca : fitted top-level PCA (from lp.fit_and_apply_pca, with pca.scaler_)
+#   gmm : fitted top-level GMM
+#   Xpca : top-level PCA features, if already computed (array or memmap)
+#   xscaled_file : if given, the scaled features are written to this
+#                  feature store (memory-mapped) instead of memory
+# returns tree (dictionary: profile IDs, method, cached features, root node)
+
+    print('hierarchy.class_tree')
+
+    if getattr(pca, 'scaler_', None) is None:
+        raise ValueError('pca has no scaler_; refit it with lp.fit_and_apply_pca')
+
+    levels = getattr(pca, 'vertical_levels_', None)
+    nprof = profiles.profile.size
+
+    # scaled features, batch by batch
+    Xscaled = None
+    compute_pca = Xpca is None
+    for start, stop, X in lp.feature_batches(profiles, method, levels, batch_size):
+        Xbatch = pca.scaler_.transform(X)
+        if Xscaled is None:
+            if xscaled_file is None:
+                Xscaled = np.empty((nprof, Xbatch.shape[1]), dtype=Xbatch.dtype)
+            else:
+                Xscaled = fs.create_features(xscaled_file, profiles.profile.values,
+                                             Xbatch.shape[1], dtype=Xbatch.dtype,
+                                             metadata={'content': 'Xscaled',
+                                                       'method': method})
+        Xscaled[start:stop, :] = Xbatch
+    if xscaled_file is not None:
+        Xscaled.flush()
+        Xscaled, profile_ids, metadata = fs.open_features(xscaled_file)
+
+    # root node (the top-level classification)
+    if compute_pca:
+        Xpca = lp.transform_in_batches(pca, Xscaled, batch_size=batch_size)
+    root = make_node(np.arange(nprof), None, pca.scaler_, pca, gmm, Xpca, batch_size)
+
+    tree = {'profile': profiles.profile.values,
+            'method': method,
+            'vertical_levels': levels,
+            'Xscaled': Xscaled,
+            'root': root}
+
+    return tree
+
+#####################################################################
+# Sub-classify one class of a node
+#####################################################################
+def subclassify(tree, path, n_components_selected, number_of_pca_components=6,
+                train_frac=0.99, random_state=42, batch_size=100000, **gmm_options):
+# subclassify(tree, path, n_components_selected, number_of_pca_components=6)
+#   path : classes from the root down to the class to sub-classify,
+#          e.g. (1,) for class 1 of the top level, (1, 2) for class 2 of
+#          that sub-classification
+#   train_frac : fraction of the class used to fit the child PCA
+#   gmm_options : passed on to gmm.train_gmm (e.g. n_init, backend)
+# returns the child node (also stored in the tree)
+
+    print('hierarchy.subclassify')
+
+    parent = get_node(tree, path[:-1])
+    k = path[-1]
+    rows = parent['rows'][parent['label']==k]
+    if rows.size==0:
+        raise ValueError('class ' + str(k) + ' of node ' + str(tuple(path[:-1])) +
+                         ' has no profiles')
+
+    # slice of the cached features, rescaled for this class
+    X = np.asarray(tree['Xscaled'][rows, :])
+    scaler = preprocessing.StandardScaler().fit(X)
+    X = scaler.transform(X)
+
+    # child PCA (fitted to a random sample of the class)
+    rows_id = sampling.random_rows(rows.size, int(train_frac*rows.size),
+                                   random_state=random_state, sort=True)
+    pca = PCA(number_of_pca_components).fit(X[rows_id, :])
+
+    # compose the scalings: the child PCA applies to the raw fields through
+    # the parent scaler followed by the child scaler, so the combined scaler
+    # can be stored with it (see pipeline.build_pipeline)
+    pca.scaler_ = compose_scalers(tree['root']['scaler'], scaler)
+    pca.vertical_levels_ = tree['vertical_levels']
+    print('hierarchy.subclassify: total variance explained = ' +
+          str(np.sum(pca.explained_variance_ratio_)))
+
+    # child GMM
+    Xpca = lp.transform_in_batches(pca, X, batch_size=batch_size)
+    gmm = gm.train_gmm(Xpca, n_components_selected, random_state=random_state,
+                       **gmm_options)
+
+    node = make_node(rows, tuple(path), pca.scaler_, pca, gmm, Xpca, batch_size)
+    parent['children'][k] = node
+
+    return node
+
+#####################################################################
+# Node of the tree
+#####################################################################
+def make_node(rows, path, scaler, pca, gmm, Xpca, batch_size=100000):
+
+    labels, posteriors, i_metric = gm.classify_features(gmm, Xpca, batch_size=batch_size)
+
+    node = {'path': () if path is None else path,
+            'rows': rows,
+            'scaler': scaler,
+            'pca': pca,
+            'gmm': gmm,
+            'Xpca': Xpca,
+            'label': labels,
+            'posteriors': posteriors,
+            'i_metric': i_metric,
+            'children': {}}
+
+    return node
+
+def get_node(tree, path):
+
+    node = tree['root']
+    for k in path:
+        if k not in node['children']:
+            raise ValueError('class ' + str(k) + ' of node ' + str(node['path']) +
+                             ' has not been sub-classified')
+        node = node['children'][k]
+
+    return node
+
+#####################################################################
+# One StandardScaler equivalent to two in a row
+#####################################################################
+def compose_scalers(first, second):
+
+    scaler = preprocessing.StandardScaler()
+    scaler.scale_ = first.scale_*second.scale_
+    scaler.mean_ = first.mean_ + first.scale_*second.mean_
+    scaler.var_ = scaler.scale_**2
+    scaler.n_features_in_ = first.n_features_in_
+    scaler.n_samples_seen_ = second.n_samples_seen_
+
+    return scaler
+
+#####################################################################
+# Profiles of a node, with its classification
+#####################################################################
+def node_profiles(tree, profiles, path):
+# returns the profiles of the node (a slice of the full profiles) with
+# label, posteriors, and i_metric from the node's classification, in the
+# same form as gmm.apply_gmm
+
+    node = get_node(tree, path)
+    subset = profiles.isel(profile=node['rows'])
+    subset = subset.drop_vars(['label', 'posteriors', 'i_metric', 'CLASS'],
+                              errors='ignore')
+    classes = np.arange(node['posteriors'].shape[1])
+    subset = subset.assign({'label': xr.DataArray(node['label'], dims='profile'),
+                            'posteriors': xr.DataArray(node['posteriors'],
+                                                       coords={'CLASS': classes},
+                                                       dims=['profile', 'CLASS']),
+                            'i_metric': xr.DataArray(node['i_metric'], dims='profile')})
+
+    return subset
+
+#####################################################################
+# Label of the deepest node of every profile (e.g. '1.2')
+#####################################################################
+def tree_labels(tree):
+
+    labels = np.full(tree['profile'].size, '', dtype=object)
+
+    def visit(node, prefix):
+        for k in np.unique(node['label']):
+            rows = node['rows'][node['label']==k]
+            name = prefix + str(k)
+            if k in node['children']:
+                visit(node['children'][k], name + '.')
+            else:
+                labels[rows] = name
+
+    visit(tree['root'], '')
+
+    return labels.astype(str)
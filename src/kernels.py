@@ -0,0 +1,296 @@
+#####################################################################
+# Per-profile numerical kernels (interpolation, MLD, extrema)
+#####################################################################
+#
+# - Each kernel works on 2D arrays of shape (profile, level) and has
+#   two implementations: a compiled, parallel (numba) version and a
+#   pure numpy version. The numba version is used if numba is
+#   installed; use set_backend('numpy') to force the numpy version.
+# - Kernels called from dask chunks (which already run in a thread pool)
+#   should use their serial numba version (parallel=False): nesting numba
+#   threads inside dask worker threads can hang the interpreter at exit
+#   with the tbb threading layer.
+#
+
+import numpy as np
+
+# numba is optional
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+# backend used by the kernels ('numba' or 'numpy')
+BACKEND = 'numba' if HAS_NUMBA else 'numpy'
+
+#####################################################################
+# Select backend
+#####################################################################
+def set_backend(backend):
+
+    global BACKEND
+
+    print('kernels.set_backend')
+
+    if backend=='numba' and not HAS_NUMBA:
+        print('kernels.set_backend: numba is not installed, using numpy')
+        backend = 'numpy'
+    elif backend not in ('numba', 'numpy'):
+        raise ValueError('backend must be numba or numpy')
+
+    BACKEND = backend
+
+#####################################################################
+# Linear interpolation onto target levels (one profile per row)
+#####################################################################
+def interp_linear(phi, theta, target, parallel=True):
+# interp_linear(phi, theta, target, parallel=True)
+#   phi : values to interpolate, shape (..., n) or (n,)
+#   theta : coordinate to interpolate along, shape (..., n) or (n,)
+#           (e.g. depth, or density for regridding onto density levels)
+#   target : target levels of theta, shape (m,)
+#   parallel : (numba) loop over the profiles in numba threads; use
+#           False when called from dask chunks
+# returns phi on the target levels, shape (..., m)
+#
+# - profiles with decreasing theta are flipped, targets outside the
+#   range of theta are set to NaN, and targets that fall next to a
+#   missing value of theta or phi are set to NaN (no filling of gaps)
+# - inversions (e.g. of density) are removed by replacing theta with its
+#   running maximum, so both backends give np.interp on the monotonic
+#   profile
+
+    # broadcast, flatten all but the last dimension
+    phi, theta = np.broadcast_arrays(np.asarray(phi, dtype=np.float64),
+                                     np.asarray(theta, dtype=np.float64))
+    target = np.asarray(target, dtype=np.float64)
+    shape = phi.shape[:-1] + (target.size,)
+    phi2d = np.ascontiguousarray(phi.reshape(-1, phi.shape[-1]))
+    theta2d = np.ascontiguousarray(theta.reshape(-1, theta.shape[-1]))
+
+    if BACKEND=='numba':
+        out = np.empty((phi2d.shape[0], target.size))
+        if parallel==True:
+            _interp_linear_numba(phi2d, theta2d, target, out)
+        else:
+            _interp_linear_numba_serial(phi2d, theta2d, target, out)
+    else:
+        out = _interp_linear_numpy(phi2d, theta2d, target)
+
+    return out.reshape(shape)
+
+def _interp_linear_numpy(phi, theta, target):
+
+    nprof, n = theta.shape
+    rows = np.arange(nprof)[:, None]
+    j = np.arange(n)[None, :]
+    missing = np.isnan(theta)
+    nvalid = np.sum(~missing, axis=1)
+
+    # first and last valid values; flip rows where theta is decreasing
+    first = np.argmax(~missing, axis=1)
+    last = n - 1 - np.argmax(np.flip(~missing, axis=1), axis=1)
+    decreasing = theta[rows[:, 0], last] < theta[rows[:, 0], first]
+    flip_idx = np.where(decreasing[:, None], n - 1 - j, j)
+    theta = np.take_along_axis(theta, flip_idx, axis=1)
+    phi = np.take_along_axis(phi, flip_idx, axis=1)
+    missing = np.take_along_axis(missing, flip_idx, axis=1)
+
+    # fill missing theta with the previous valid value (leading ones with the
+    # first valid value), and remove inversions, so that every row is sorted
+    fill_idx = np.maximum.accumulate(np.where(missing, 0, j), axis=1)
+    first = np.argmax(~missing, axis=1)[:, None]
+    fill_idx = np.where(j < first, first, fill_idx)
+    theta = np.maximum.accumulate(np.take_along_axis(theta, fill_idx, axis=1), axis=1)
+    theta_min = theta[:, :1]
+    theta_max = theta[:, -1:]
+
+    # row-wise searchsorted in a single call: shift each row into its own band
+    # (rows with no valid theta sit at the bottom of their band, and are
+    # masked below)
+    lo_val = np.nanmin((np.nanmin(theta), target.min()))
+    span = np.nanmax((np.nanmax(theta), target.max())) - lo_val + 1.0
+    offset = rows*span
+    flat = (np.where(np.isnan(theta), 0.0, theta - lo_val) + offset).ravel()
+    query = target[None, :] - lo_val + offset
+    pos = np.searchsorted(flat, query.ravel(), side='right').reshape(query.shape) - rows*n
+
+    # bracketing indices and weights
+    hi = np.clip(pos, 1, n - 1)
+    lo = hi - 1
+    theta0 = np.take_along_axis(theta, lo, axis=1)
+    theta1 = np.take_along_axis(theta, hi, axis=1)
+    phi0 = np.take_along_axis(phi, lo, axis=1)
+    phi1 = np.take_along_axis(phi, hi, axis=1)
+    # (a target on a flat step of theta, only possible at the top, takes phi1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(theta1==theta0, 1.0, (target[None, :] - theta0)/(theta1 - theta0))
+        out = np.where(w==0, phi0, np.where(w==1, phi1, phi0 + w*(phi1 - phi0)))
+
+    # mask targets outside the range of theta, next to missing theta,
+    # and in rows with fewer than two values
+    outside = (target[None, :] < theta_min) | (target[None, :] > theta_max)
+    gap = np.take_along_axis(missing, lo, axis=1) | np.take_along_axis(missing, hi, axis=1)
+    out[outside | gap | (nvalid[:, None] < 2)] = np.nan
+
+    return out
+
+def _interp_linear_rows(phi, theta, target, out):
+
+    nprof, n = theta.shape
+    m = target.size
+
+    for i in prange(nprof):
+
+        # first and last valid values
+        first = -1
+        last = -1
+        for jj in range(n):
+            if not np.isnan(theta[i, jj]):
+                if first < 0:
+                    first = jj
+                last = jj
+
+        # not enough values to interpolate
+        if first < 0 or first==last:
+            for jt in range(m):
+                out[i, jt] = np.nan
+            continue
+
+        # flip if decreasing
+        th = theta[i, :].copy()
+        ph = phi[i, :].copy()
+        if th[last] < th[first]:
+            th = th[::-1].copy()
+            ph = ph[::-1].copy()
+        missing = np.isnan(th)
+
+        # fill missing theta with the previous (or first) valid value,
+        # and remove inversions (running maximum)
+        prev = np.nan
+        for jj in range(n):
+            if not missing[jj]:
+                prev = th[jj]
+                break
+        for jj in range(n):
+            if not missing[jj] and th[jj] > prev:
+                prev = th[jj]
+            th[jj] = prev
+
+        # interpolate, masking targets outside the range or next to gaps
+        for jt in range(m):
+            t = target[jt]
+            if (t < th[0]) or (t > th[n-1]):
+                out[i, jt] = np.nan
+                continue
+            hi = min(max(np.searchsorted(th, t, side='right'), 1), n - 1)
+            lo = hi - 1
+            if missing[lo] or missing[hi]:
+                out[i, jt] = np.nan
+                continue
+            if th[hi]==th[lo]:
+                w = 1.0
+            else:
+                w = (t - th[lo])/(th[hi] - th[lo])
+            if w==0:
+                out[i, jt] = ph[lo]
+            elif w==1:
+                out[i, jt] = ph[hi]
+            else:
+                out[i, jt] = ph[lo] + w*(ph[hi] - ph[lo])
+
+# parallel (prange over profiles) and serial compiled versions
+if HAS_NUMBA:
+    _interp_linear_numba = njit(parallel=True)(_interp_linear_rows)
+    _interp_linear_numba_serial = njit(parallel=False)(_interp_linear_rows)
+
+#####################################################################
+# Integral depth scale for the mixed layer (Thomson and Fine, 2003)
+#####################################################################
+def mld_integral(N2, p):
+# mld_integral(N2, p)
+#   N2 : buoyancy frequency, shape (profile, level)
+#   p : pressure/depth of the N2 levels, shape (level,)
+# returns sum(p*N2)/sum(N2) for each profile (NaNs propagate; NaN where
+# sum(N2) is zero)
+
+    N2 = np.asarray(N2, dtype=np.float64)
+    p = np.asarray(p, dtype=np.float64)
+
+    if BACKEND=='numba':
+        out = np.empty(N2.shape[0])
+        _mld_integral_numba(N2, p, out)
+    else:
+        den = np.sum(N2, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(den==0, np.nan, np.sum(p[None, :]*N2, axis=1)/den)
+
+    return out
+
+if HAS_NUMBA:
+    @njit(parallel=True)
+    def _mld_integral_numba(N2, p, out):
+
+        for i in prange(N2.shape[0]):
+            num = 0.0
+            den = 0.0
+            for j in range(N2.shape[1]):
+                num += p[j]*N2[i, j]
+                den += N2[i, j]
+            if den==0:
+                out[i] = np.nan
+            else:
+                out[i] = num/den
+
+#####################################################################
+# Maximum and minimum of each profile (and where they are)
+#####################################################################
+def column_extrema(x, z):
+# column_extrema(x, z)
+#   x : values, shape (profile, level)
+#   z : vertical coordinate, shape (level,)
+# returns xmax, z_of_xmax, xmin, z_of_xmin (NaN for all-NaN profiles)
+
+    x = np.asarray(x, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+
+    if BACKEND=='numba':
+        xmax = np.empty(x.shape[0])
+        zmax = np.empty(x.shape[0])
+        xmin = np.empty(x.shape[0])
+        zmin = np.empty(x.shape[0])
+        _column_extrema_numba(x, z, xmax, zmax, xmin, zmin)
+    else:
+        # NaNs can never be selected as maximum or minimum
+        allnan = np.all(np.isnan(x), axis=1)
+        imax = np.argmax(np.where(np.isnan(x), -np.inf, x), axis=1)
+        imin = np.argmin(np.where(np.isnan(x), np.inf, x), axis=1)
+        rows = np.arange(x.shape[0])
+        xmax = np.where(allnan, np.nan, x[rows, imax])
+        zmax = np.where(allnan, np.nan, z[imax])
+        xmin = np.where(allnan, np.nan, x[rows, imin])
+        zmin = np.where(allnan, np.nan, z[imin])
+
+    return xmax, zmax, xmin, zmin
+
+if HAS_NUMBA:
+    @njit(parallel=True)
+    def _column_extrema_numba(x, z, xmax, zmax, xmin, zmin):
+
+        for i in prange(x.shape[0]):
+            xmax[i] = np.nan
+            zmax[i] = np.nan
+            xmin[i] = np.nan
+            zmin[i] = np.nan
+            for j in range(x.shape[1]):
+                v = x[i, j]
+                if np.isnan(v):
+                    continue
+                if np.isnan(xmax[i]) or v > xmax[i]:
+                    xmax[i] = v
+                    zmax[i] = z[j]
+                if np.isnan(xmin[i]) or v < xmin[i]:
+                    xmin[i] = v
+                    zmin[i] = z[j]
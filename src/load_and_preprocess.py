@@ -5,20 +5,42 @@
 # import pakcages
 import numpy as np
 import xarray as xr
+import dask
+import dask.array as dask_array
 from sklearn import preprocessing
 from sklearn.decomposition import PCA
-from sklearn.decomposition import KernelPCA
+from sklearn.decomposition import IncrementalPCA
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import make_pipeline
 from sklearn import manifold
-from xgcm import Grid
-import random
-#import umap
+import kernels
+import sampling
+import feature_store as fs
+import gmm as gm
+import neighbours
+import joblib
+
+# umap (umap-learn) is optional
+try:
+    import umap
+    HAS_UMAP = True
+except ImportError:
+    HAS_UMAP = False
+
+# openTSNE is optional (approximate neighbours, FFT gradients, multithreaded)
+try:
+    import openTSNE
+    HAS_OPENTSNE = True
+except ImportError:
+    HAS_OPENTSNE = False
 
 #####################################################################
 # Load the profile data (combined CTD, float, and seal data)
 #####################################################################
 def load_profile_data(data_location, lon_min, lon_max,
                       lat_min, lat_max, zmin, zmax, 
-                      data_in_one_file=True, is_data_already_organized = True, zscale=False):
+                      data_in_one_file=True, is_data_already_organized = True, zscale=False,
+                      max_gap=None):
 
     # start message
     print('load_and_preprocess.load_profile_data')
@@ -78,10 +100,15 @@ def load_profile_data(data_location, lon_min, lon_max,
         profiles = profiles.where(profiles.lon>=lon_min,drop=True)
         profiles = profiles.where(profiles.lat<=lat_max,drop=True)
         profiles = profiles.where(profiles.lat>=lat_min,drop=True)
+        # fill short interior gaps (up to max_gap metres) so that those
+        # profiles are not discarded below; filled values are flagged
+        if max_gap is not None:
+            profiles = fill_vertical_gaps(profiles, max_gap,
+                                          varnames=['prof_T','prof_S'],
+                                          dim='depth', flag_name='gap_filled')
         # drop any remaining profiles with NaN values
         # the profiles with NaN values don't have measurements in selected depth range
         profiles = profiles.dropna('profile')
-        # !!! This is where profiles with NaN are dropped -- if too many, maybe interpolate for NaN values
 
     # start message
     print('----> profiles loaded')
@@ -89,6 +116,79 @@ def load_profile_data(data_location, lon_min, lon_max,
     # return
     return profiles
 
+#####################################################################
+# Fill short interior gaps in profiles (vectorized over all profiles)
+#####################################################################
+def fill_vertical_gaps(profiles, max_gap, varnames=['prof_T','prof_S'],
+                       dim='depth', flag_name='gap_filled'):
+# fill_vertical_gaps(profiles, max_gap, varnames=['prof_T','prof_S'],
+#                    dim='depth', flag_name='gap_filled')
+#   max_gap : largest gap (in units of the vertical coordinate) that is
+#             filled, measured between the valid values on either side
+#   varnames : variables to fill (linear interpolation along dim)
+#   flag_name : name of the boolean flag marking filled values
+# returns profiles (gaps at the top and bottom of a profile are not filled)
+
+    print('load_and_preprocess.fill_vertical_gaps')
+
+    # vertical coordinate
+    z = profiles[dim].values
+
+    # fill each variable, keep track of where values have been filled
+    filled_flag = None
+    for varname in varnames:
+        filled, flag = xr.apply_ufunc(fill_gaps_along_last_axis,
+                                      profiles[varname],
+                                      input_core_dims=[[dim]],
+                                      output_core_dims=[[dim],[dim]],
+                                      kwargs=dict(z=z, max_gap=max_gap),
+                                      dask='parallelized',
+                                      output_dtypes=[profiles[varname].dtype, bool])
+        profiles[varname] = filled.transpose(*profiles[varname].dims)
+        flag = flag.transpose(*profiles[varname].dims)
+        if filled_flag is None:
+            filled_flag = flag
+        else:
+            filled_flag = filled_flag | flag
+
+    # add flag to Dataset
+    profiles[flag_name] = filled_flag
+    profiles[flag_name].attrs['description'] = 'True where a value was gap-filled'
+    profiles[flag_name].attrs['max_gap'] = max_gap
+
+    return profiles
+
+#####################################################################
+# Linear interpolation of interior gaps along the last axis (numpy)
+#####################################################################
+def fill_gaps_along_last_axis(x, z, max_gap):
+
+    # valid values and level index
+    valid = ~np.isnan(x)
+    n = x.shape[-1]
+    idx = np.arange(n)
+
+    # index of the previous valid level (-1 if none) and next valid level (n if none)
+    prev_idx = np.maximum.accumulate(np.where(valid, idx, -1), axis=-1)
+    next_idx = np.flip(np.minimum.accumulate(np.flip(np.where(valid, idx, n), axis=-1),
+                                             axis=-1), axis=-1)
+
+    # only interior gaps, and only if they are short enough
+    prev_idx_c = np.clip(prev_idx, 0, n-1)
+    next_idx_c = np.clip(next_idx, 0, n-1)
+    z0 = z[prev_idx_c]
+    z1 = z[next_idx_c]
+    fill = (~valid) & (prev_idx >= 0) & (next_idx < n) & ((z1 - z0) <= max_gap)
+
+    # linear interpolation between the bounding valid values
+    x0 = np.take_along_axis(x, prev_idx_c, axis=-1)
+    x1 = np.take_along_axis(x, next_idx_c, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = (z - z0)/(z1 - z0)
+    xfilled = np.where(fill, x0 + w*(x1 - x0), x)
+
+    return xfilled, fill
+
 #####################################################################
 # Load Ekman velocity (estimates from tau and oss)
 #####################################################################
@@ -318,94 +418,258 @@ def preprocess_time_and_date(profiles, add_season=True):
     return profiles
 
 #####################################################################
-# Regrid onto higher-resolution vertical grid
+# Linear interpolation of a field onto target levels of another field
 #####################################################################
-def regrid_onto_more_vertical_levels(profiles, zmin, zmax, zlevs=50):
-
-    print('load_and_preprocess.regrid_onto_more_vertical_levels')
+def transform_onto_levels(field, source, target_levels, dim, new_dim):
+# transform_onto_levels(field, source, target_levels, dim, new_dim)
+#   field : DataArray to interpolate (e.g. ct_on_highz)
+#   source : DataArray that defines the levels (e.g. depth or sig0_on_highz)
+#   target_levels : levels of source to interpolate onto
+#   dim : vertical dimension of field and source
+#   new_dim : name of the new vertical dimension
+# returns field on the target levels (NaN outside the range of source)
+#
+# - uses the per-profile kernels (compiled with numba if available),
+#   lazily for dask-backed input; dask chunks use the serial kernel, as
+#   they already run in parallel
+
+    target_levels = np.asarray(target_levels)
+    chunked = (field.chunks is not None) or (source.chunks is not None)
+
+    # apply kernel profile by profile (vectorized over all profiles)
+    out = xr.apply_ufunc(kernels.interp_linear, field, source,
+                         input_core_dims=[[dim],[dim]],
+                         output_core_dims=[[new_dim]],
+                         kwargs=dict(target=target_levels, parallel=not chunked),
+                         dask='parallelized',
+                         output_dtypes=[np.float64],
+                         dask_gufunc_kwargs=dict(output_sizes={new_dim: target_levels.size}))
+
+    # assign the target levels as coordinate
+    out = out.assign_coords({new_dim: target_levels})
+    out.name = field.name
+
+    return out
 
-    # define grid object
-    grid = Grid(profiles, coords={'Z': {'center': 'depth'}}, periodic=False)
+#####################################################################
+# Regrid onto higher-resolution vertical grid (standalone Dataset)
+#####################################################################
+def regrid_onto_highz_dataset(profiles, zmin, zmax, zlevs=50,
+                              chunks=None, release_source=False):
+# regrid_onto_highz_dataset(profiles, zmin, zmax, zlevs=50,
+#                           chunks=None, release_source=False)
+#   chunks : optional chunking for the new Dataset, e.g. {'profile': 10000}
+#   release_source : if True, prof_CT, prof_SA, and sig0 are removed from
+#                    profiles once the high-z fields have been built
+# returns highz (Dataset with ct_on_highz, sa_on_highz, sig0_on_highz)
+
+    print('load_and_preprocess.regrid_onto_highz_dataset')
+
+    # target levels
     target_z_levels = np.linspace(zmin, zmax, zlevs)
 
     # linearly interpolate temperature onto selected z levels
-    ct_on_highz = grid.transform(profiles.prof_CT, 'Z',
-                                 target_z_levels,
-                                 target_data=profiles.depth,
-                                 method='linear')
+    ct_on_highz = transform_onto_levels(profiles.prof_CT, profiles.depth,
+                                        target_z_levels, 'depth', 'depth_highz')
 
     # linearly interpolate salt onto selected z levels
-    sa_on_highz = grid.transform(profiles.prof_SA, 'Z',
-                                 target_z_levels,
-                                 target_data=profiles.depth,
-                                 method='linear')
+    sa_on_highz = transform_onto_levels(profiles.prof_SA, profiles.depth,
+                                        target_z_levels, 'depth', 'depth_highz')
     
     # linearly interpolate density onto selected z levels
-    sig0_on_highz = grid.transform(profiles.sig0, 'Z',
-                                   target_z_levels,
-                                   target_data=profiles.depth,
-                                   method='linear')
+    sig0_on_highz = transform_onto_levels(profiles.sig0, profiles.depth,
+                                          target_z_levels, 'depth', 'depth_highz')
 
-    # rename dimension to avoid conflict with existing dimension
-    profiles['ct_on_highz']   =   ct_on_highz.rename({'depth':'depth_highz'})
-    profiles['sa_on_highz']   =   sa_on_highz.rename({'depth':'depth_highz'})
-    profiles['sig0_on_highz'] = sig0_on_highz.rename({'depth':'depth_highz'})
+    # new Dataset
+    highz = xr.Dataset({'ct_on_highz'   :   ct_on_highz,
+                        'sa_on_highz'   :   sa_on_highz,
+                        'sig0_on_highz' : sig0_on_highz})
 
     # drop any levels where the interpolation failed
-    profiles = profiles.dropna(dim='depth_highz', how='all')
+    highz = highz.dropna(dim='depth_highz', how='all')
 
-    return profiles
+    # chunk independently of the source profiles
+    if chunks is not None:
+        highz = highz.chunk(chunks)
 
-######################################################################################
-# Regrid onto density levels (tends to get better results after high-z interpolation)
-######################################################################################
-def regrid_onto_density_levels(profiles, target_sig0_levels=None):
+    # release the source fields
+    if release_source==True:
+        highz = release_source_fields(profiles, highz, ['prof_CT','prof_SA','sig0'])
 
-    print('load_and_preprocess.regrid_onto_density_levels')
+    return highz
 
-    # if none provided, define target sigma levels
-    if (target_sig0_levels is None):
-        sig0min = profiles.sig0_on_highz.values.min()
-        sig0max = profiles.sig0_on_highz.values.max()
-        target_sig0_levels = np.linspace(sig0min, sig0max, 100)
+#####################################################################
+# Regrid onto higher-resolution vertical grid
+#####################################################################
+def regrid_onto_more_vertical_levels(profiles, zmin, zmax, zlevs=50):
 
-    # define grid object
-    grid = Grid(profiles, coords={'Z': {'center': 'depth_highz'}}, periodic=False)
+    print('load_and_preprocess.regrid_onto_more_vertical_levels')
 
-    # linearly interpolate temperature onto selected z levels
-    ct_on_sig0 = grid.transform(profiles.ct_on_highz, 'Z',
-                                target_sig0_levels,
-                                target_data=profiles.sig0_on_highz,
-                                method='linear')
+    # build the high-z fields as a separate Dataset
+    highz = regrid_onto_highz_dataset(profiles, zmin, zmax, zlevs=zlevs)
 
-    # linearly interpolate salt onto selected z levels
-    sa_on_sig0 = grid.transform(profiles.sa_on_highz, 'Z',
-                                target_sig0_levels,
-                                target_data=profiles.sig0_on_highz,
-                                method='linear')
+    # attach them to profiles (only the levels kept in highz remain)
+    profiles = profiles.assign(highz.data_vars)
+
+    return profiles
+
+#####################################################################
+# Remove consumed fields from a source Dataset
+#####################################################################
+def release_source_fields(source, result, varnames):
+# release_source_fields(source, result, varnames)
+#   source : Dataset the fields are removed from (modified in place)
+#   result : Dataset built from those fields
+#   varnames : names of the consumed fields
+# returns result
+#
+# - dask-backed results still need the source chunks, so they are
+#   loaded first; numpy-backed results are already independent
+
+    # make sure the result no longer depends on the source fields
+    if result.chunks:
+        result = result.load()
+
+    # remove the fields from the source Dataset
+    for varname in varnames:
+        if varname in source.data_vars:
+            del source[varname]
+
+    return result
+
+#####################################################################
+# Select target density levels using streaming (chunk-wise) reductions
+#####################################################################
+def select_target_sig0_levels(sig0, nlevs=100, level_method='linear', nbins=1000):
+# select_target_sig0_levels(sig0, nlevs=100, level_method='linear', nbins=1000)
+#   sig0 : DataArray of density (numpy- or dask-backed)
+#   nlevs : number of target density levels
+#   level_method : 'linear' (evenly spaced between min and max) or
+#                  'quantile' (evenly spaced in the cumulative distribution,
+#                  so that more levels are placed where the data are dense)
+#   nbins : number of histogram bins used to estimate the quantiles
+# returns target_sig0_levels, attrs (description of the level choice)
+
+    print('load_and_preprocess.select_target_sig0_levels')
+
+    # min and max as (lazy) reductions, evaluated together in a single pass
+    # --- this avoids loading the whole array with .values
+    sig0min, sig0max = dask.compute(sig0.min(), sig0.max())
+    sig0min = float(sig0min)
+    sig0max = float(sig0max)
+
+    if level_method=='linear':
+        target_sig0_levels = np.linspace(sig0min, sig0max, nlevs)
+    elif level_method=='quantile':
+        # histogram of density (chunk-wise for dask arrays, NaNs are ignored)
+        bin_edges = np.linspace(sig0min, sig0max, nbins+1)
+        if isinstance(sig0.data, dask_array.Array):
+            counts, _ = dask_array.histogram(sig0.data, bins=bin_edges)
+            counts = counts.compute()
+        else:
+            counts, _ = np.histogram(sig0.values, bins=bin_edges)
+        # invert the (piecewise linear) cumulative distribution
+        cdf = np.concatenate(([0.0], np.cumsum(counts)))/np.sum(counts)
+        target_sig0_levels = np.interp(np.linspace(0, 1, nlevs), cdf, bin_edges)
+        # empty bins can produce repeated levels; those are removed
+        target_sig0_levels = np.unique(target_sig0_levels)
+    else:
+        raise ValueError('level_method must be linear or quantile')
+
+    # record the level choice for reproducibility
+    attrs = dict(level_method=level_method,
+                 sig0min=sig0min,
+                 sig0max=sig0max,
+                 nlevs=int(target_sig0_levels.size))
+
+    return target_sig0_levels, attrs
+
+######################################################################################
+# Regrid onto density levels as a standalone Dataset (needs high-z fields)
+######################################################################################
+def regrid_onto_density_dataset(highz, target_sig0_levels=None,
+                                nlevs=100, level_method='linear',
+                                chunks=None, release_source=False):
+# regrid_onto_density_dataset(highz, target_sig0_levels=None,
+#                             nlevs=100, level_method='linear',
+#                             chunks=None, release_source=False)
+#   highz : Dataset with ct_on_highz, sa_on_highz, sig0_on_highz
+#           (from regrid_onto_highz_dataset, or profiles with these fields)
+#   chunks : optional chunking for the new Dataset, e.g. {'profile': 10000}
+#   release_source : if True, the high-z fields are removed from highz
+#                    once the density fields have been built
+# returns onsig (Dataset with ct_on_sig0, sa_on_sig0, z_on_sig0)
+
+    print('load_and_preprocess.regrid_onto_density_dataset')
+
+    # if none provided, define target sigma levels (streaming min/max or quantiles)
+    if (target_sig0_levels is None):
+        target_sig0_levels, level_attrs = select_target_sig0_levels(highz.sig0_on_highz,
+                                                                    nlevs=nlevs,
+                                                                    level_method=level_method)
+    else:
+        target_sig0_levels = np.asarray(target_sig0_levels)
+        level_attrs = dict(level_method='user',
+                           sig0min=float(target_sig0_levels.min()),
+                           sig0max=float(target_sig0_levels.max()),
+                           nlevs=int(target_sig0_levels.size))
+
+    # linearly interpolate temperature onto selected density levels
+    ct_on_sig0 = transform_onto_levels(highz.ct_on_highz, highz.sig0_on_highz,
+                                       target_sig0_levels, 'depth_highz', 'sig0_levs')
+
+    # linearly interpolate salt onto selected density levels
+    sa_on_sig0 = transform_onto_levels(highz.sa_on_highz, highz.sig0_on_highz,
+                                       target_sig0_levels, 'depth_highz', 'sig0_levs')
     
     # find the depth of density surfaces
-    tmp1 = xr.broadcast(profiles.depth_highz,profiles.profile)
-    broadcast_depth_highz = tmp1[0]
-    z_on_sig0 = grid.transform(broadcast_depth_highz, 'Z',
-                               target_sig0_levels,
-                               target_data=profiles.sig0_on_highz,
-                               method='linear')
-
-    # rename dimension to avoid conflict with existing dimension
-    profiles['ct_on_sig0'] = ct_on_sig0.rename({'sig0_on_highz':'sig0_levs'})
-    profiles['sa_on_sig0'] = sa_on_sig0.rename({'sig0_on_highz':'sig0_levs'})
-    profiles['z_on_sig0'] = z_on_sig0.rename({'sig0_on_highz':'sig0_levs'})
+    z_on_sig0 = transform_onto_levels(highz.depth_highz, highz.sig0_on_highz,
+                                      target_sig0_levels, 'depth_highz', 'sig0_levs')
+
+    # new Dataset
+    onsig = xr.Dataset({'ct_on_sig0' : ct_on_sig0,
+                        'sa_on_sig0' : sa_on_sig0,
+                        'z_on_sig0'  :  z_on_sig0})
+
+    # record how the density levels were chosen
+    onsig['sig0_levs'].attrs.update(level_attrs)
 
     # drop any levels where there are no values (all NaNs)
-    #profiles = profiles.dropna(dim='sig0_levs', how='all')
+    #onsig = onsig.dropna(dim='sig0_levs', how='all')
+
+    # chunk independently of the high-z fields
+    if chunks is not None:
+        onsig = onsig.chunk(chunks)
+
+    # release the source fields
+    if release_source==True:
+        onsig = release_source_fields(highz, onsig,
+                                      ['ct_on_highz','sa_on_highz','sig0_on_highz'])
+
+    return onsig
+
+######################################################################################
+# Regrid onto density levels (tends to get better results after high-z interpolation)
+######################################################################################
+def regrid_onto_density_levels(profiles, target_sig0_levels=None,
+                               nlevs=100, level_method='linear'):
+
+    print('load_and_preprocess.regrid_onto_density_levels')
+
+    # build the density fields as a separate Dataset
+    onsig = regrid_onto_density_dataset(profiles,
+                                        target_sig0_levels=target_sig0_levels,
+                                        nlevs=nlevs, level_method=level_method)
+
+    # attach them to profiles
+    profiles = profiles.assign(onsig.data_vars)
 
     return profiles
 
 #####################################################################
 # Select more specific density range; drop NaNs
 #####################################################################
-def select_sig0_range(profiles,sig0range=(26.5,27.2)):
+def select_sig0_range(profiles,sig0range=(26.5,27.2), max_gap=None):
 
     print('load_and_preprocess.select_sig0_range')
 
@@ -413,7 +677,13 @@ def select_sig0_range(profiles,sig0range=(26.5,27.2)):
     profiles = profiles.sel(sig0_levs=slice(sig0range[0],sig0range[1]))
 
     # might be redundant, but get rid of levels where all values nan
-    profiles = profiles.dropna(dim='')
+    profiles = profiles.dropna(dim='sig0_levs', how='all')
+
+    # fill short interior gaps (up to max_gap in kg/m^3) before dropping
+    if max_gap is not None:
+        profiles = fill_vertical_gaps(profiles, max_gap,
+                                      varnames=['ct_on_sig0','sa_on_sig0','z_on_sig0'],
+                                      dim='sig0_levs', flag_name='gap_filled_sig0')
 
     # drop all profiles with nan values
     profiles = profiles.dropna(dim='profile', how='any')
@@ -421,70 +691,255 @@ def select_sig0_range(profiles,sig0range=(26.5,27.2)):
     return profiles
 
 #####################################################################
-# Apply preprocessing scaling
+# Select the temperature and salinity fields used as features
 #####################################################################
-def apply_scaling(profiles, method='onZ'):
-
-    # start message
-    print('load_and_preprocess.apply_scaling')
+def select_feature_fields(profiles, method='onZ'):
+# returns XT, XS, name of the vertical dimension
 
     # select SA on pressure levels or SA on sig0
     if method=='onZ':
-        print('load_and_preprocess.apply_scaling: using depth levels')
+        print('load_and_preprocess.select_feature_fields: using depth levels')
         XS = profiles.prof_SA
         XT = profiles.prof_CT
+        zdim = 'depth'
     elif method=='onSig':
-        print('load_and_preprocess.apply_scaling: using density levels')
+        print('load_and_preprocess.select_feature_fields: using density levels')
         XS = profiles.sa_on_sig0
         XT = profiles.ct_on_sig0
+        zdim = 'sig0_levs'
     else:
-        print('method must be onZ or onSig')
+        raise ValueError('method must be onZ or onSig')
+
+    return XT, XS, zdim
+
+#####################################################################
+# Select a reduced set of vertical levels (greedy, error budget)
+#####################################################################
+def select_vertical_levels(profiles, method='onZ', max_error=0.05,
+                           max_levels=None, sample_size=10000,
+                           random_state=sampling.DEFAULT_SEED):
+# select_vertical_levels(profiles, method='onZ', max_error=0.05,
+#                        max_levels=None, sample_size=10000, random_state=0)
+#
+# - Starts from the top and bottom levels and repeatedly adds the level
+#   with the largest error when CT and SA are reconstructed by linear
+#   interpolation between the selected levels. Stops once the RMS error
+#   (in units of the per-level standard deviation) is below max_error,
+#   or once max_levels levels have been selected.
+# - Levels where CT or SA is missing in every sampled profile cannot be
+#   selected (nor reconstructed) and are left out; with fewer than two
+#   other levels, those are returned as they are.
+#
+# returns levels (indices along the vertical dimension), rms_error
+
+    print('load_and_preprocess.select_vertical_levels')
+
+    # temperature and salinity fields, vertical coordinate
+    XT, XS, zdim = select_feature_fields(profiles, method)
+    z = profiles[zdim].values
+    nlev = z.size
+    if max_levels is None:
+        max_levels = nlev
+
+    # random sample of profiles (the error estimate does not need all of them)
+    nprof = profiles.profile.size
+    rows_id = sampling.random_rows(nprof, sample_size, random_state=random_state,
+                                   sort=True)
+    X = np.stack((XT.isel(profile=rows_id).transpose('profile', zdim).values,
+                  XS.isel(profile=rows_id).transpose('profile', zdim).values))
+
+    # leave out levels with no CT or SA values in the sample
+    valid = np.flatnonzero(np.all(np.any(np.isfinite(X), axis=1), axis=0))
+    if valid.size < nlev:
+        print('load_and_preprocess.select_vertical_levels: leaving out ' +
+              str(nlev - valid.size) + ' levels without values')
+    if valid.size < 2:
+        return valid, 0.0
+    X = X[:, :, valid]
+    z = z[valid]
+    nlev = valid.size
+
+    # standardize each level (same as the scaling applied before PCA)
+    Xstd = np.nanstd(X, axis=1, keepdims=True)
+    Xstd[Xstd==0] = 1.0
+    X = (X - np.nanmean(X, axis=1, keepdims=True))/Xstd
+
+    # greedy selection, starting from the top and bottom levels
+    selected = [0, nlev-1]
+    while True:
+
+        # reconstruct all levels from the selected ones
+        sel = np.array(sorted(selected))
+        hi = np.clip(np.searchsorted(z[sel], z, side='right'), 1, sel.size-1)
+        lo = hi - 1
+        w = (z - z[sel[lo]])/(z[sel[hi]] - z[sel[lo]])
+        Xrec = X[:, :, sel[lo]]*(1 - w) + X[:, :, sel[hi]]*w
+
+        # RMS error for each level and overall
+        level_error = np.sqrt(np.nanmean((X - Xrec)**2, axis=(0,1)))
+        rms_error = np.sqrt(np.nanmean((X - Xrec)**2))
+
+        # stop when within the error budget (or out of levels)
+        if (rms_error <= max_error) or (sel.size >= max_levels):
+            break
+        selected.append(int(np.nanargmax(level_error)))
+
+    # report
+    print('load_and_preprocess.select_vertical_levels: ' + str(sel.size) + ' of ' +
+          str(nlev) + ' levels selected, RMS reconstruction error = ' + str(rms_error))
+
+    return valid[sel], rms_error
 
-    # scale salinity and temperature
-    scaled_S = preprocessing.scale(XS)
-    scaled_T = preprocessing.scale(XT)
-    #scaled_S.shape
-    #scaled_T.shape
+#####################################################################
+# Apply preprocessing scaling
+#####################################################################
+def apply_scaling(profiles, method='onZ', levels=None, scaler=None):
+# apply_scaling(profiles, method='onZ', levels=None, scaler=None)
+#   scaler : fitted StandardScaler to reuse (e.g. pca.scaler_); if None,
+#            a new one is fitted to these profiles
+# returns Xraw, Xscaled, scaler
+
+    # start message
+    print('load_and_preprocess.apply_scaling')
+
+    # select SA on pressure levels or SA on sig0
+    XT, XS, zdim = select_feature_fields(profiles, method)
+
+    # only keep a subset of vertical levels
+    if levels is not None:
+        XS = XS.isel({zdim: levels})
+        XT = XT.isel({zdim: levels})
 
     # concatenate
     Xraw = np.concatenate((XT,XS),axis=1)
-    Xscaled = np.concatenate((scaled_T,scaled_S),axis=1)
 
-    return Xraw, Xscaled
+    # scale salinity and temperature (each feature to zero mean, unit variance)
+    if scaler is None:
+        scaler = preprocessing.StandardScaler().fit(Xraw)
+    Xscaled = scaler.transform(Xraw)
+
+    return Xraw, Xscaled, scaler
+
+#####################################################################
+# Fit the feature scaler in batches of profiles
+#####################################################################
+def fit_scaler(profiles, method='onZ', levels=None, batch_size=10000):
+# - same statistics as the scaler fitted by apply_scaling, without holding
+#   the full feature matrix in memory
+# returns scaler (StandardScaler)
+
+    print('load_and_preprocess.fit_scaler')
+
+    scaler = preprocessing.StandardScaler()
+    for start, stop, X in feature_batches(profiles, method, levels, batch_size):
+        scaler.partial_fit(X)
+
+    return scaler
 
 #####################################################################
 # Fit and apply PCA (applied to absolute salinity, conservative temp)
 #####################################################################
 def fit_and_apply_pca(profiles, number_of_pca_components=3,
-                      kernel=False, train_frac=0.33, method='onZ'):
+                      kernel=False, train_frac=0.33, method='onZ',
+                      max_level_error=None, max_levels=None,
+                      solver='full', batch_size=10000, xpca_file=None,
+                      tol=1e-3, compare_to_exact=False,
+                      kernel_landmarks=1000, kernel_gamma=None,
+                      stratify_by=None, random_state=sampling.DEFAULT_SEED):
+# solver : 'full' (scale everything in memory, fit PCA on a random sample)
+#          'incremental' (out of core: scale, fit, and transform in batches
+#          of batch_size profiles)
+#          'randomized' (truncated randomized SVD on float32 features; power
+#          iterations are added until the subspace changes by less than tol;
+#          if compare_to_exact, the agreement with the exact solver is printed)
+# kernel : if True, nonlinear (RBF) kernel PCA using a Nystroem approximation
+#          with kernel_landmarks landmark profiles; memory is linear in the
+#          number of profiles. kernel_gamma defaults to 1/number of features.
+#          Not available with solver='incremental'.
+# stratify_by : None, or variables to stratify the training sample by
+#          (e.g. ['source','season']; see sampling.profile_strata)
+# xpca_file : if given, Xpca is written to this feature store (see
+#          feature_store) and returned memory-mapped
 
     # start message
     print('load_and_preprocess.fit_and_apply_pca')
 
+    if kernel==True and solver=='incremental':
+        raise ValueError('kernel PCA is not available with the incremental solver')
+
+    # optionally, select a reduced set of vertical levels first
+    if (max_level_error is not None) or (max_levels is not None):
+        if max_level_error is None:
+            max_level_error = 0.0
+        levels, level_error = select_vertical_levels(profiles, method=method,
+                                                     max_error=max_level_error,
+                                                     max_levels=max_levels,
+                                                     random_state=random_state)
+    else:
+        levels, level_error = None, None
+
+    # out-of-core mode: never holds the full feature matrix in memory
+    if solver=='incremental':
+        pca, Xpca = fit_and_apply_incremental_pca(profiles,
+                                                  number_of_pca_components,
+                                                  method=method, levels=levels,
+                                                  batch_size=batch_size,
+                                                  xpca_file=xpca_file)
+        pca.vertical_levels_ = levels
+        pca.level_reconstruction_error_ = level_error
+        return pca, Xpca
+    elif solver not in ('full', 'randomized'):
+        raise ValueError('solver must be full, incremental, or randomized')
+
     # concatenate
-    Xraw, Xscaled = apply_scaling(profiles, method)
+    Xraw, Xscaled, scaler = apply_scaling(profiles, method, levels=levels)
+
+    # float32 features for the randomized solver
+    if solver=='randomized':
+        Xscaled = Xscaled.astype(np.float32)
+
+    # random sample for training (optionally stratified)
+    rows_id = sampling.sample_profiles(profiles, frac=train_frac, by=stratify_by,
+                                       random_state=random_state)
+    Xtrain = Xscaled[rows_id,:]
 
     # create PCA object
     if kernel==True:
-        # KernelPCA approach (crashses due to memory)
-        print('load_and_preprocess: apply KernelPCA')
-        pca = KernelPCA(n_components=number_of_pca_components,
-                        kernel='linear', fit_inverse_transform=True, gamma=10)
+        # low-rank (Nystroem) approximation of an RBF kernel, followed by PCA
+        # (KernelPCA builds the full n x n kernel matrix and runs out of memory)
+        print('load_and_preprocess: apply Nystroem kernel PCA')
+        nystroem = Nystroem(kernel='rbf', gamma=kernel_gamma,
+                            n_components=int(np.min((kernel_landmarks, Xtrain.shape[0]))),
+                            random_state=0)
+        pca = make_pipeline(nystroem, PCA(number_of_pca_components))
     else:
         pca = PCA(number_of_pca_components)
 
-    # random sample for training
-    pf = profiles.profile
-    rsample_size = np.min((int(train_frac*pf.size),int(pf.size)))
-    rows_id = random.sample(range(0,pf.size), rsample_size)
-    Xtrain = Xscaled[rows_id,:]
-
     # fit PCA model using training dataset
     print('Fitting PCA')
-    pca.fit(Xtrain)
+    if (solver=='randomized') and (kernel==False):
+        pca = fit_randomized_pca(Xtrain, number_of_pca_components, tol=tol)
+        if compare_to_exact==True:
+            pca_exact = PCA(number_of_pca_components).fit(Xtrain.astype(np.float64))
+            agreement = pca_subspace_agreement(pca, pca_exact)
+            print('load_and_preprocess.fit_and_apply_pca: explained variance ' +
+                  str(np.sum(pca.explained_variance_ratio_)) + ' (randomized), ' +
+                  str(np.sum(pca_exact.explained_variance_ratio_)) + ' (exact)')
+            print('load_and_preprocess.fit_and_apply_pca: subspace agreement ' +
+                  '(cosines of principal angles) = ' + str(agreement))
+    else:
+        pca.fit(Xtrain)
+
+    # keep the selected levels and the scaling with the PCA, so that
+    # apply_pca can reuse them
+    pca.vertical_levels_ = levels
+    pca.level_reconstruction_error_ = level_error
+    pca.scaler_ = scaler
 
     # transform entire input dataset into PCA representation
-    Xpca = pca.transform(Xscaled)
+    Xpca = transform_in_batches(pca, Xscaled)
+    if xpca_file is not None:
+        Xpca = store_xpca(xpca_file, Xpca, profiles, pca, method)
 
     # calculated total variance explained
     if kernel==False:
@@ -494,36 +949,281 @@ def fit_and_apply_pca(profiles, number_of_pca_components=3,
     return pca, Xpca
 
 #####################################################################
-# Apply an existing PCA
+# Write Xpca to a feature store, return it memory-mapped
 #####################################################################
-def apply_pca(profiles, pca, method='onZ'):
+def store_xpca(xpca_file, Xpca, profiles, pca, method='onZ'):
 
-    # start message
-    print('load_and_preprocess.apply_pca')
+    fs.write_features(xpca_file, Xpca, profiles.profile.values,
+                      metadata=xpca_metadata(pca, profiles, method))
+    Xpca, profile_ids, metadata = fs.open_features(xpca_file)
 
-    # concatenate
-    Xraw, Xscaled = apply_scaling(profiles, method=method)
+    return Xpca
 
-    # transform
-    Xpca = pca.transform(Xscaled)
+#####################################################################
+# Metadata of a stored Xpca (what it was computed from)
+#####################################################################
+def xpca_metadata(pca, profiles, method='onZ', levels=None):
+# - the PCA (gmm.pca_signature), the feature method, the vertical levels,
+#   and a fingerprint of the profiles; a stored Xpca is only reused if all
+#   of them match (see feature_store.is_current)
+#   levels : defaults to pca.vertical_levels_
+
+    if levels is None:
+        levels = getattr(pca, 'vertical_levels_', None)
+
+    metadata = {'content': 'Xpca', 'method': method,
+                'vertical_levels': None if levels is None else [int(i) for i in levels],
+                'profiles_fingerprint': fs.profile_fingerprint(profiles)}
+    metadata.update(gm.pca_signature(pca))
+
+    return metadata
+
+#####################################################################
+# Transform features in batches of profiles (limits temporary memory)
+#####################################################################
+def transform_in_batches(pca, Xscaled, batch_size=10000):
+
+    Xpca = None
+    for start in range(0, Xscaled.shape[0], batch_size):
+        Xbatch = pca.transform(Xscaled[start:start + batch_size, :])
+        if Xpca is None:
+            Xpca = np.empty((Xscaled.shape[0], Xbatch.shape[1]), dtype=Xbatch.dtype)
+        Xpca[start:start + batch_size, :] = Xbatch
+
+    return Xpca
+
+#####################################################################
+# Fit PCA with a randomized truncated SVD (controlled tolerance)
+#####################################################################
+def fit_randomized_pca(Xtrain, number_of_pca_components=3, tol=1e-3,
+                       max_power_iterations=12, random_state=0, n_oversamples=10):
+# - randomized subspace iteration (Halko et al., 2011) in a single fit:
+#   a random subspace of the features is carried from one power iteration
+#   to the next (instead of refitting with more iterations), and the
+#   components are its Rayleigh-Ritz vectors; iterations are added until
+#   the largest principal angle between the components of successive
+#   iterations has a sine below tol
+# - each iteration is two passes over Xtrain (Xc P and Xc'(Xc P)); only
+#   (features x subspace) matrices are orthonormalized
+# returns the fitted PCA (with pca.power_iterations_ set)
+
+    X = np.asarray(Xtrain)
+    n, d = X.shape
+    k = number_of_pca_components
+    nl = int(np.min((k + n_oversamples, d)))
+    rng = sampling.get_rng(random_state)
+
+    # centred features (in the precision of Xtrain, e.g. float32)
+    mean = X.mean(axis=0)
+    Xc = X - mean
+
+    # random starting subspace, then power iterations
+    P, _ = np.linalg.qr(rng.standard_normal((d, nl)))
+    P = P.astype(X.dtype)
+    components = None
+    for n_iter in range(0, max_power_iterations + 1):
+        Y = Xc @ P
+
+        # Rayleigh-Ritz: eigenvectors of the covariance within the subspace
+        eigenvalues, W = np.linalg.eigh((Y.T @ Y).astype(np.float64))
+        order = np.argsort(eigenvalues)[::-1][:k]
+        components_old = components
+        components = (P.astype(np.float64) @ W[:, order]).T
+        eigenvalues = eigenvalues[order]
+
+        # converged?
+        if components_old is not None:
+            cosines = np.linalg.svd(components @ components_old.T, compute_uv=False)
+            if np.sqrt(np.max((1.0 - np.min(cosines)**2, 0.0))) < tol:
+                break
+
+        # next subspace
+        P, _ = np.linalg.qr(Xc.T @ Y)
+
+    # sign convention of sklearn (largest absolute entry positive)
+    signs = np.sign(components[np.arange(k), np.argmax(np.abs(components), axis=1)])
+    components = (components*signs[:, None]).astype(X.dtype)
+
+    # explained variance
+    explained_variance = np.maximum(eigenvalues, 0.0)/(n - 1)
+    total_variance = np.sum(np.var(Xc, axis=0, ddof=1, dtype=np.float64))
+
+    # a fitted PCA object with these parameters
+    pca = PCA(k, svd_solver='randomized', iterated_power=n_iter,
+              random_state=random_state)
+    pca.components_ = components
+    pca.mean_ = mean
+    pca.singular_values_ = np.sqrt(explained_variance*(n - 1)).astype(X.dtype)
+    pca.explained_variance_ = explained_variance.astype(X.dtype)
+    pca.explained_variance_ratio_ = (explained_variance/total_variance).astype(X.dtype)
+    pca.noise_variance_ = ((total_variance - np.sum(explained_variance))/(d - k)
+                           if k < d else 0.0)
+    pca.n_components_ = k
+    pca.n_features_in_ = d
+    pca.n_samples_ = n
+    pca.power_iterations_ = n_iter
+
+    return pca
+
+#####################################################################
+# Agreement between the subspaces spanned by two PCAs
+#####################################################################
+def pca_subspace_agreement(pca1, pca2):
+# returns the cosines of the principal angles between the two subspaces
+# (1 = identical directions, 0 = orthogonal), largest first
+
+    # orthonormal bases (rows of components_)
+    Q1, _ = np.linalg.qr(np.asarray(pca1.components_, dtype=np.float64).T)
+    Q2, _ = np.linalg.qr(np.asarray(pca2.components_, dtype=np.float64).T)
+
+    # singular values of Q1'Q2 are the cosines of the principal angles
+    cosines = np.linalg.svd(Q1.T @ Q2, compute_uv=False)
+
+    return np.clip(cosines, 0.0, 1.0)
+
+#####################################################################
+# Iterate over the features in batches of profiles
+#####################################################################
+def feature_batches(profiles, method='onZ', levels=None, batch_size=10000):
+# yields (start, stop, X) with X = [CT, SA] for profiles start:stop,
+# shape (stop - start, number of features); only one batch is loaded
+# at a time (works for numpy- and dask-backed profiles)
+
+    # select SA on pressure levels or SA on sig0
+    XT, XS, zdim = select_feature_fields(profiles, method)
+
+    # only keep a subset of vertical levels
+    if levels is not None:
+        XS = XS.isel({zdim: levels})
+        XT = XT.isel({zdim: levels})
+    XT = XT.transpose('profile', zdim)
+    XS = XS.transpose('profile', zdim)
+
+    # batch edges; a short last batch is merged into the previous one
+    nprof = profiles.profile.size
+    edges = list(range(0, nprof, batch_size)) + [nprof]
+    if (len(edges) > 2) and (edges[-1] - edges[-2] < batch_size//2):
+        del edges[-2]
+
+    # loop over batches
+    for start, stop in zip(edges[:-1], edges[1:]):
+        X = np.concatenate((XT.isel(profile=slice(start, stop)).values,
+                            XS.isel(profile=slice(start, stop)).values), axis=1)
+        yield start, stop, X
+
+#####################################################################
+# Fit and apply incremental PCA (out of core, in batches of profiles)
+#####################################################################
+def fit_and_apply_incremental_pca(profiles, number_of_pca_components=3,
+                                  method='onZ', levels=None,
+                                  batch_size=10000, xpca_file=None):
+# - pass 1: accumulate the mean and std of each feature (StandardScaler)
+# - pass 2: fit IncrementalPCA on the scaled batches
+# - pass 3: transform each batch into Xpca (written straight into the
+#           feature store xpca_file if given, otherwise an in-memory array)
+# returns pca, Xpca
+
+    # start message
+    print('load_and_preprocess.fit_and_apply_incremental_pca')
+
+    # IncrementalPCA needs at least n_components profiles in each batch
+    nprof = profiles.profile.size
+    batch_size = int(np.max((batch_size, 2*number_of_pca_components)))
+
+    # pass 1: scaling statistics (same scaling as preprocessing.scale)
+    scaler = preprocessing.StandardScaler()
+    for start, stop, X in feature_batches(profiles, method, levels, batch_size):
+        scaler.partial_fit(X)
+
+    # pass 2: fit the PCA
+    print('Fitting incremental PCA')
+    pca = IncrementalPCA(n_components=number_of_pca_components)
+    for start, stop, X in feature_batches(profiles, method, levels, batch_size):
+        pca.partial_fit(scaler.transform(X))
+
+    # pass 3: transform into the PCA representation
+    if xpca_file is not None:
+        Xpca = fs.create_features(xpca_file, profiles.profile.values,
+                                  number_of_pca_components,
+                                  metadata=xpca_metadata(pca, profiles, method, levels))
+    else:
+        Xpca = np.empty((nprof, number_of_pca_components))
+    for start, stop, X in feature_batches(profiles, method, levels, batch_size):
+        Xpca[start:stop, :] = pca.transform(scaler.transform(X))
+    if xpca_file is not None:
+        Xpca.flush()
+        Xpca, profile_ids, metadata = fs.open_features(xpca_file)
+
+    # keep the scaling with the PCA
+    pca.scaler_ = scaler
 
     # calculated total variance explained
     total_variance_explained_ = np.sum(pca.explained_variance_ratio_)
     print(total_variance_explained_)
 
+    return pca, Xpca
+
+#####################################################################
+# Apply an existing PCA
+#####################################################################
+def apply_pca(profiles, pca, method='onZ', batch_size=None, xpca_file=None):
+# - uses the levels and scaling the PCA was trained on (pca.scaler_);
+#   PCAs saved without a scaler fall back to rescaling the new profiles
+# - if batch_size is given, the profiles are transformed in batches
+# - if xpca_file is given, Xpca is written to this feature store and
+#   returned memory-mapped
+
+    # start message
+    print('load_and_preprocess.apply_pca')
+
+    # levels and scaling the PCA was trained on
+    levels = getattr(pca, 'vertical_levels_', None)
+    scaler = getattr(pca, 'scaler_', None)
+    if scaler is None:
+        print('load_and_preprocess.apply_pca: no stored scaler, rescaling with the new profiles')
+
+    # transform
+    if (batch_size is None) or (scaler is None):
+        Xraw, Xscaled, scaler = apply_scaling(profiles, method=method,
+                                              levels=levels, scaler=scaler)
+        Xpca = transform_in_batches(pca, Xscaled)
+        if xpca_file is not None:
+            Xpca = store_xpca(xpca_file, Xpca, profiles, pca, method)
+    else:
+        Xpca = None
+        for start, stop, X in feature_batches(profiles, method, levels, batch_size):
+            Xbatch = pca.transform(scaler.transform(X))
+            if Xpca is None and xpca_file is not None:
+                Xpca = fs.create_features(xpca_file, profiles.profile.values,
+                                          Xbatch.shape[1], dtype=Xbatch.dtype,
+                                          metadata=xpca_metadata(pca, profiles, method))
+            elif Xpca is None:
+                Xpca = np.empty((profiles.profile.size, Xbatch.shape[1]))
+            Xpca[start:stop, :] = Xbatch
+        if xpca_file is not None:
+            Xpca.flush()
+            Xpca, profile_ids, metadata = fs.open_features(xpca_file)
+
+    # calculated total variance explained (not defined for kernel PCA)
+    if hasattr(pca, 'explained_variance_ratio_'):
+        total_variance_explained_ = np.sum(pca.explained_variance_ratio_)
+        print(total_variance_explained_)
+
     return Xpca
 
 #####################################################################
 # Fit and apply t-SNE
 #####################################################################
 def fit_and_apply_tsne(profiles, Xpca, random_state=0, perplexity=50,
-                       tsne_frac=0.10, var_to_plot="label"):
-
-    # sample size
-    sample_size = np.min((int(tsne_frac*Xpca.shape[0]),int(Xpca.shape[0])))
-
-    # random sample for tSNE plot
-    rows_id = random.sample(range(0,Xpca.shape[0]), sample_size)
+                       tsne_frac=0.10, var_to_plot="label", backend='auto',
+                       n_jobs=-1, knn_cache_dir=None, stratify_by=None):
+# backend : 'opentsne' (approximate nearest neighbours and FFT-accelerated
+#           gradients on all cores; fast enough for tsne_frac=1.0),
+#           'sklearn' (Barnes-Hut), or 'auto' (openTSNE if installed)
+
+    # random sample for tSNE plot (optionally stratified, e.g. by label)
+    rows_id = sampling.sample_profiles(profiles, frac=tsne_frac, by=stratify_by,
+                                       random_state=random_state)
     Xpca_for_tSNE = Xpca[rows_id,:]
     
     # select which variable to plot
@@ -542,7 +1242,7 @@ def fit_and_apply_tsne(profiles, Xpca, random_state=0, perplexity=50,
     elif var_to_plot=="CT":
         colors_for_tSNE = profiles.prof_CT[rows_id].values
     elif var_to_plot=="sig0":
-        colors_for_tNSE = profiles.sig0[rows_id].values
+        colors_for_tSNE = profiles.sig0[rows_id].values
     elif var_to_plot=="dyn_height":
         colors_for_tSNE = profiles.dyn_height[rows_id].values
     elif var_to_plot=="mld":
@@ -552,40 +1252,178 @@ def fit_and_apply_tsne(profiles, Xpca, random_state=0, perplexity=50,
     else:
         colors_for_tSNE = profiles.label[rows_id].values
 
-    # create tSNE object
-    tsne = manifold.TSNE(n_components=2, init='random',
-                         random_state=random_state,
-                         perplexity=perplexity)
-
     # fit tsne
-    trans_data = tsne.fit_transform(Xpca_for_tSNE).T
+    trans_data = tsne_embedding(Xpca_for_tSNE, random_state=random_state,
+                                perplexity=perplexity, backend=backend,
+                                n_jobs=n_jobs, knn_cache_dir=knn_cache_dir).T
 
     # return tsne-transformed data
     return trans_data, colors_for_tSNE
 
+#####################################################################
+# t-SNE embedding (2D) with the selected backend
+#####################################################################
+def tsne_embedding(X, random_state=0, perplexity=50, backend='auto', n_jobs=-1,
+                   knn_cache_dir=None):
+# returns the embedding, shape (number of samples, 2)
+#
+# - if knn_cache_dir is given, the neighbour graph is taken from (or added
+#   to) the cache in neighbours.knn_graph instead of being rebuilt
+
+    # select backend
+    if backend=='auto':
+        backend = 'opentsne' if HAS_OPENTSNE else 'sklearn'
+    if backend=='opentsne' and not HAS_OPENTSNE:
+        print('load_and_preprocess.tsne_embedding: openTSNE is not installed, using sklearn')
+        backend = 'sklearn'
+    print('load_and_preprocess.tsne_embedding: ' + backend + ' backend')
+
+    # cached neighbour graph (t-SNE uses about 3*perplexity neighbours)
+    graph = None
+    if knn_cache_dir is not None:
+        k = int(np.min((int(3*perplexity + 1), X.shape[0] - 1)))
+        graph = neighbours.knn_graph(X, k=k, cache_dir=knn_cache_dir, n_jobs=n_jobs)
+
+    if backend=='opentsne':
+        tsne = openTSNE.TSNE(n_components=2, perplexity=perplexity,
+                             neighbors='approx',
+                             negative_gradient_method='fft',
+                             n_jobs=n_jobs, random_state=random_state)
+        if graph is None:
+            embedding = np.asarray(tsne.fit(X))
+        else:
+            indices, distances = neighbours.graph_to_arrays(graph)
+            knn_index = openTSNE.nearest_neighbors.PrecomputedNeighbors(indices, distances)
+            affinities = openTSNE.affinity.PerplexityBasedNN(perplexity=perplexity,
+                                                             knn_index=knn_index,
+                                                             n_jobs=n_jobs)
+            embedding = np.asarray(tsne.fit(X, affinities=affinities))
+    elif backend=='sklearn':
+        if graph is None:
+            tsne = manifold.TSNE(n_components=2, init='random',
+                                 random_state=random_state,
+                                 perplexity=perplexity, n_jobs=n_jobs)
+            embedding = tsne.fit_transform(X)
+        else:
+            # the neighbour distances must be squared, as sklearn does for
+            # metric='euclidean'; before sklearn 1.3 precomputed ones are
+            # only squared with square_distances=True (the default 'legacy'
+            # leaves them as they are), after 1.3 they always are
+            options = {}
+            if 'square_distances' in manifold.TSNE().get_params():
+                options['square_distances'] = True
+            tsne = manifold.TSNE(n_components=2, init='random',
+                                 random_state=random_state, metric='precomputed',
+                                 perplexity=perplexity, n_jobs=n_jobs, **options)
+            embedding = tsne.fit_transform(neighbours.add_self(graph, X))
+    else:
+        raise ValueError('backend must be auto, opentsne, or sklearn')
+
+    return embedding
+
 #####################################################################
 # Fit and apply UMAP
 #####################################################################
-def fit_and_apply_umap(profiles,n_neighbors=50,min_dist=0.0,frac=0.33):
+def fit_and_apply_umap(profiles,n_neighbors=50,min_dist=0.0,frac=0.33,
+                       method='onZ', batch_size=10000, n_jobs=-1,
+                       knn_cache_dir=None, random_state=42):
+# - fits UMAP on a random sample (frac) of the profiles, then transforms
+#   all profiles in batches with apply_umap; the fitted scaler and the
+#   method ('onZ' or 'onSig') are kept as embedding.scaler_ and
+#   embedding.method_ so that the embedding can be saved and reused
+# - the scaler is fitted in batches of batch_size profiles, and only the
+#   sampled profiles are loaded and scaled at once, so memory use depends
+#   on frac, not on the total number of profiles
+# - if knn_cache_dir is given, UMAP is instead fitted on all profiles
+#   using the cached neighbour graph (neighbours.knn_graph); this holds the
+#   full scaled feature matrix in memory (not memory-bounded), and such an
+#   embedding cannot transform new profiles afterwards
+# returns embedding, Xumap
 
     # start message
     print('load_and_preprocess.fit_and_apply_umap')
 
-    # apply scaling
-    Xraw, Xscaled = apply_scaling(profiles)
-
-    # random sample
-    rsample_size = int(frac*Xscaled.shape[0])
-    rows_id = random.sample(range(0,Xscaled.shape[0]-1), rsample_size)
-    Xscaled_for_umap = Xscaled[rows_id,:]
+    if not HAS_UMAP:
+        raise ImportError('fit_and_apply_umap needs umap-learn (pip install umap-learn)')
+
+    # fit on all profiles, using the cached neighbour graph
+    if knn_cache_dir is not None:
+        Xraw, Xscaled, scaler = apply_scaling(profiles, method)
+        del Xraw
+        graph = neighbours.knn_graph(Xscaled, k=n_neighbors - 1,
+                                     cache_dir=knn_cache_dir, n_jobs=n_jobs)
+        indices, distances = neighbours.graph_to_arrays(graph)
+        # UMAP counts each profile as its own nearest neighbour
+        rows = np.arange(Xscaled.shape[0])[:, None]
+        indices = np.concatenate((rows, indices), axis=1)
+        distances = np.concatenate((np.zeros(rows.shape, dtype=distances.dtype),
+                                    distances), axis=1)
+        embedding = umap.UMAP(n_neighbors=n_neighbors,
+                              min_dist=min_dist,
+                              n_components=3,
+                              precomputed_knn=(indices, distances, None),
+                              random_state=random_state).fit(Xscaled)
+        embedding.scaler_ = scaler
+        embedding.method_ = method
+        return embedding, embedding.embedding_
+
+    # scaling statistics of all profiles (in batches)
+    scaler = preprocessing.StandardScaler()
+    for start, stop, X in feature_batches(profiles, method, None, batch_size):
+        scaler.partial_fit(X)
+
+    # random sample (only these profiles are loaded)
+    nprof = profiles.profile.size
+    rows_id = sampling.random_rows(nprof, int(frac*nprof), random_state=random_state,
+                                   sort=True)
+    Xraw, Xscaled_for_umap, scaler = apply_scaling(profiles.isel(profile=rows_id),
+                                                   method, scaler=scaler)
+    del Xraw
 
     # fit UMAP to scaled data
     embedding = umap.UMAP(n_neighbors=n_neighbors,
                           min_dist=min_dist,
                           n_components=3,
-                          random_state=42).fit(Xscaled_for_umap)
+                          random_state=random_state).fit(Xscaled_for_umap)
+    embedding.scaler_ = scaler
+    embedding.method_ = method
+    del Xscaled_for_umap
 
-    # transform
-    Xumap = embedding.transform(Xscaled)
+    # transform (in batches)
+    Xumap = apply_umap(profiles, embedding, method=method, batch_size=batch_size,
+                       n_jobs=n_jobs)
 
     return embedding, Xumap
+
+#####################################################################
+# Apply an existing UMAP embedding (in batches, in parallel)
+#####################################################################
+def apply_umap(profiles, embedding, method=None, batch_size=10000, n_jobs=-1):
+# - method defaults to the one the embedding was fitted with
+#   (embedding.method_, or 'onZ')
+# - transforming everything at once runs out of memory, so the profiles
+#   are scaled and transformed batch_size at a time; at most a few
+#   batches per worker are in flight, so memory use stays flat
+# - threads share the fitted embedding (processes would each need a copy)
+
+    # start message
+    print('load_and_preprocess.apply_umap')
+
+    # embeddings fitted from a precomputed graph have no search index
+    if getattr(embedding, '_knn_search_index', 0) is None:
+        raise ValueError('this UMAP embedding was fitted from a precomputed ' +
+                         'neighbour graph and cannot transform new profiles')
+
+    if method is None:
+        method = getattr(embedding, 'method_', 'onZ')
+
+    # batches of scaled features, generated lazily
+    scaler = embedding.scaler_
+    batches = (scaler.transform(X) for start, stop, X in
+               feature_batches(profiles, method, None, batch_size))
+
+    # transform in parallel
+    Xumap = joblib.Parallel(n_jobs=n_jobs, backend='threading')(
+        joblib.delayed(embedding.transform)(X) for X in batches)
+
+    return np.concatenate(Xumap, axis=0)
@@ -17,6 +17,10 @@ import file_io as io
 import xarray
 import density
 import gmm
+import pipeline
+import neighbours as nb
+import feature_store as fs
+import class_stats as cs
 ### plotting tools
 import matplotlib
 import matplotlib.pyplot as plt
@@ -44,13 +48,10 @@ if not os.path.exists(ploc):
 getBIC = True
 max_N = 20
 
-# transformation method (pca, umap)
-# --- at present, UMAP transform crashes the kernel
+# transformation method (pca, kpca, umap)
+# --- kpca is the Nystroem-approximated (RBF) kernel PCA
 transform_method = 'pca'
 
-# use the kernel PCA approach (memory intensive, not working yet)
-use_kernel_pca = False
-
 # save the processed output as a NetCDF file?
 saveOutput = True
 
@@ -60,6 +61,10 @@ n_pca = 6
 # make decision about n_components_selected (iterative part of analysis)
 n_components_selected = 4
 
+# number of GMM starts (1 = a single sklearn fit, as in the saved models;
+# more starts run in a process pool and keep the best, see gmm.train_gmm)
+n_gmm_starts = 1
+
 #longitude and latitude range
 lon_min = -65
 lon_max =  80
@@ -76,9 +81,16 @@ Trange=(-2, 25.0)
 Srange=(33.0, 37.0)
 
 # create filename for saving GMM and saving labelled profiles
-pca_fname = dloc + 'pca_' + str(int(lon_min)) + 'to' + str(int(lon_max)) + 'lon_' + str(int(lat_min)) + 'to' + str(int(lat_max)) + 'lat_' + str(int(zmin)) + 'to' + str(int(zmax)) + 'depth_' + str(int(n_pca)) + descrip
-gmm_fname = dloc + 'gmm_' + str(int(lon_min)) + 'to' + str(int(lon_max)) + 'lon_' + str(int(lat_min)) + 'to' + str(int(lat_max)) + 'lat_' + str(int(zmin)) + 'to' + str(int(zmax)) + 'depth_' + str(int(n_components_selected)) + 'K_' + descrip
-fname = dloc + 'profiles_' + str(int(lon_min)) + 'to' + str(int(lon_max)) + 'lon_' + str(int(lat_min)) + 'to' + str(int(lat_max)) + 'lat_' + str(int(zmin)) + 'to' + str(int(zmax)) + 'depth_' + str(int(n_components_selected)) + 'K_' + descrip + '.nc'
+pca_fname = io.model_file_name(dloc, transform_method, lon_min, lon_max, lat_min, lat_max,
+                               zmin, zmax, str(int(n_pca)), descrip)
+gmm_fname = io.model_file_name(dloc, 'gmm', lon_min, lon_max, lat_min, lat_max,
+                               zmin, zmax, str(int(n_components_selected)) + 'K_', descrip)
+pipe_fname = io.model_file_name(dloc, transform_method + '_pipeline', lon_min, lon_max, lat_min, lat_max,
+                                zmin, zmax, str(int(n_pca)) + 'pc_' +
+                                str(int(n_components_selected)) + 'K_', descrip)
+fname = io.model_file_name(dloc, 'profiles', lon_min, lon_max, lat_min, lat_max,
+                           zmin, zmax, str(int(n_components_selected)) + 'K_', descrip,
+                           extension='.nc')
 
 # colormap
 colormap = plt.get_cmap('tab20', n_components_selected)
@@ -124,20 +136,26 @@ profiles = lp.regrid_onto_density_levels(profiles)
 # Dimensionality reduction / transformation
 #####################################################################
 
-# use PCA, either regular or KernelPCA
-if transform_method=='pca':
+# use PCA, either regular or kernel PCA
+if transform_method in ('pca', 'kpca'):
 
-    # if trained PCA already exists, load it
-    if os.path.isfile(pca_fname):
+    # if trained PCA already exists, load it, and open its stored projection
+    # if that was made by this PCA from these profiles (memory-mapped, no
+    # recomputation); otherwise project the profiles again
+    if os.path.isfile(pca_fname + '.pkl'):
         pca = io.load_pca(pca_fname)
-        Xtrans = lp.apply_pca(profiles, pca)
+        if fs.is_current(pca_fname + '_Xpca', profiles, lp.xpca_metadata(pca, profiles)):
+            Xtrans, profile_ids, metadata = fs.open_features(pca_fname + '_Xpca', profiles)
+        else:
+            Xtrans = lp.apply_pca(profiles, pca, xpca_file=pca_fname + '_Xpca')
     # otherwise, go ahead and train it
     else:
         # apply PCA
         pca, Xtrans = lp.fit_and_apply_pca(profiles,
                                            number_of_pca_components=n_pca,
-                                           kernel=use_kernel_pca,
-                                           train_frac=0.99)
+                                           kernel=(transform_method=='kpca'),
+                                           train_frac=0.99,
+                                           xpca_file=pca_fname + '_Xpca')
         # save for future use
         io.save_pca(pca_fname, pca)
 
@@ -151,9 +169,15 @@ if transform_method=='pca':
 # the UMAP method produces a 2D projection
 elif transform_method=='umap':
 
-    # alternatively, apply UMAP
-    embedding, Xtrans = lp.fit_and_apply_umap(profiles,
-                                              n_neighbors=50, min_dist=0.0)
+    # if a fitted UMAP already exists, load it (pca_fname is named after
+    # the transform method), otherwise fit it on a sample and save it
+    if os.path.isfile(pca_fname + '.pkl'):
+        embedding = io.load_umap(pca_fname)
+        Xtrans = lp.apply_umap(profiles, embedding)
+    else:
+        embedding, Xtrans = lp.fit_and_apply_umap(profiles,
+                                                  n_neighbors=50, min_dist=0.0)
+        io.save_umap(pca_fname, embedding)
 
     # plot UMAP structure
     pt.plot_umap(ploc, Xtrans)
@@ -163,7 +187,7 @@ elif transform_method=='umap':
 
 else:
 
-    print('Invalid transform method! Must be pca or umap')
+    print('Invalid transform method! Must be pca, kpca, or umap')
 
 #####################################################################
 # Statistical measures to inform number of classes
@@ -180,24 +204,45 @@ if getBIC==True:
 #####################################################################
 
 # if GMM exists, load it. Otherwise, create it.
-if os.path.isfile(gmm_fname):
-    best_gmm = io.load_gmm(gmm_fname)
+# (stored with the width and fingerprint of the PCA, checked when loading)
+transform = pca if transform_method in ('pca', 'kpca') else None
+if io.gmm_exists(gmm_fname):
+    best_gmm = io.load_gmm(gmm_fname, pca=transform, n_features=Xtrans.shape[1])
 else:
-    best_gmm = gmm.train_gmm(Xtrans, n_components_selected)
-    io.save_gmm(gmm_fname, best_gmm)
+    best_gmm = gmm.train_gmm(Xtrans, n_components_selected, n_init=n_gmm_starts)
+    io.save_gmm(gmm_fname, best_gmm, pca=transform,
+                metadata={'transform_method': transform_method})
+
+# bundle the vertical grid, scaler, PCA, and GMM into a single file, so that
+# new profiles can be classified with pipeline.classify(io.load_pipeline(...))
+if transform_method in ('pca', 'kpca'):
+    # PCAs saved before the scaler was stored with them were applied with the
+    # scaling of these profiles (see lp.apply_pca): bundle that scaler
+    if getattr(pca, 'scaler_', None) is None:
+        print('PCA has no stored scaler, bundling the scaler of these profiles')
+        pca.scaler_ = lp.fit_scaler(profiles, levels=getattr(pca, 'vertical_levels_', None))
+    io.save_pipeline(pipe_fname, pipeline.build_pipeline(profiles, pca, best_gmm))
 
 # apply either loaded or created GMM
 profiles = gmm.apply_gmm(profiles, Xtrans, best_gmm, n_components_selected)
 
 # calculate class statistics
-class_means, class_stds = gmm.calc_class_stats(profiles)
+class_summary = cs.class_summary(profiles)
+class_means, class_stds = gmm.calc_class_stats(profiles, summary=class_summary)
+
+# neighbourhood purity of the classes (the neighbour graph of Xtrans is
+# cached, so reruns do not rebuild it)
+knn = nb.knn_graph(Xtrans, k=30, cache_dir=dloc + 'knn/')
+purity, class_purity = nb.class_purity(knn, profiles.label.values)
+print('Neighbourhood purity of each class = ' + str(class_purity))
 
 #####################################################################
 # Calculate and plot tSNE with class labels
 #####################################################################
 
 # fit and apply tsne
-tSNE_data, colors_for_tSNE = lp.fit_and_apply_tsne(profiles, Xtrans)
+tSNE_data, colors_for_tSNE = lp.fit_and_apply_tsne(profiles, Xtrans,
+                                                   knn_cache_dir=dloc + 'knn/')
 
 # plot t-SNE with class labels
 pt.plot_tsne(ploc, colormap, tSNE_data, colors_for_tSNE)
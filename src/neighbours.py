@@ -0,0 +1,242 @@
+#####################################################################
+# Nearest-neighbour graph (cached on disk, shared between consumers)
+#####################################################################
+#
+# - The k-nearest-neighbour graph of a feature matrix is built once and
+#   stored as a sparse matrix (scipy .npz), keyed by a hash of the
+#   feature matrix and k. A later call on the same matrix (e.g. the same
+#   stage of a rerun, or another consumer of the same features) loads it
+#   instead of building it again; a graph with more neighbours also
+#   serves calls with fewer. Consumers that pass different matrices (e.g.
+#   t-SNE on a sample, UMAP on the scaled features) get separate graphs.
+# - The cache keeps at most max_cached graphs (least recently used are
+#   removed), and a graph replaces the smaller-k graphs of the same matrix.
+# - Each row of the graph holds the k nearest neighbours of that row
+#   (excluding itself), ordered by distance; the values are distances.
+#
+
+# import packages
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sparse
+from sklearn.neighbors import NearestNeighbors
+
+# pynndescent is optional (approximate index, much faster for large sets)
+try:
+    from pynndescent import NNDescent
+    HAS_PYNNDESCENT = True
+except ImportError:
+    HAS_PYNNDESCENT = False
+
+#####################################################################
+# Hash of a feature matrix (used as the cache key)
+#####################################################################
+def feature_hash(X):
+
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha1()
+    h.update(str((X.shape, X.dtype.str)).encode())
+    h.update(X.data)
+
+    return h.hexdigest()[:16]
+
+#####################################################################
+# Build (or load) the k-nearest-neighbour graph
+#####################################################################
+def knn_graph(X, k=30, cache_dir='models/knn/', method='auto', n_jobs=-1,
+              random_state=0, max_cached=8):
+# knn_graph(X, k=30, cache_dir='models/knn/', method='auto', n_jobs=-1)
+#   X : feature matrix, shape (samples, features)
+#   k : number of neighbours
+#   cache_dir : where graphs are stored (None = no caching)
+#   method : 'nndescent' (approximate), 'exact' (sklearn), or 'auto'
+#   max_cached : number of graphs kept in cache_dir
+# returns graph (scipy.sparse.csr_matrix, shape (samples, samples))
+#
+# - a cached graph with more neighbours than k is reused (and truncated)
+
+    print('neighbours.knn_graph')
+
+    key = feature_hash(X)
+
+    # look for a cached graph with at least k neighbours
+    if cache_dir is not None:
+        cached = cached_graph_file(cache_dir, key, k)
+        if cached is not None:
+            print('neighbours.knn_graph: loading ' + cached)
+            graph = sparse.load_npz(cached)
+            # mark as recently used
+            os.utime(cached)
+            return truncate_graph(graph, k)
+
+    # select method
+    if method=='auto':
+        method = 'nndescent' if HAS_PYNNDESCENT else 'exact'
+    if method=='nndescent' and not HAS_PYNNDESCENT:
+        print('neighbours.knn_graph: pynndescent is not installed, using exact search')
+        method = 'exact'
+
+    # neighbours of every sample (excluding the sample itself)
+    n = X.shape[0]
+    if method=='nndescent':
+        index = NNDescent(X, n_neighbors=k + 1, n_jobs=n_jobs,
+                          random_state=random_state)
+        indices, distances = index.neighbor_graph
+        indices, distances = drop_self(indices, distances)
+    elif method=='exact':
+        nn = NearestNeighbors(n_neighbors=k, n_jobs=n_jobs).fit(X)
+        distances, indices = nn.kneighbors()
+    else:
+        raise ValueError('method must be auto, nndescent, or exact')
+
+    # sparse matrix, rows ordered by distance (explicit zeros are kept)
+    graph = sparse.csr_matrix((distances.ravel().astype(np.float32),
+                               indices.ravel(), np.arange(0, n*k + 1, k)),
+                              shape=(n, n))
+
+    # save
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        sparse.save_npz(graph_file(cache_dir, key, k), graph, compressed=False)
+        prune_cache(cache_dir, key, k, max_cached)
+
+    return graph
+
+#####################################################################
+# Cache file names
+#####################################################################
+def graph_file(cache_dir, key, k):
+
+    return os.path.join(cache_dir, 'knn_' + key + '_k' + str(int(k)) + '.npz')
+
+def cached_graph_file(cache_dir, key, k):
+# returns the cached graph with the smallest number of neighbours >= k
+
+    if not os.path.isdir(cache_dir):
+        return None
+
+    prefix = 'knn_' + key + '_k'
+    available = [int(f[len(prefix):-4]) for f in os.listdir(cache_dir)
+                 if f.startswith(prefix) and f.endswith('.npz')]
+    available = [kk for kk in available if kk >= k]
+    if len(available)==0:
+        return None
+
+    return graph_file(cache_dir, key, np.min(available))
+
+#####################################################################
+# Remove superseded and least recently used graphs from the cache
+#####################################################################
+def prune_cache(cache_dir, key, k, max_cached=8):
+# - graphs of the same features (key) with fewer than k neighbours are
+#   removed, then the oldest graphs until at most max_cached are left
+
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+             if f.startswith('knn_') and f.endswith('.npz')]
+
+    # superseded by the new graph
+    prefix = 'knn_' + key + '_k'
+    for f in list(files):
+        name = os.path.basename(f)
+        if name.startswith(prefix) and int(name[len(prefix):-4]) < k:
+            print('neighbours.prune_cache: removing ' + f)
+            os.remove(f)
+            files.remove(f)
+
+    # least recently used
+    files.sort(key=os.path.getmtime)
+    for f in files[:max(len(files) - max_cached, 0)]:
+        print('neighbours.prune_cache: removing ' + f)
+        os.remove(f)
+
+#####################################################################
+# Remove each sample from its own neighbour list
+#####################################################################
+def drop_self(indices, distances):
+
+    n, kp1 = indices.shape
+    rows = np.arange(n)[:, None]
+
+    # drop the sample itself or, if it is not in the list, the last neighbour
+    keep = (indices != rows)
+    keep[np.all(keep, axis=1), -1] = False
+
+    return indices[keep].reshape(n, kp1 - 1), distances[keep].reshape(n, kp1 - 1)
+
+#####################################################################
+# Put each sample first in its own neighbour list (distance 0)
+#####################################################################
+def add_self(graph, X=None, chunk_size=10000):
+# - sklearn's precomputed neighbours (e.g. t-SNE) expect the sample itself
+#   in each row and otherwise drop the nearest neighbour instead
+# - if X is given, the distances are recomputed from it in float64 (the
+#   cached graph stores float32)
+
+    n = graph.shape[0]
+    indices, distances = graph_to_arrays(graph)
+    if X is not None:
+        X = np.asarray(X, dtype=np.float64)
+        distances = np.empty(indices.shape)
+        for start in range(0, n, chunk_size):
+            stop = np.min((start + chunk_size, n))
+            diff = X[start:stop, None, :] - X[indices[start:stop]]
+            distances[start:stop] = np.sqrt(np.sum(diff**2, axis=2))
+    k = indices.shape[1] + 1
+    indices = np.hstack((np.arange(n)[:, None], indices))
+    distances = np.hstack((np.zeros((n, 1), dtype=distances.dtype), distances))
+
+    # explicit zeros are kept
+    graph = sparse.csr_matrix((distances.ravel(), indices.ravel(), np.arange(0, n*k + 1, k)),
+                              shape=(n, n))
+
+    return graph
+
+#####################################################################
+# Keep only the k nearest neighbours of each row
+#####################################################################
+def truncate_graph(graph, k):
+
+    n = graph.shape[0]
+    kg = graph.indptr[1] - graph.indptr[0]
+    if kg==k:
+        return graph
+
+    indices, distances = graph_to_arrays(graph)
+    graph = sparse.csr_matrix((distances[:, :k].ravel(), indices[:, :k].ravel(),
+                               np.arange(0, n*k + 1, k)), shape=(n, n))
+
+    return graph
+
+#####################################################################
+# Neighbour indices and distances as dense (samples, k) arrays
+#####################################################################
+def graph_to_arrays(graph):
+
+    n = graph.shape[0]
+    k = graph.indptr[1] - graph.indptr[0]
+    indices = graph.indices.reshape(n, k)
+    distances = graph.data.reshape(n, k)
+
+    return indices, distances
+
+#####################################################################
+# Neighbourhood class purity (diagnostic)
+#####################################################################
+def class_purity(graph, labels):
+# class_purity(graph, labels)
+# returns purity (fraction of the neighbours of each sample that share
+# its label) and the mean purity of each class
+
+    indices, distances = graph_to_arrays(graph)
+    labels = np.asarray(labels)
+
+    # fraction of neighbours with the same label
+    purity = np.mean(labels[indices] == labels[:, None], axis=1)
+
+    # mean for each class
+    classes = np.unique(labels)
+    class_means = np.array([np.mean(purity[labels==c]) for c in classes])
+
+    return purity, class_means
@@ -0,0 +1,104 @@
+#####################################################################
+# Classification pipeline (vertical grid + scaler + PCA + GMM)
+#####################################################################
+#
+# - A pipeline is a dictionary bundling everything needed to classify
+#   new profiles: the vertical grid and levels the features were built
+#   on, the fitted scaler, the PCA, and the GMM. It is saved and loaded
+#   as a single file with file_io.save_pipeline/load_pipeline.
+#
+
+# import packages
+import numpy as np
+import xarray as xr
+import load_and_preprocess as lp
+import gmm as gm
+
+# increment when the contents of the pipeline dictionary change
+PIPELINE_VERSION = 1
+
+#####################################################################
+# Build a pipeline from a trained PCA and GMM
+#####################################################################
+def build_pipeline(profiles, pca, gmm, method='onZ'):
+# build_pipeline(profiles, pca, gmm, method='onZ')
+#   profiles : the profiles the PCA was trained on (for the vertical grid)
+#   pca : fitted PCA (from lp.fit_and_apply_pca, with pca.scaler_)
+#   gmm : fitted GaussianMixture
+#   method : 'onZ' or 'onSig' (features on depth or density levels)
+# returns pipeline (dictionary)
+
+    print('pipeline.build_pipeline')
+
+    # the scaler is needed to apply the PCA to new profiles
+    if getattr(pca, 'scaler_', None) is None:
+        raise ValueError('pca has no scaler_; refit it with lp.fit_and_apply_pca')
+    gm.check_compatibility(gmm, pca=pca)
+
+    # vertical grid the features were built on
+    XT, XS, zdim = lp.select_feature_fields(profiles, method)
+    levels = getattr(pca, 'vertical_levels_', None)
+    vertical_grid = profiles[zdim].values
+    if levels is not None:
+        vertical_grid = vertical_grid[levels]
+
+    pipeline = {'version': PIPELINE_VERSION,
+                'method': method,
+                'vertical_dim': zdim,
+                'vertical_grid': vertical_grid,
+                'vertical_levels': levels,
+                'scaler': pca.scaler_,
+                'pca': pca,
+                'gmm': gmm,
+                'n_components': gmm.n_components}
+
+    return pipeline
+
+#####################################################################
+# Classify profiles with a pipeline (streamed in batches)
+#####################################################################
+def classify(pipeline, profiles, batch_size=10000):
+# classify(pipeline, profiles, batch_size=10000)
+# returns a Dataset with label, posteriors, and i_metric for each profile
+#
+# - profiles must contain the feature fields on the same vertical grid
+#   that the pipeline was trained on; only one batch of features is
+#   held in memory at a time
+
+    print('pipeline.classify')
+
+    # check the vertical grid
+    zdim = pipeline['vertical_dim']
+    levels = pipeline['vertical_levels']
+    vertical_grid = profiles[zdim].values
+    if levels is not None:
+        vertical_grid = vertical_grid[levels]
+    if (vertical_grid.shape != pipeline['vertical_grid'].shape or
+        not np.allclose(vertical_grid, pipeline['vertical_grid'])):
+        raise ValueError('profiles are not on the vertical grid of the pipeline')
+
+    # preallocate outputs
+    nprof = profiles.profile.size
+    ncomp = pipeline['n_components']
+    labels = np.empty(nprof, dtype=np.int64)
+    posteriors = np.empty((nprof, ncomp))
+    i_metric = np.empty(nprof)
+
+    # scale, transform, and classify one batch at a time
+    scaler = pipeline['scaler']
+    pca = pipeline['pca']
+    gmm = pipeline['gmm']
+    for start, stop, X in lp.feature_batches(profiles, pipeline['method'],
+                                             levels, batch_size):
+        Xpca = pca.transform(scaler.transform(X))
+        labels[start:stop], posteriors[start:stop, :], i_metric[start:stop] = \
+            gm.classify_batch(gmm, Xpca)
+
+    # collect in a Dataset
+    classes = np.arange(ncomp)
+    result = xr.Dataset({'label': (('profile',), labels),
+                         'posteriors': (('profile','CLASS'), posteriors),
+                         'i_metric': (('profile',), i_metric)},
+                        coords={'profile': profiles.profile, 'CLASS': classes})
+
+    return result
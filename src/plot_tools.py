@@ -24,7 +24,7 @@ import os.path
 from glob import glob
 import file_io as io
 import density
-import random
+import sampling
 import gsw
 
 # update
@@ -128,7 +128,12 @@ def plot_many_profiles(ploc, df, frac = 0.10,
                        sig0min = 23.0, sig0max = 28.0,
                        alpha = 0.01, modStr = '',
                        colorVal = 'black', fs = 14, 
-                       withDensity=True):
+                       withDensity=True, summary=None,
+                       random_state=sampling.DEFAULT_SEED):
+# summary : class summary of these profiles for a single class (from
+#           class_stats.class_summary, .sel(label=...)); if given, the
+#           quantiles are taken from it instead of being recomputed
+# random_state : seed of the random sample of profiles (see sampling)
 
    print("plot_tools.plot_many_profiles")
 
@@ -142,7 +147,8 @@ def plot_many_profiles(ploc, df, frac = 0.10,
 
    # select random samples
    sample_size = int(frac*df.profile.size)
-   rows_id = sorted(random.sample(range(0, df.profile.size-1), sample_size))
+   rows_id = sampling.random_rows(df.profile.size, sample_size, sort=True,
+                                  random_state=random_state)
    df_sample = df.isel(profile=rows_id)
 
    # extract DataArrays
@@ -157,33 +163,42 @@ def plot_many_profiles(ploc, df, frac = 0.10,
        CTsig = df_sample.ct_on_sig0.values
        SAsig = df_sample.sa_on_sig0.values
 
-   # Rechunk into a single dask array chunk along the "profile" dimension
-   # --- this was necessary to get rid of a "core dimension" error
-   df = df.chunk(dict(profile=-1))
-
-   # 0.25 quantile
-   CT_q25 = df.prof_CT.quantile(0.25, dim='profile').values
-   SA_q25 = df.prof_SA.quantile(0.25, dim='profile').values
-   if withDensity==True:
-       sig0_q25 = df.sig0.quantile(0.25, dim='profile').values
-       CTsig_q25 = df.ct_on_sig0.quantile(0.25, dim='profile').values
-       SAsig_q25 = df.sa_on_sig0.quantile(0.25, dim='profile').values
-
-   # median values
-   CT_median = df.prof_CT.quantile(0.50, dim='profile').values
-   SA_median = df.prof_SA.quantile(0.50, dim='profile').values
-   if withDensity==True:
-       sig0_median = df.sig0.quantile(0.50, dim='profile').values
-       CTsig_median = df.ct_on_sig0.quantile(0.50, dim='profile').values
-       SAsig_median = df.sa_on_sig0.quantile(0.50, dim='profile').values
-
-   # 0.75 quantile
-   CT_q75 = df.prof_CT.quantile(0.75, dim='profile').values
-   SA_q75 = df.prof_SA.quantile(0.75, dim='profile').values
-   if withDensity==True:
-       sig0_q75 = df.sig0.quantile(0.75, dim='profile').values
-       CTsig_q75 = df.ct_on_sig0.quantile(0.75, dim='profile').values
-       SAsig_q75 = df.sa_on_sig0.quantile(0.75, dim='profile').values
+   # quantiles from the class summary
+   if summary is not None:
+      CT_q25, CT_median, CT_q75 = summary_quantiles(summary, 'prof_CT')
+      SA_q25, SA_median, SA_q75 = summary_quantiles(summary, 'prof_SA')
+      if withDensity==True:
+          sig0_q25, sig0_median, sig0_q75 = summary_quantiles(summary, 'sig0')
+          CTsig_q25, CTsig_median, CTsig_q75 = summary_quantiles(summary, 'ct_on_sig0')
+          SAsig_q25, SAsig_median, SAsig_q75 = summary_quantiles(summary, 'sa_on_sig0')
+   else:
+      # Rechunk into a single dask array chunk along the "profile" dimension
+      # --- this was necessary to get rid of a "core dimension" error
+      df = df.chunk(dict(profile=-1))
+
+      # 0.25 quantile
+      CT_q25 = df.prof_CT.quantile(0.25, dim='profile').values
+      SA_q25 = df.prof_SA.quantile(0.25, dim='profile').values
+      if withDensity==True:
+          sig0_q25 = df.sig0.quantile(0.25, dim='profile').values
+          CTsig_q25 = df.ct_on_sig0.quantile(0.25, dim='profile').values
+          SAsig_q25 = df.sa_on_sig0.quantile(0.25, dim='profile').values
+
+      # median values
+      CT_median = df.prof_CT.quantile(0.50, dim='profile').values
+      SA_median = df.prof_SA.quantile(0.50, dim='profile').values
+      if withDensity==True:
+          sig0_median = df.sig0.quantile(0.50, dim='profile').values
+          CTsig_median = df.ct_on_sig0.quantile(0.50, dim='profile').values
+          SAsig_median = df.sa_on_sig0.quantile(0.50, dim='profile').values
+
+      # 0.75 quantile
+      CT_q75 = df.prof_CT.quantile(0.75, dim='profile').values
+      SA_q75 = df.prof_SA.quantile(0.75, dim='profile').values
+      if withDensity==True:
+          sig0_q75 = df.sig0.quantile(0.75, dim='profile').values
+          CTsig_q75 = df.ct_on_sig0.quantile(0.75, dim='profile').values
+          SAsig_q75 = df.sa_on_sig0.quantile(0.75, dim='profile').values
 
    # figure CT
    fig1, ax1 = plt.subplots(facecolor='white')
@@ -364,8 +379,10 @@ def plot_pca_vertical_structure(ploc, profiles, pca, Xpca):
     plt.style.use('seaborn-darkgrid')
     #palette = cmx.Paired(np.linspace(0,1,n_comp))
 
-    # vertical coordinate
+    # vertical coordinate (only the levels the PCA was trained on)
     z = profiles.depth.values
+    if getattr(pca, 'vertical_levels_', None) is not None:
+        z = z[pca.vertical_levels_]
 
     num = 0
 
@@ -408,8 +425,10 @@ def plot_pca_vertical_structure(ploc, profiles, pca, Xpca):
     #plt.style.use('seaborn-darkgrid')
     #palette = cmx.Paired(np.linspace(0,1,n_comp))
 
-    # vertical coordinate
+    # vertical coordinate (only the levels the PCA was trained on)
     z = profiles.depth.values
+    if getattr(pca, 'vertical_levels_', None) is not None:
+        z = z[pca.vertical_levels_]
 
     # iterate over groups
     for npca in range(pca.n_components):
@@ -476,9 +495,8 @@ def add_ellipse(means, cov, ax, n_std=1.0, facecolor='none'):
 ########################################################################
 # Plot PCA structure in 2D space (still need to add gaussian ellipses)
 ########################################################################
-def plot_pca2D(ploc, colormap, profiles, Xpca, pca, gmm, frac=0.33, withLabels=False, fs=14):
-
-    import random
+def plot_pca2D(ploc, colormap, profiles, Xpca, pca, gmm, frac=0.33, withLabels=False, fs=14,
+               random_state=sampling.DEFAULT_SEED):
 
     # start message
     print('plot_tools.plot_pca2D')
@@ -492,7 +510,7 @@ def plot_pca2D(ploc, colormap, profiles, Xpca, pca, gmm, frac=0.33, withLabels=F
 
     # random sample
     rsample_size = int(frac*xy.shape[0])
-    rows_id = random.sample(range(0,xy.shape[0]-1), rsample_size)
+    rows_id = sampling.random_rows(xy.shape[0], rsample_size, random_state=random_state)
 
     # select radom sample in xy and color
     xyp = xy[rows_id,:]
@@ -552,7 +570,8 @@ def plot_pca2D(ploc, colormap, profiles, Xpca, pca, gmm, frac=0.33, withLabels=F
 #####################################################################
 # Plot PCA structure in 3D space (with or without class labels
 #####################################################################
-def plot_pca3D(ploc, colormap, profiles, Xpca, frac=0.33, withLabels=False, fs=14):
+def plot_pca3D(ploc, colormap, profiles, Xpca, frac=0.33, withLabels=False, fs=14,
+               random_state=sampling.DEFAULT_SEED):
 
     # for the ellipses
     import numpy.linalg as la
@@ -569,7 +588,7 @@ def plot_pca3D(ploc, colormap, profiles, Xpca, frac=0.33, withLabels=False, fs=1
 
     # random sample
     rsample_size = int(frac*xy.shape[0])
-    rows_id = random.sample(range(0,xy.shape[0]-1), rsample_size)
+    rows_id = sampling.random_rows(xy.shape[0], rsample_size, random_state=random_state)
 
     # select radom sample in xy and color
     xyp = xy[rows_id,:]
@@ -665,7 +684,7 @@ def plot_pairs(ploc, dataset, kind="hist", descr=""):
 #####################################################################
 # Plot UMAP structures (not shaded by class or anything yet)
 #####################################################################
-def plot_umap(ploc, Xtrans, frac=0.33):
+def plot_umap(ploc, Xtrans, frac=0.33, random_state=sampling.DEFAULT_SEED):
 
     # start message
     print('plot_tools.plot_umap')
@@ -674,7 +693,7 @@ def plot_umap(ploc, Xtrans, frac=0.33):
     xy=Xtrans
     # random sample
     rsample_size = int(frac*xy.shape[0])
-    rows_id = random.sample(range(0,xy.shape[0]-1), rsample_size)
+    rows_id = sampling.random_rows(xy.shape[0], rsample_size, random_state=random_state)
     xyp = xy[rows_id,:]
 
     # view 1
@@ -1129,6 +1148,15 @@ def plot_CT_and_SA_class_structure(ploc, profiles, class_means,
     plt.show()
     plt.close()
 
+#####################################################################
+# 0.25, 0.5, and 0.75 quantiles of a variable from a class summary
+#####################################################################
+def summary_quantiles(summary, variable):
+
+    q = summary[variable + '_quantiles']
+
+    return [q.sel(quantile=qq).values for qq in (0.25, 0.50, 0.75)]
+
 #####################################################################
 # Plot vertical structure of a single class (CT, SA, sigma0)
 #####################################################################
@@ -1138,7 +1166,9 @@ def plot_class_vertical_structures(ploc, df1, n_components_selected, colormap,
                                    Smin=33.6, Smax=37.0,
                                    sig0min=26.0, sig0max=28.0,
                                    frac=0.1, description='full', 
-                                   withDensity=True):
+                                   withDensity=True, summary=None):
+# summary : class summary (from class_stats.class_summary); if given, the
+#           class quantiles are not recomputed for each class
 
     print('plot_tools.plot_class_vertical_structures')
 
@@ -1163,7 +1193,8 @@ def plot_class_vertical_structures(ploc, df1, n_components_selected, colormap,
                            alpha=0.01,
                            modStr='Class'+str(nrow)+'z'+description,
                            colorVal=colorVal, 
-                           withDensity=withDensity)
+                           withDensity=withDensity,
+                           summary=None if summary is None else summary.sel(label=nrow))
 
 #####################################################################
 # Plot mean and stdev salinity class structure
@@ -1499,7 +1530,8 @@ def plot_sig0_class_structure(ploc, profiles, class_means,
 #####################################################################
 def plot_label_map(ploc, profiles, n_components_selected, colormap,
                    lon_min=-80, lon_max=80, lat_min=-85, lat_max=-30,
-                   bathy_fname="bathy.nc", lev_range=range(-6000,1,500)):
+                   bathy_fname="bathy.nc", lev_range=range(-6000,1,500),
+                   random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_label_map')
 
@@ -1527,7 +1559,7 @@ def plot_label_map(ploc, profiles, n_components_selected, colormap,
     random_sample_size = int(np.ceil(0.30*df1D.profile.size))
 
     # random sample for plotting
-    rows_id = random.sample(range(0,clabels.size-1), random_sample_size)
+    rows_id = sampling.random_rows(clabels.size, random_sample_size, random_state=random_state)
     lons_random_sample = lons[rows_id]
     lats_random_sample = lats[rows_id]
     clabels_random_sample = clabels[rows_id]
@@ -1567,7 +1599,8 @@ def plot_label_map(ploc, profiles, n_components_selected, colormap,
 # Scatter plot single i-metric map
 #####################################################################
 def plot_i_metric_single_panel(ploc, df1D, lon_min, lon_max, lat_min, lat_max,
-        rr=0.66,str="bathy.nc", lev_range=range(-6000,1,500)):
+        rr=0.66,str="bathy.nc", lev_range=range(-6000,1,500),
+        random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_i_metric_single_panel')
 
@@ -1602,7 +1635,7 @@ def plot_i_metric_single_panel(ploc, df1D, lon_min, lon_max, lat_min, lat_max,
     random_sample_size = int(np.ceil(rr*df1D.lon.size))
 
     # random sample for plotting
-    rows_id = random.sample(range(0,c.size-1), random_sample_size)
+    rows_id = sampling.random_rows(c.size, random_sample_size, random_state=random_state)
     lons_random_sample = lons[rows_id]
     lats_random_sample = lats[rows_id]
     clabels_random_sample = c[rows_id]
@@ -2099,7 +2132,8 @@ def plot_tsne(ploc, colormap, tSNE_data, colors_for_tSNE, describe=''):
 # T-S plot for a single pressure level
 #####################################################################
 def plot_TS_single_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(-2, 27.0),
-                       SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.60):
+                       SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.60,
+                       random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_TS_single_lev')
 
@@ -2138,7 +2172,7 @@ def plot_TS_single_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(
     random_sample_size = int(np.ceil(rr*df.profile.size))
 
     # random sample for plotting
-    rows_id = random.sample(range(0,clabels.size-1), random_sample_size)
+    rows_id = sampling.random_rows(clabels.size, random_sample_size, random_state=random_state)
     T_random_sample = T[rows_id]
     S_random_sample = S[rows_id]
     clabels_random_sample = clabels[rows_id]
@@ -2228,7 +2262,8 @@ def plot_TS_withMeans(ploc, class_means, class_stds, n_comp, colormap, descrip='
 # Single T-S plot featuring all pressure levels (shaded by class)
 #####################################################################
 def plot_TS_all_lev(ploc, df, n_comp, colormap, descrip='', PTrange=(-2, 27.0),
-                    SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.33):
+                    SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.33,
+                    random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_TS_all_lev')
 
@@ -2264,7 +2299,7 @@ def plot_TS_all_lev(ploc, df, n_comp, colormap, descrip='', PTrange=(-2, 27.0),
     random_sample_size = int(np.ceil(rr*df1D.profile.size))
 
     # random sample for plotting
-    rows_id = random.sample(range(0,clabels.size-1), random_sample_size)
+    rows_id = sampling.random_rows(clabels.size, random_sample_size, random_state=random_state)
     T_random_sample = T[rows_id]
     S_random_sample = S[rows_id]
     clabels_random_sample = clabels[rows_id]
@@ -2298,7 +2333,8 @@ def plot_TS_all_lev(ploc, df, n_comp, colormap, descrip='', PTrange=(-2, 27.0),
 # T-S plot for a multiple pressure levels (one for each class)
 #####################################################################
 def plot_TS_multi_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(-2, 27.0),
-                      SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.60):
+                      SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.60,
+                      random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_TS_multi_lev')
 
@@ -2335,6 +2371,9 @@ def plot_TS_multi_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(-
     labels = df1D.label.values
     depths = df1D.depth.values
 
+    # one generator for all classes (a different sample for each)
+    rng = sampling.get_rng(random_state)
+
     # for each class, create new plot (shaded by depth)
     for nclass in range(n_comp):
 
@@ -2346,7 +2385,7 @@ def plot_TS_multi_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(-
         random_sample_size = int(np.ceil(rr*T1.size))
 
         # random sample for plotting
-        rows_id = random.sample(range(0,T1.size-1), random_sample_size)
+        rows_id = sampling.random_rows(T1.size, random_sample_size, random_state=rng)
         T_random_sample = T1[rows_id]
         S_random_sample = S1[rows_id]
         clabels_random_sample = c1[rows_id]
@@ -2381,7 +2420,7 @@ def plot_TS_multi_lev(ploc, df, n_comp, colormap, descrip='', plev=0, PTrange=(-
 #####################################################################
 def plot_TS_bytime(ploc, df, n_comp, descrip='', plev=0, PTrange=(-2, 27.0),
                       SPrange=(33.5, 37.5), lon = -20, lat = -65, rr = 0.60,
-                      timeShading='month'):
+                      timeShading='month', random_state=sampling.DEFAULT_SEED):
 
     print('plot_tools.plot_TS_bytime')
 
@@ -2424,6 +2463,9 @@ def plot_TS_bytime(ploc, df, n_comp, descrip='', plev=0, PTrange=(-2, 27.0),
     months = time.month.values
     years = time.year.values
 
+    # one generator for all classes (a different sample for each)
+    rng = sampling.get_rng(random_state)
+
     # for each class, create new plot
     for nclass in range(n_comp):
 
@@ -2441,7 +2483,7 @@ def plot_TS_bytime(ploc, df, n_comp, descrip='', plev=0, PTrange=(-2, 27.0),
         random_sample_size = int(np.ceil(rr*T1.size))
 
         # random sample for plotting
-        rows_id = random.sample(range(0,T1.size-1), random_sample_size)
+        rows_id = sampling.random_rows(T1.size, random_sample_size, random_state=rng)
         T_random_sample = T1[rows_id]
         S_random_sample = S1[rows_id]
         clabels_random_sample = c1[rows_id]
@@ -0,0 +1,129 @@
+#####################################################################
+# Seeded (and optionally stratified) random subsampling
+#####################################################################
+#
+# - All random subsets (training sets for PCA, BIC and embeddings, and
+#   the subsets used for plotting) are drawn here with a NumPy Generator,
+#   so that they are reproducible (fixed seed by default).
+# - Stratified samples keep the proportions of the strata (e.g. data
+#   source, season, class, or region) and make sure that small strata
+#   are still represented.
+#
+
+# import packages
+import numpy as np
+
+# default seed for all samples
+DEFAULT_SEED = 0
+
+#####################################################################
+# Random number generator
+#####################################################################
+def get_rng(random_state=DEFAULT_SEED):
+# random_state : seed, None (not reproducible), or an existing Generator
+
+    return np.random.default_rng(random_state)
+
+#####################################################################
+# Simple random sample of row indices (without replacement)
+#####################################################################
+def random_rows(n, sample_size, random_state=DEFAULT_SEED, sort=False):
+# random_rows(n, sample_size, random_state=0, sort=False)
+# returns sample_size indices drawn from 0..n-1 (all rows if sample_size >= n)
+
+    rng = get_rng(random_state)
+    sample_size = int(np.clip(sample_size, 0, n))
+    rows_id = rng.choice(n, size=sample_size, replace=False)
+    if sort==True:
+        rows_id = np.sort(rows_id)
+
+    return rows_id
+
+#####################################################################
+# Stratified random sample of row indices
+#####################################################################
+def stratified_rows(strata, sample_size, random_state=DEFAULT_SEED,
+                    min_per_stratum=1, sort=False):
+# stratified_rows(strata, sample_size, random_state=0, min_per_stratum=1)
+#   strata : array with one stratum code (any type) for each row
+# returns about sample_size indices, allocated to the strata in proportion
+# to their size (at least min_per_stratum from each stratum, if available)
+
+    rng = get_rng(random_state)
+    strata = np.asarray(strata)
+    n = strata.size
+    sample_size = int(np.clip(sample_size, 0, n))
+
+    # rows in each stratum
+    codes, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+
+    # proportional allocation (largest remainder), with a minimum per stratum
+    quota = sample_size*counts/n
+    alloc = np.floor(quota).astype(int)
+    remainder = sample_size - np.sum(alloc)
+    alloc[np.argsort(quota - alloc)[::-1][:remainder]] += 1
+    alloc = np.minimum(np.maximum(alloc, min_per_stratum), counts)
+
+    # draw from each stratum
+    rows_id = np.concatenate([rng.choice(order[bounds[i]:bounds[i+1]], size=alloc[i],
+                                         replace=False)
+                              for i in range(codes.size)])
+    if sort==True:
+        rows_id = np.sort(rows_id)
+
+    return rows_id
+
+#####################################################################
+# Stratum code for each profile (source, season, label, region)
+#####################################################################
+def profile_strata(profiles, by=('source',), region_bins=(30.0, 10.0)):
+# profile_strata(profiles, by=('source',), region_bins=(30.0, 10.0))
+#   by : any of 'source', 'season', 'label', 'region', or the name of any
+#        other variable with one value per profile
+#   region_bins : size of the lon/lat boxes used for 'region' (degrees)
+# returns an integer stratum code for each profile
+
+    # one column of integer codes for each stratifying variable
+    columns = []
+    for name in by:
+        if name=='region':
+            ilon = np.floor(profiles.lon.values/region_bins[0])
+            ilat = np.floor(profiles.lat.values/region_bins[1])
+            values = ilon*1000 + ilat
+        else:
+            values = profiles[name].values
+        columns.append(np.unique(values, return_inverse=True)[1].ravel())
+
+    # combine the columns into a single code
+    if len(columns)==0:
+        return np.zeros(profiles.profile.size, dtype=int)
+    combined = np.stack(columns, axis=1)
+    strata = np.unique(combined, axis=0, return_inverse=True)[1].ravel()
+
+    return strata
+
+#####################################################################
+# Sample of profiles (simple or stratified)
+#####################################################################
+def sample_profiles(profiles, frac=None, sample_size=None, by=None,
+                    random_state=DEFAULT_SEED, sort=True, region_bins=(30.0, 10.0)):
+# sample_profiles(profiles, frac=None, sample_size=None, by=None, random_state=0)
+#   frac or sample_size : size of the sample (fraction or number of profiles)
+#   by : None (simple random sample) or list of stratifying variables
+#        (see profile_strata)
+# returns row indices along the profile dimension
+
+    n = profiles.profile.size
+    if sample_size is None:
+        sample_size = int(frac*n)
+
+    if by is None:
+        rows_id = random_rows(n, sample_size, random_state=random_state, sort=sort)
+    else:
+        strata = profile_strata(profiles, by=by, region_bins=region_bins)
+        rows_id = stratified_rows(strata, sample_size, random_state=random_state,
+                                  sort=sort)
+
+    return rows_id
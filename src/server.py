@@ -0,0 +1,197 @@
+#####################################################################
+# Local classification server (HTTP, JSON)
+#####################################################################
+#
+# - Loads a saved pipeline (vertical grid + scaler + PCA + GMM, see
+#   pipeline.py) once and keeps it in memory, so that a few new profiles
+#   can be labelled without running a main script.
+# - POST /classify with a JSON body
+#     {"profiles": [{"lon": ..., "lat": ..., "depth": [...],
+#                    "T": [...], "S": [...]}, ...]}
+#   (T is potential temperature and S practical salinity, as prof_T and
+#   prof_S in the archive; depth is used as pressure, as in
+#   density.calc_density). The response holds, for each profile, CT and
+#   SA on its own levels, and the label, posteriors, and i-metric; a
+#   profile that does not cover the vertical grid of the pipeline gets
+#   label null and an error message.
+# - GET /health returns a short description of the loaded model.
+# - Run with: python server.py <pipeline file name> [port]
+#
+
+# import packages
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import gsw
+import kernels
+import gmm as gm
+
+#####################################################################
+# Classify a batch of profiles with a pipeline
+#####################################################################
+def classify_profiles(pipeline, records):
+# classify_profiles(pipeline, records)
+#   records : list of dictionaries with lon, lat, depth, T, S
+# returns list of dictionaries (one per profile)
+
+    n = len(records)
+    nz = max(len(r['depth']) for r in records)
+
+    # ragged profiles, padded with NaN
+    depth = np.full((n, nz), np.nan)
+    T = np.full((n, nz), np.nan)
+    S = np.full((n, nz), np.nan)
+    for i, r in enumerate(records):
+        m = len(r['depth'])
+        if len(r['T'])!=m or len(r['S'])!=m:
+            raise ValueError('profile ' + str(i) + ': depth, T, and S must have the same length')
+        depth[i, :m] = r['depth']
+        T[i, :m] = r['T']
+        S[i, :m] = r['S']
+    lon = np.array([r['lon'] for r in records], dtype=np.float64)[:, None]
+    lat = np.array([r['lat'] for r in records], dtype=np.float64)[:, None]
+
+    # absolute salinity and conservative temperature
+    SA = gsw.SA_from_SP(S, depth, lon, lat)
+    CT = gsw.CT_from_pt(SA, T)
+
+    # features on the vertical grid of the pipeline
+    if pipeline['method']=='onZ':
+        source = depth
+    else:
+        source = gsw.density.sigma0(SA, CT)
+    # (serial kernel: requests are small and are already handled in
+    # parallel threads, see kernels.py)
+    grid = pipeline['vertical_grid']
+    X = np.concatenate((kernels.interp_linear(CT, source, grid, parallel=False),
+                        kernels.interp_linear(SA, source, grid, parallel=False)), axis=1)
+
+    # classify the profiles that cover the grid
+    valid = np.all(np.isfinite(X), axis=1)
+    labels = np.full(n, -1)
+    posteriors = np.full((n, pipeline['n_components']), np.nan)
+    i_metric = np.full(n, np.nan)
+    if np.any(valid):
+        Xpca = pipeline['pca'].transform(pipeline['scaler'].transform(X[valid]))
+        labels[valid], posteriors[valid], i_metric[valid] = gm.classify_batch(pipeline['gmm'],
+                                                                             Xpca)
+
+    # results
+    results = []
+    for i, r in enumerate(records):
+        m = len(r['depth'])
+        result = {'CT': CT[i, :m].tolist(), 'SA': SA[i, :m].tolist()}
+        if valid[i]:
+            result.update({'label': int(labels[i]),
+                           'posteriors': posteriors[i].tolist(),
+                           'i_metric': float(i_metric[i])})
+        else:
+            result.update({'label': None, 'posteriors': None, 'i_metric': None,
+                           'error': 'profile does not cover the vertical grid of the model'})
+        results.append(result)
+
+    return results
+
+#####################################################################
+# Request handler
+#####################################################################
+class ClassifyHandler(BaseHTTPRequestHandler):
+
+    # set by make_server
+    pipeline = None
+
+    def do_GET(self):
+        if self.path=='/health':
+            self.send_json(200, {'status': 'ok',
+                                 'method': self.pipeline['method'],
+                                 'n_components': int(self.pipeline['n_components']),
+                                 'n_levels': int(self.pipeline['vertical_grid'].size)})
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path!='/classify':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            records = request['profiles']
+            if len(records)==0:
+                raise ValueError('no profiles')
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {'error': 'bad request: ' + str(error)})
+            return
+        try:
+            results = classify_profiles(self.pipeline, records)
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except Exception as error:
+            # anything else (e.g. from gsw or the kernels on odd input) still
+            # gets a response
+            self.send_json(500, {'error': 'internal error: ' + type(error).__name__ +
+                                          ': ' + str(error)})
+            return
+        self.send_json(200, {'profiles': results})
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # no log line for every request
+    def log_message(self, format, *args):
+        return
+
+#####################################################################
+# Create a server for a loaded pipeline
+#####################################################################
+def make_server(pipeline, host='127.0.0.1', port=8765):
+# port=0 picks a free port (see server.server_address)
+
+    print('server.make_server')
+
+    handler = type('PipelineClassifyHandler', (ClassifyHandler,), {'pipeline': pipeline})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    return server
+
+#####################################################################
+# Start a server in a background thread (for tests and load tests)
+#####################################################################
+def start_in_background(pipeline, host='127.0.0.1', port=0):
+# returns server, url (stop with server.shutdown())
+
+    server = make_server(pipeline, host=host, port=port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://' + server.server_address[0] + ':' + str(server.server_address[1])
+
+    return server, url
+
+#####################################################################
+# Run
+#####################################################################
+if __name__=='__main__':
+
+    import file_io as io
+
+    if len(sys.argv) < 2:
+        print('usage: python server.py <pipeline file name> [port]')
+        sys.exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+
+    # load the pipeline once
+    server = make_server(io.load_pipeline(sys.argv[1]), port=port)
+    print('server: listening on http://127.0.0.1:' + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()